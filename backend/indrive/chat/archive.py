@@ -0,0 +1,89 @@
+"""
+Chat archival.
+
+Messages of rides that ended more than ``CHAT_ARCHIVE_AFTER_DAYS`` ago are
+compacted into one ``ChatArchive`` row per ride and deleted from the hot
+``ChatMessage`` table (``manage.py archive_chats``), so the table and its
+indexes only hold the chats of recent rides.
+
+The blob is zlib-compressed JSON: a list of
+``[id, sender_id, recipient_id, message, timestamp, is_read]`` rows in
+timestamp order. ``archived_messages`` turns it back into unsaved
+``ChatMessage`` instances, so serializers can't tell the difference.
+"""
+import json
+import zlib
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rides.models import Ride
+from .models import ChatArchive, ChatMessage, ChatUnreadCounter
+
+FIELDS = ['id', 'sender_id', 'recipient_id', 'message', 'timestamp', 'is_read']
+
+
+def archivable_rides(days=None):
+    """Ids of rides that ended more than ``days`` ago and still have messages in the hot table"""
+    days = settings.CHAT_ARCHIVE_AFTER_DAYS if days is None else days
+    cutoff = timezone.now() - timedelta(days=days)
+    ended = (Q(status='completed', completed_at__lt=cutoff) |
+             # Cancelled rides have no end time; they were cancelled soon after being requested
+             Q(status='cancelled', created_at__lt=cutoff))
+    return Ride.objects.filter(ended, messages__isnull=False).values_list('id', flat=True).distinct()
+
+
+def compress(rows):
+    return zlib.compress(json.dumps(rows, separators=(',', ':')).encode(), 9)
+
+
+def archive_ride(ride_id, batch_size=None):
+    """Move a ride's messages into its archive blob; returns the number of messages moved"""
+    batch_size = batch_size or settings.CHAT_ARCHIVE_DELETE_BATCH
+    with transaction.atomic():
+        rows = [
+            [id, sender_id, recipient_id, message, timestamp.isoformat(), is_read]
+            for id, sender_id, recipient_id, message, timestamp, is_read
+            in ChatMessage.objects.filter(ride_id=ride_id).order_by('timestamp', 'id').values_list(*FIELDS)
+        ]
+        if not rows:
+            return 0
+        archive = ChatArchive.objects.select_for_update().filter(ride_id=ride_id).first()
+        if archive is not None:
+            # Messages that arrived after an earlier run
+            rows = decompress(archive.data) + rows
+            rows.sort(key=lambda row: (row[4], row[0]))
+        ChatArchive.objects.update_or_create(ride_id=ride_id, defaults={
+            'message_count': len(rows),
+            'first_timestamp': parse_datetime(rows[0][4]),
+            'last_timestamp': parse_datetime(rows[-1][4]),
+            'data': compress(rows),
+        })
+        # Delete by primary key in batches to keep each statement and its lock small
+        ids = [row[0] for row in rows]
+        for start in range(0, len(ids), batch_size):
+            ChatMessage.objects.filter(id__in=ids[start:start + batch_size]).delete()
+        ChatUnreadCounter.objects.filter(ride_id=ride_id).delete()
+    return len(rows)
+
+
+def decompress(data):
+    return json.loads(zlib.decompress(bytes(data)))
+
+
+def archived_messages(ride_id, recipient=None):
+    """The archived messages of a ride as unsaved ``ChatMessage`` instances, oldest first"""
+    archive = ChatArchive.objects.filter(ride_id=ride_id).only('data').first()
+    if archive is None:
+        return []
+    messages = []
+    for id, sender_id, recipient_id, message, timestamp, is_read in decompress(archive.data):
+        if recipient is not None and recipient_id != recipient.pk:
+            continue
+        messages.append(ChatMessage(
+            id=id, ride_id=ride_id, sender_id=sender_id, recipient_id=recipient_id,
+            message=message, timestamp=parse_datetime(timestamp), is_read=is_read
+        ))
+    return messages
@@ -0,0 +1,123 @@
+"""
+Batched persistence for chat messages.
+
+``ChatConsumer`` hands each validated, unsaved ``ChatMessage`` to
+``chat_batcher``, which inserts the queued messages with one ``bulk_create``
+every ``CHAT_BATCH_DELAY_MS`` or as soon as ``CHAT_BATCH_SIZE`` are waiting,
+and broadcasts a message only once ``add``'s future says it is committed.
+
+Messages are written in the order they were queued, so per-ride ordering
+(and the ``timestamp`` order clients sort by) is preserved. A batch that
+fails goes back to the front of the queue and is retried; each batch is
+inserted in one transaction, so a retry never duplicates rows.
+
+Storage is at least once for everything the chat shows: nothing is
+broadcast (the sender's own copy of the broadcast is its acknowledgement)
+before it is in the database. A process dying with messages still queued
+loses only unacknowledged ones, which clients send again. While the
+database is failing the queue holds up to ``CHAT_MAX_PENDING`` messages;
+``add`` refuses more, and the sender is told to retry.
+"""
+import asyncio
+import logging
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from .models import ChatMessage
+from .unread import count_new_messages
+
+logger = logging.getLogger(__name__)
+
+class ChatMessageBatcher:
+    retry_delay = 1.0  # Seconds to wait after a failed batch (database unavailable...)
+
+    def __init__(self, size=None, delay_ms=None, max_pending=None):
+        self.size = size or settings.CHAT_BATCH_SIZE
+        self.delay = (delay_ms or settings.CHAT_BATCH_DELAY_MS) / 1000
+        self.max_pending = max_pending or settings.CHAT_MAX_PENDING
+        self._pending = []  # (message, future)
+        self._task = None
+
+    def add(self, message):
+        """Queue an unsaved ``ChatMessage``; must be called from the event loop.
+
+        Returns a future set to True once the message is committed, or to
+        False if it can't be saved (its ride or a participant was deleted).
+        Returns None, without queueing it, if ``max_pending`` messages are
+        already waiting.
+        """
+        self._ensure_task()
+        if len(self._pending) >= self.max_pending:
+            return None
+        saved = asyncio.get_running_loop().create_future()
+        self._pending.append((message, saved))
+        self._has_pending.set()
+        if len(self._pending) >= self.size:
+            self._full.set()
+        return saved
+
+    def _ensure_task(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._has_pending = asyncio.Event()
+            self._full = asyncio.Event()
+            self._lock = asyncio.Lock()
+            self._task = loop.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await self._has_pending.wait()
+            if len(self._pending) < self.size:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.delay)
+                except asyncio.TimeoutError:
+                    pass
+            if not await self.flush():
+                await asyncio.sleep(self.retry_delay)
+
+    async def flush(self):
+        """Write everything queued so far; returns False if a batch failed and was requeued"""
+        if self._task is None:
+            return True
+        async with self._lock:
+            while self._pending:
+                batch, self._pending = self._pending[:self.size], self._pending[self.size:]
+                if len(self._pending) < self.size:
+                    self._full.clear()
+                try:
+                    results = await database_sync_to_async(self.write)([message for message, _ in batch])
+                except Exception:
+                    logger.warning("Saving %d chat messages failed, will retry", len(batch), exc_info=True)
+                    self._pending[:0] = batch
+                    return False
+                for (_, saved), result in zip(batch, results):
+                    if not saved.done():  # Not cancelled by a sender that stopped waiting
+                        saved.set_result(result)
+            self._has_pending.clear()
+            self._full.clear()
+        return True
+
+    def write(self, batch):
+        """Insert ``batch``; returns whether each message was saved"""
+        try:
+            with transaction.atomic():
+                ChatMessage.objects.bulk_create(batch)
+                count_new_messages(batch)
+            return [True] * len(batch)
+        except IntegrityError:
+            # A ride or user was deleted meanwhile: save the rows that still can be
+            results = []
+            for message in batch:
+                try:
+                    with transaction.atomic():
+                        ChatMessage.objects.bulk_create([message])
+                        count_new_messages([message])
+                    results.append(True)
+                except IntegrityError:
+                    logger.info("Chat message for ride %s refused: its ride or a participant is gone",
+                                message.ride_id)
+                    results.append(False)
+            return results
+
+
+chat_batcher = ChatMessageBatcher()
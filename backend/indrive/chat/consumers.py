@@ -1,45 +1,90 @@
-import json
+import asyncio
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
+from django.utils import timezone
 from .models import ChatMessage
+from .batcher import chat_batcher
 from rides.models import Ride
+from indrive.codecs import CodecConsumerMixin, decode_frame
+from indrive.metrics import MetricsConsumerMixin
+from indrive.tracing import TracingConsumerMixin
 
-class ChatConsumer(AsyncWebsocketConsumer):
+class ChatConsumer(MetricsConsumerMixin, TracingConsumerMixin, CodecConsumerMixin, AsyncWebsocketConsumer):
     async def connect(self):
         self.ride_id = self.scope['url_route']['kwargs']['ride_id']
         self.user = self.scope['user']
-        
+
         if not self.user.is_authenticated:
             await self.close()
             return
 
+        # Rider and driver of the ride, cached for validating recipients
+        self.participants = await self.get_participants()
+        if self.user.id not in self.participants:
+            await self.close()
+            return
+
         self.room_group_name = f'chat_{self.ride_id}'
-        
+
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
-        await self.accept()
+        await self.accept_negotiated()
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
+        if hasattr(self, 'room_group_name'):
+            await self.channel_layer.group_discard(
+                self.room_group_name,
+                self.channel_name
+            )
+            # Don't leave this socket's last messages waiting for the next batch
+            await chat_batcher.flush()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        data = decode_frame(text_data, bytes_data)
+        message = data.get('message')
+        try:
+            recipient_id = int(data.get('recipient_id'))
+        except (TypeError, ValueError):
+            recipient_id = None
+
+        if recipient_id not in self.participants:
+            # A driver may have been assigned since this socket connected
+            self.participants = await self.get_participants()
+        if not message or recipient_id == self.user.id or recipient_id not in self.participants:
+            await self.send_payload({'type': 'error', 'message': 'Invalid chat message'})
+            return
+
+        # Saved in the next batch, broadcast once committed
+        message_obj = ChatMessage(
+            ride_id=self.ride_id,
+            sender_id=self.user.id,
+            recipient_id=recipient_id,
+            message=message,
+            timestamp=timezone.now()
         )
+        saved = chat_batcher.add(message_obj)
+        if saved is None:
+            await self.send_payload({'type': 'error', 'message': 'Chat is unavailable, try again later'})
+            return
+        try:
+            saved = await asyncio.wait_for(saved, settings.CHAT_SAVE_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            # The database is failing; the message may still be saved once it is back
+            await self.send_payload({'type': 'error', 'message': 'Message not confirmed, try again later'})
+            return
+        if not saved:
+            await self.send_payload({'type': 'error', 'message': 'This chat is closed'})
+            return
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        message = data['message']
-        recipient_id = data['recipient_id']
-        
-        # Save message to database
-        message_obj = await self.create_message(message, recipient_id)
-        
         # Broadcast to room group
         await self.channel_layer.group_send(
             self.room_group_name,
             {
                 'type': 'chat_message',
+                'id': message_obj.id,
                 'message': message,
                 'sender_id': self.user.id,
                 'timestamp': message_obj.timestamp.isoformat()
@@ -47,17 +92,14 @@ class ChatConsumer(AsyncWebsocketConsumer):
         )
 
     async def chat_message(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self.send_payload(event)
 
     @database_sync_to_async
-    def create_message(self, message, recipient_id):
-        from users.models import User
-        recipient = User.objects.get(id=recipient_id)
-        ride = Ride.objects.get(id=self.ride_id)
-        
-        return ChatMessage.objects.create(
-            ride=ride,
-            sender=self.user,
-            recipient=recipient,
-            message=message
-        )
\ No newline at end of file
+    def get_participants(self):
+        try:
+            ride = Ride.objects.filter(id=self.ride_id).values('rider_id', 'driver_id').first()
+        except ValueError:  # Not a ride id
+            return set()
+        if ride is None:
+            return set()
+        return {user_id for user_id in ride.values() if user_id is not None}
@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from chat.archive import archivable_rides, archive_ride
+
+
+class Command(BaseCommand):
+    help = 'Compact the chat messages of rides that ended long ago into one compressed archive row per ride'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.CHAT_ARCHIVE_AFTER_DAYS,
+                            help='Archive rides completed or cancelled more than this many days ago')
+        parser.add_argument('--batch-size', type=int, default=settings.CHAT_ARCHIVE_DELETE_BATCH,
+                            help='Hot rows deleted per statement')
+        parser.add_argument('--limit', type=int, default=None, help='Archive at most this many rides')
+
+    def handle(self, *args, **options):
+        ride_ids = list(archivable_rides(options['days'])[:options['limit']])
+        messages = 0
+        for ride_id in ride_ids:
+            messages += archive_ride(ride_id, batch_size=options['batch_size'])
+        self.stdout.write(f"Archived {messages} messages of {len(ride_ids)} rides")
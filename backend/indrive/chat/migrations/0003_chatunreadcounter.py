@@ -0,0 +1,44 @@
+# Generated by Django 4.2.30 on 2026-10-19 14:47
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def count_existing_unread(apps, schema_editor):
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    ChatUnreadCounter = apps.get_model('chat', 'ChatUnreadCounter')
+    db_alias = schema_editor.connection.alias
+    unread = (ChatMessage.objects.using(db_alias).filter(is_read=False)
+              .values('ride_id', 'recipient_id').annotate(count=models.Count('id')))
+    ChatUnreadCounter.objects.using(db_alias).bulk_create(
+        [ChatUnreadCounter(ride_id=row['ride_id'], recipient_id=row['recipient_id'], count=row['count'])
+         for row in unread.iterator()],
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0002_rename_fare_ride_final_fare_ride_accepted_proposal_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0002_alter_chatmessage_timestamp'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatUnreadCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('recipient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='unread_counters', to=settings.AUTH_USER_MODEL)),
+                ('ride', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='unread_counters', to='rides.ride')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='chatunreadcounter',
+            constraint=models.UniqueConstraint(fields=('recipient', 'ride'), name='unique_unread_counter'),
+        ),
+        migrations.RunPython(count_existing_unread, migrations.RunPython.noop),
+    ]
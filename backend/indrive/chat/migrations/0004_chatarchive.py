@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-19 14:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_chatunreadcounter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatArchive',
+            fields=[
+                ('ride_id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('message_count', models.PositiveIntegerField()),
+                ('first_timestamp', models.DateTimeField(null=True)),
+                ('last_timestamp', models.DateTimeField(null=True)),
+                ('data', models.BinaryField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
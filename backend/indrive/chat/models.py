@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 from users.models import User
 from rides.models import Ride
 
@@ -7,7 +8,7 @@ class ChatMessage(models.Model):
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
     recipient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_messages')
     message = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now) # Set when received, saved in batches later
     is_read = models.BooleanField(default=False)
 
     class Meta:
@@ -18,4 +19,32 @@ class ChatMessage(models.Model):
         ]
 
     def __str__(self):
-        return f"{self.sender} to {self.recipient}: {self.message[:20]}"
\ No newline at end of file
+        return f"{self.sender} to {self.recipient}: {self.message[:20]}"
+
+class ChatUnreadCounter(models.Model):
+    """Unread messages of one recipient in one ride, kept up to date by chat.unread"""
+    ride = models.ForeignKey(Ride, on_delete=models.CASCADE, related_name='unread_counters')
+    recipient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='unread_counters')
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['recipient', 'ride'], name='unique_unread_counter')
+        ]
+
+    def __str__(self):
+        return f"{self.recipient} has {self.count} unread in ride {self.ride_id}"
+
+
+class ChatArchive(models.Model):
+    """All messages of a finished ride, compacted into one compressed blob by chat.archive"""
+    # Plain id rather than a foreign key: the archive outlives the ride row
+    ride_id = models.BigIntegerField(primary_key=True)
+    message_count = models.PositiveIntegerField()
+    first_timestamp = models.DateTimeField(null=True)
+    last_timestamp = models.DateTimeField(null=True)
+    data = models.BinaryField()  # zlib-compressed JSON, see chat.archive
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.message_count} archived messages of ride {self.ride_id}"
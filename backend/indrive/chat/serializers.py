@@ -10,4 +10,13 @@ class ChatMessageSerializer(serializers.ModelSerializer):
 class ChatMessageUpdateSerializer(serializers.ModelSerializer):
     class Meta:
         model = ChatMessage
-        fields = ['is_read']
\ No newline at end of file
+        fields = ['is_read']
+
+class MarkReadSerializer(serializers.Serializer):
+    up_to_id = serializers.IntegerField(required=False)
+    up_to_timestamp = serializers.DateTimeField(required=False)
+
+    def validate(self, data):
+        if len(data) != 1:
+            raise serializers.ValidationError('Give exactly one of up_to_id and up_to_timestamp.')
+        return data
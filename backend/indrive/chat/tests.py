@@ -0,0 +1,201 @@
+import asyncio
+from datetime import timedelta
+from io import StringIO
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rides.models import Ride
+from users.models import User
+from chat.archive import archivable_rides, archive_ride, archived_messages
+from chat.batcher import ChatMessageBatcher
+from chat.consumers import ChatConsumer
+from chat.models import ChatArchive, ChatMessage, ChatUnreadCounter
+from chat.unread import count_new_messages
+
+
+class ChatTestMixin:
+    def setUp(self):
+        self.rider = User.objects.create_user('+9771000001', role='rider')
+        self.driver = User.objects.create_user('+9771000002', role='driver')
+        self.ride = Ride.objects.create(rider=self.rider, driver=self.driver, pickup_location='a',
+                                        destination_location='b', proposed_fare=100)
+
+    def message(self, text='hi', sender=None, recipient=None):
+        return ChatMessage(ride_id=self.ride.id, sender_id=(sender or self.driver).id,
+                           recipient_id=(recipient or self.rider).id, message=text)
+
+
+class ChatMessageBatcherTests(ChatTestMixin, TransactionTestCase):
+    async def test_futures_resolve_once_the_batch_is_saved(self):
+        batcher = ChatMessageBatcher(size=3, delay_ms=1000)
+        messages = [self.message(str(i)) for i in range(3)]
+        saved = [batcher.add(message) for message in messages]
+        self.assertEqual(await asyncio.wait_for(asyncio.gather(*saved), 1), [True] * 3)
+        self.assertTrue(all(message.id for message in messages))
+        self.assertEqual(await ChatMessage.objects.acount(), 3)
+        counter = await ChatUnreadCounter.objects.aget(recipient=self.rider)
+        self.assertEqual(counter.count, 3)
+
+    async def test_unsaveable_messages_are_refused_alone(self):
+        batcher = ChatMessageBatcher(size=2, delay_ms=1000)
+        gone = User(id=999999)
+        saved = [batcher.add(self.message()), batcher.add(self.message(recipient=gone))]
+        self.assertEqual(await asyncio.wait_for(asyncio.gather(*saved), 1), [True, False])
+        self.assertEqual(await ChatMessage.objects.acount(), 1)
+
+    async def test_full_queue_refuses_messages(self):
+        batcher = ChatMessageBatcher(delay_ms=60000, max_pending=1)
+        self.assertIsNotNone(batcher.add(self.message()))
+        self.assertIsNone(batcher.add(self.message()))
+        await batcher.flush()
+
+    async def test_failed_batches_are_retried(self):
+        batcher = ChatMessageBatcher(delay_ms=1)
+        batcher.retry_delay = 0.01
+        write = batcher.write
+        attempts = []
+
+        def flaky(batch):
+            attempts.append(len(batch))
+            if len(attempts) == 1:
+                raise RuntimeError('down')
+            return write(batch)
+
+        batcher.write = flaky
+        with self.assertLogs('chat.batcher', 'WARNING'):
+            self.assertTrue(await asyncio.wait_for(batcher.add(self.message()), 1))
+        self.assertEqual(attempts, [1, 1])
+        self.assertEqual(await ChatMessage.objects.acount(), 1)
+
+
+class ChatConsumerTests(ChatTestMixin, TransactionTestCase):
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{self.ride.id}/')
+        communicator.scope['user'] = user
+        communicator.scope['url_route'] = {'kwargs': {'ride_id': str(self.ride.id)}}
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_messages_are_broadcast_once_saved(self):
+        rider, driver = await self.connect(self.rider), await self.connect(self.driver)
+        try:
+            await driver.send_json_to({'message': 'On my way', 'recipient_id': self.rider.id})
+            for communicator in (rider, driver):
+                event = await communicator.receive_json_from(timeout=2)
+                self.assertEqual(event['message'], 'On my way')
+                stored = await ChatMessage.objects.aget(id=event['id'])
+                self.assertEqual(stored.sender_id, self.driver.id)
+        finally:
+            await rider.disconnect()
+            await driver.disconnect()
+
+    async def test_invalid_recipients_are_refused(self):
+        driver = await self.connect(self.driver)
+        try:
+            await driver.send_json_to({'message': 'Hello me', 'recipient_id': self.driver.id})
+            self.assertEqual((await driver.receive_json_from())['type'], 'error')
+            self.assertEqual(await ChatMessage.objects.acount(), 0)
+        finally:
+            await driver.disconnect()
+
+
+class UnreadCounterTests(ChatTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.rider)
+        # Three messages sent at the same instant, so only their ids order them
+        now = timezone.now()
+        self.messages = ChatMessage.objects.bulk_create([
+            ChatMessage(ride=self.ride, sender=self.driver, recipient=self.rider, message=str(i), timestamp=now)
+            for i in range(3)
+        ])
+        count_new_messages(self.messages)
+
+    def unread(self):
+        return self.client.get('/api/chat/unread/').json()
+
+    def mark_read(self, **data):
+        return self.client.post(f'/api/chat/rides/{self.ride.id}/messages/mark-read/', data, format='json')
+
+    def test_new_messages_are_counted(self):
+        self.assertEqual(self.unread(), {'rides': [{'ride_id': self.ride.id, 'unread': 3}], 'total': 3})
+
+    def test_mark_read_up_to_a_message(self):
+        response = self.mark_read(up_to_id=self.messages[1].id)
+        self.assertEqual(response.json(), {'marked_read': 2})
+        self.assertEqual(self.unread()['total'], 1)
+        read = ChatMessage.objects.order_by('id').values_list('is_read', flat=True)
+        self.assertEqual(list(read), [True, True, False])
+
+    def test_mark_read_up_to_a_time(self):
+        self.assertEqual(self.mark_read(up_to_timestamp=timezone.now().isoformat()).json(), {'marked_read': 3})
+        self.assertEqual(self.unread(), {'rides': [], 'total': 0})
+        self.assertEqual(self.mark_read(up_to_id=self.messages[2].id).json(), {'marked_read': 0})
+
+    def test_mark_read_needs_exactly_one_bound(self):
+        self.assertEqual(self.mark_read().status_code, 400)
+        self.assertEqual(self.mark_read(up_to_id=1, up_to_timestamp=timezone.now().isoformat()).status_code, 400)
+
+    def test_updating_one_message_adjusts_the_counter(self):
+        url = f'/api/chat/rides/{self.ride.id}/messages/{self.messages[0].id}/'
+        self.client.patch(url, {'is_read': True}, format='json')
+        self.client.patch(url, {'is_read': True}, format='json')
+        self.assertEqual(self.unread()['total'], 2)
+        self.client.patch(url, {'is_read': False}, format='json')
+        self.assertEqual(self.unread()['total'], 3)
+
+    def test_only_active_rides_are_listed(self):
+        Ride.objects.filter(id=self.ride.id).update(status='completed')
+        self.assertEqual(self.unread(), {'rides': [], 'total': 0})
+
+
+class ChatArchiveTests(ChatTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.ended = timezone.now() - timedelta(days=31)
+        Ride.objects.filter(id=self.ride.id).update(status='completed', completed_at=self.ended)
+        self.sent = ChatMessage.objects.bulk_create([
+            ChatMessage(ride=self.ride, sender=self.driver, recipient=self.rider, message='Here',
+                        timestamp=self.ended - timedelta(minutes=2)),
+            ChatMessage(ride=self.ride, sender=self.rider, recipient=self.driver, message='Coming',
+                        timestamp=self.ended - timedelta(minutes=1), is_read=True),
+        ])
+
+    def test_only_rides_that_ended_long_ago_are_archivable(self):
+        self.assertEqual(list(archivable_rides(days=30)), [self.ride.id])
+        self.assertEqual(list(archivable_rides(days=32)), [])
+        Ride.objects.filter(id=self.ride.id).update(status='started')
+        self.assertEqual(list(archivable_rides(days=30)), [])
+
+    def test_archived_messages_read_back_the_same(self):
+        ChatUnreadCounter.objects.create(ride=self.ride, recipient=self.rider, count=1)
+        self.assertEqual(archive_ride(self.ride.id, batch_size=1), 2)
+        self.assertFalse(ChatMessage.objects.exists())
+        self.assertFalse(ChatUnreadCounter.objects.exists())
+        archive = ChatArchive.objects.get()
+        self.assertEqual((archive.message_count, archive.first_timestamp), (2, self.sent[0].timestamp))
+        fields = ['id', 'sender_id', 'recipient_id', 'message', 'timestamp', 'is_read']
+        self.assertEqual([[getattr(message, field) for field in fields] for message in archived_messages(self.ride.id)],
+                         [[getattr(message, field) for field in fields] for message in self.sent])
+        self.assertEqual([message.message for message in archived_messages(self.ride.id, self.rider)], ['Here'])
+
+    def test_later_messages_are_merged_into_the_archive(self):
+        archive_ride(self.ride.id)
+        ChatMessage.objects.create(ride=self.ride, sender=self.driver, recipient=self.rider, message='Thanks',
+                                   timestamp=self.ended + timedelta(minutes=1))
+        self.assertEqual(archive_ride(self.ride.id), 3)
+        self.assertEqual([message.message for message in archived_messages(self.ride.id)],
+                         ['Here', 'Coming', 'Thanks'])
+
+    def test_history_endpoint_serves_archived_messages(self):
+        call_command('archive_chats', days=30, stdout=StringIO())
+        client = APIClient()
+        client.force_authenticate(self.rider)
+        response = client.get(f'/api/chat/rides/{self.ride.id}/messages/')
+        self.assertEqual([message['message'] for message in response.json()], ['Here'])
+        detail = client.get(f'/api/chat/rides/{self.ride.id}/messages/{self.sent[0].id}/')
+        self.assertEqual(detail.json()['message'], 'Here')
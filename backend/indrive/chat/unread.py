@@ -0,0 +1,58 @@
+"""
+Unread chat counters.
+
+``ChatUnreadCounter`` holds the number of unread messages per (ride,
+recipient). It is adjusted in the same transaction as the messages it
+counts: ``count_new_messages`` after inserts, ``mark_read`` and
+``set_read`` when messages are read, so listing unread counts never has to
+scan ``ChatMessage``.
+"""
+from collections import Counter
+from django.db.models import F, Q, Subquery
+from django.db.models.functions import Greatest
+from .models import ChatMessage, ChatUnreadCounter
+
+
+def _adjust(ride_id, recipient_id, delta):
+    updated = ChatUnreadCounter.objects.filter(ride_id=ride_id, recipient_id=recipient_id).update(
+        count=Greatest(F('count') + delta, 0)
+    )
+    if not updated and delta > 0:
+        ChatUnreadCounter.objects.bulk_create(
+            [ChatUnreadCounter(ride_id=ride_id, recipient_id=recipient_id)], ignore_conflicts=True
+        )
+        ChatUnreadCounter.objects.filter(ride_id=ride_id, recipient_id=recipient_id).update(
+            count=F('count') + delta
+        )
+
+
+def count_new_messages(messages):
+    """Add freshly inserted unread ``messages`` to their counters; call inside the inserting transaction"""
+    new = Counter((message.ride_id, message.recipient_id) for message in messages if not message.is_read)
+    for (ride_id, recipient_id), count in new.items():
+        _adjust(ride_id, recipient_id, count)
+
+
+def mark_read(ride_id, recipient, up_to_id=None, up_to_timestamp=None):
+    """Mark the recipient's messages of a ride read up to a message or a time, in one UPDATE.
+
+    Returns the number of messages marked read. Must run in a transaction.
+    """
+    messages = ChatMessage.objects.filter(ride_id=ride_id, recipient=recipient, is_read=False)
+    if up_to_id is not None:
+        # Compare on timestamp so the (ride, timestamp) index serves the UPDATE; the id
+        # orders messages sent at the same instant, so later ones stay unread
+        timestamp = Subquery(ChatMessage.objects.filter(pk=up_to_id, ride_id=ride_id).values('timestamp')[:1])
+        messages = messages.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lte=up_to_id))
+    elif up_to_timestamp is not None:
+        messages = messages.filter(timestamp__lte=up_to_timestamp)
+    marked = messages.update(is_read=True)
+    if marked:
+        _adjust(ride_id, recipient.pk, -marked)
+    return marked
+
+
+def set_read(message, is_read):
+    """Counter side of changing one message's ``is_read`` flag; call before saving it"""
+    if message.is_read != is_read:
+        _adjust(message.ride_id, message.recipient_id, -1 if is_read else 1)
@@ -7,4 +7,5 @@ router.register(r'messages', views.ChatMessageViewSet, basename='chatmessage')
 
 urlpatterns = [
     path('rides/<int:ride_id>/', include(router.urls)),
+    path('unread/', views.UnreadCountView.as_view(), name='chat_unread'),
 ]
\ No newline at end of file
@@ -1,6 +1,14 @@
-from rest_framework import viewsets, permissions
-from .models import ChatMessage
-from .serializers import ChatMessageSerializer, ChatMessageUpdateSerializer
+from django.db import transaction
+from rest_framework import viewsets, permissions, status
+from rest_framework.decorators import action
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from .archive import archived_messages
+from .models import ChatMessage, ChatUnreadCounter
+from .serializers import ChatMessageSerializer, ChatMessageUpdateSerializer, MarkReadSerializer
+from .unread import count_new_messages, mark_read, set_read
+
+ACTIVE_RIDE_STATUSES = ['requested', 'accepted', 'started']
 
 class ChatMessageViewSet(viewsets.ModelViewSet):
     serializer_class = ChatMessageSerializer
@@ -13,14 +21,60 @@ class ChatMessageViewSet(viewsets.ModelViewSet):
             recipient=self.request.user
         ).order_by('-timestamp')
 
+    def list(self, request, *args, **kwargs):
+        # Chats of rides that ended long ago live in one compressed archive row
+        archived = archived_messages(self.kwargs['ride_id'], recipient=request.user)
+        if not archived:
+            return super().list(request, *args, **kwargs)
+        messages = list(self.get_queryset()) + archived
+        messages.sort(key=lambda message: message.timestamp, reverse=True)
+        return Response(self.get_serializer(messages, many=True).data)
+
+    def retrieve(self, request, *args, **kwargs):
+        if not self.get_queryset().filter(pk=kwargs['pk']).exists():
+            for message in archived_messages(self.kwargs['ride_id'], recipient=request.user):
+                if str(message.pk) == kwargs['pk']:
+                    return Response(self.get_serializer(message).data)
+        return super().retrieve(request, *args, **kwargs)
+
     def perform_create(self, serializer):
         ride_id = self.kwargs['ride_id']
-        serializer.save(
-            sender=self.request.user,
-            ride_id=ride_id
-        )
+        with transaction.atomic():
+            message = serializer.save(
+                sender=self.request.user,
+                ride_id=ride_id
+            )
+            count_new_messages([message])
+
+    def perform_update(self, serializer):
+        with transaction.atomic():
+            if 'is_read' in serializer.validated_data:
+                set_read(serializer.instance, serializer.validated_data['is_read'])
+            serializer.save()
+
+    @action(detail=False, methods=['post'], url_path='mark-read')
+    def mark_read(self, request, ride_id=None):
+        """Mark this ride's messages to the user read up to ``up_to_id`` or ``up_to_timestamp``"""
+        serializer = MarkReadSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        with transaction.atomic():
+            marked = mark_read(ride_id, request.user, **serializer.validated_data)
+        return Response({'marked_read': marked}, status=status.HTTP_200_OK)
 
     def get_serializer_class(self):
         if self.action in ['update', 'partial_update']:
             return ChatMessageUpdateSerializer
-        return super().get_serializer_class()
\ No newline at end of file
+        return super().get_serializer_class()
+
+class UnreadCountView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        # One query over the counters, joined to rides for their status
+        counters = ChatUnreadCounter.objects.filter(
+            recipient=request.user,
+            count__gt=0,
+            ride__status__in=ACTIVE_RIDE_STATUSES
+        ).values_list('ride_id', 'count')
+        rides = [{'ride_id': ride_id, 'unread': count} for ride_id, count in counters]
+        return Response({'rides': rides, 'total': sum(ride['unread'] for ride in rides)})
@@ -0,0 +1,34 @@
+"""
+SQLite backend that applies ``OPTIONS['pragmas']`` to every new connection.
+
+Synchronous level, mmap size and busy timeout are per connection, so they
+have to be set on connect rather than once with the sqlite3 shell. Pragmas
+that are stored in the database file (``journal_mode=WAL``) don't belong
+here: they would rewrite the file on first connect.
+
+``OPTIONS['transaction_mode']`` (``IMMEDIATE``, as in Django 5.1) makes
+``atomic()`` take the write lock when it begins. A deferred transaction that
+reads and then writes fails with "database is locked" at once, without the
+busy timeout, when another connection wrote in between, which concurrent
+ASGI requests (a thread each) run into.
+"""
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        self.pragmas = params.pop('pragmas', {})
+        self.transaction_mode = params.pop('transaction_mode', None)
+        return params
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        if self.transaction_mode is None:
+            return super()._start_transaction_under_autocommit()
+        self.cursor().execute(f"BEGIN {self.transaction_mode}")
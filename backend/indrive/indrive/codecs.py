@@ -0,0 +1,202 @@
+"""
+Wire formats for the ride and chat WebSockets.
+
+Clients choose a format during the WebSocket handshake
+(``Sec-WebSocket-Protocol``):
+
+* ``indrive.msgpack.v1`` - binary MessagePack frames. Field names listed in
+  ``FIELD_KEYS`` are replaced by their short keys at every nesting level and
+  the ``type`` of known messages by its code in ``MESSAGE_TYPES``. Only
+  offered when ``msgpack`` is installed.
+* ``indrive.json.v1``, or no subprotocol at all - JSON text frames with the
+  full field names. This is the fallback for older clients.
+
+Incoming frames are decoded by their kind (text or binary), so a client may
+always send JSON text even after negotiating MessagePack.
+"""
+import json
+from collections import OrderedDict
+from django.core.serializers.json import DjangoJSONEncoder
+
+try:
+    import msgpack
+except ImportError:  # Binary frames are simply not offered
+    msgpack = None
+
+JSON_SUBPROTOCOL = 'indrive.json.v1'
+MSGPACK_SUBPROTOCOL = 'indrive.msgpack.v1'
+
+# Full field name -> compact key. Shared by both directions and all nesting
+# levels, so a compact key must never be a full field name itself.
+FIELD_KEYS = {
+    # Envelope
+    'type': 't',
+    'content': 'c',
+    'message': 'm',
+    'ride_id': 'r',
+    'seq': 'q',
+    'last_seq': 'lq',
+    'user_id': 'u',
+    'sender_id': 'sd',
+    'recipient_id': 'rc',
+    'timestamp': 'ts',
+    'latitude': 'la',
+    'longitude': 'lo',
+    'bid': 'b',
+    'eta': 'e',
+    'distance': 'ds',
+    'polyline': 'pl',
+    # Ride
+    'id': 'i',
+    'rider': 'rd',
+    'driver': 'dr',
+    'status': 'st',
+    'pickup_location': 'pk',
+    'pickup_latitude': 'pka',
+    'pickup_longitude': 'pko',
+    'destination_location': 'dn',
+    'destination_latitude': 'dna',
+    'destination_longitude': 'dno',
+    'proposal_type': 'pt',
+    'created_at': 'ca',
+    'accepted_at': 'aa',
+    'completed_at': 'ma',
+    'proposed_fare': 'pf',
+    'final_fare': 'ff',
+    'eta_minutes': 'em',
+    'distance_km': 'dk',
+    'estimated_duration': 'ed',
+    'route_polyline': 'rp',
+    'driver_proposals': 'dp',
+    'passenger_counter_offers': 'pc',
+    'accepted_proposal': 'ap',
+    'amount': 'am',
+    # User
+    'phone_number': 'ph',
+    'role': 'ro',
+    'is_available': 'av',
+    'is_online': 'on',
+}
+FULL_KEYS = {short: full for full, short in FIELD_KEYS.items()}
+assert len(FULL_KEYS) == len(FIELD_KEYS) and not FULL_KEYS.keys() & FIELD_KEYS.keys()
+
+# Message type -> code, for the ``type`` field only
+MESSAGE_TYPES = {
+    'websocket.connected': 0,
+    'ride_update': 1,
+    'bid_update': 2,
+    'location_update': 3,
+    'eta_update': 4,
+    'location_ping': 5,
+    'resume': 6,
+    'resync_required': 7,
+    'chat_message': 8,
+    'error': 9,
+    'ping': 10,
+    'pong': 11,
+    'ride_offer': 12,
+}
+TYPE_NAMES = {code: name for name, code in MESSAGE_TYPES.items()}
+
+
+def _msgpack_default(value):
+    # Decimals, datetimes, UUIDs... the same way the JSON frames spell them
+    return DjangoJSONEncoder().default(value)
+
+
+def _compact(value):
+    if isinstance(value, dict):
+        return {FIELD_KEYS.get(key, key): _compact(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_compact(item) for item in value]
+    return value
+
+
+def _expand(value):
+    if isinstance(value, dict):
+        return {FULL_KEYS.get(key, key): _expand(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_expand(item) for item in value]
+    return value
+
+
+class JSONCodec:
+    subprotocol = JSON_SUBPROTOCOL
+    binary = False
+
+    def encode(self, payload):
+        return json.dumps(payload, cls=DjangoJSONEncoder)
+
+
+class MsgPackCodec:
+    subprotocol = MSGPACK_SUBPROTOCOL
+    binary = True
+
+    def encode(self, payload):
+        frame = _compact(payload)
+        if frame.get('t') in MESSAGE_TYPES:
+            frame['t'] = MESSAGE_TYPES[frame['t']]
+        return msgpack.packb(frame, default=_msgpack_default)
+
+
+JSON_CODEC = JSONCodec()
+MSGPACK_CODEC = MsgPackCodec() if msgpack is not None else None
+
+
+# Encoded frames of recently broadcast events, keyed by (subprotocol, event key).
+# Every socket in a group gets the same frame for a sequenced event, so a
+# fan-out pays for one encode per format instead of one per recipient.
+FRAME_CACHE_SIZE = 1024
+_frame_cache = OrderedDict()
+
+
+def encode_frame(codec, payload, cache_key=None):
+    if cache_key is None:
+        return codec.encode(payload)
+    key = (codec.subprotocol, cache_key)
+    frame = _frame_cache.get(key)
+    if frame is None:
+        frame = _frame_cache[key] = codec.encode(payload)
+        if len(_frame_cache) > FRAME_CACHE_SIZE:
+            _frame_cache.popitem(last=False)
+    return frame
+
+
+def negotiate_codec(subprotocols):
+    """Pick the codec for a handshake; returns ``(codec, subprotocol to accept)``"""
+    if MSGPACK_CODEC is not None and MSGPACK_SUBPROTOCOL in subprotocols:
+        return MSGPACK_CODEC, MSGPACK_SUBPROTOCOL
+    if JSON_SUBPROTOCOL in subprotocols:
+        return JSON_CODEC, JSON_SUBPROTOCOL
+    return JSON_CODEC, None
+
+
+def decode_frame(text_data=None, bytes_data=None):
+    """Decode an incoming text (JSON) or binary (MessagePack) frame to a dict with full keys"""
+    if text_data is not None:
+        return json.loads(text_data)
+    if msgpack is None:
+        raise ValueError('Binary frames are not supported')
+    data = _expand(msgpack.unpackb(bytes_data))
+    if not isinstance(data, dict):
+        raise ValueError('Frame must be a map')
+    if isinstance(data.get('type'), int):
+        data['type'] = TYPE_NAMES.get(data['type'], data['type'])
+    return data
+
+
+class CodecConsumerMixin:
+    """Subprotocol negotiation and framing for ``AsyncWebsocketConsumer`` subclasses"""
+    codec = JSON_CODEC
+
+    async def accept_negotiated(self):
+        self.codec, subprotocol = negotiate_codec(self.scope.get('subprotocols') or [])
+        await self.accept(subprotocol)
+
+    async def send_payload(self, payload, cache_key=None):
+        """Send ``payload``; pass ``cache_key`` when the same payload goes to many sockets"""
+        frame = encode_frame(self.codec, payload, cache_key)
+        if self.codec.binary:
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
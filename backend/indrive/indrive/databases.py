@@ -0,0 +1,85 @@
+"""
+Database profiles, picked with the ``DATABASE_PROFILE`` environment variable.
+
+* ``sqlite`` (default) - the local ``db.sqlite3`` through
+  ``indrive.backends.sqlite3``, tuned for a development server with a few
+  concurrent writers: ``synchronous=NORMAL`` (fewer fsyncs per commit),
+  memory mapped reads and a busy timeout instead of immediate "database is
+  locked" errors, with transactions that take the write lock up front so
+  they wait out that timeout too. Only per-connection pragmas are set: the
+  WAL journal mode would be written into the (tracked) database file and
+  leave ``-wal``/``-shm`` files next to it; switch a local copy over with
+  ``PRAGMA journal_mode=WAL`` in ``manage.py dbshell`` if wanted.
+* ``postgres`` - PostgreSQL from the ``POSTGRES_*`` variables, with
+  persistent connections (``DB_CONN_MAX_AGE`` seconds, checked before reuse)
+  and, with ``DB_POOL=pgbouncer``, settings for a PgBouncer in transaction
+  pooling mode in front of the server (Django 4.2 has no pool of its own).
+  ``POSTGRES_REPLICA_HOSTS`` (comma separated) adds a ``replica_<n>``
+  alias per streaming replica of that server, for ``indrive.routers``.
+"""
+import os
+
+SQLITE_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'mmap_size': 134217728,  # 128 MiB
+    'busy_timeout': 5000,  # Milliseconds
+    'temp_store': 'MEMORY',
+}
+
+
+def sqlite_database(path, tuned=True):
+    if not tuned:
+        return {'ENGINE': 'django.db.backends.sqlite3', 'NAME': path}
+    return {
+        'ENGINE': 'indrive.backends.sqlite3',
+        'NAME': path,
+        'OPTIONS': {'pragmas': dict(SQLITE_PRAGMAS), 'transaction_mode': 'IMMEDIATE'},
+    }
+
+
+def postgres_database(environ=os.environ):
+    database = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': environ.get('POSTGRES_DB', 'indrive'),
+        'USER': environ.get('POSTGRES_USER', 'indrive'),
+        'PASSWORD': environ.get('POSTGRES_PASSWORD', ''),
+        'HOST': environ.get('POSTGRES_HOST', 'localhost'),
+        'PORT': environ.get('POSTGRES_PORT', '5432'),
+        # Keep connections open between requests instead of a new one (and
+        # its TCP + auth handshake) per request
+        'CONN_MAX_AGE': int(environ.get('DB_CONN_MAX_AGE', 60)),
+        # Ping a reused connection first, so a server restart costs one
+        # reconnect instead of one failed request per worker
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'connect_timeout': 5,
+            'application_name': 'indrive',
+        },
+    }
+    if environ.get('DB_POOL') == 'pgbouncer':
+        # Transaction pooling hands each transaction whichever server
+        # connection is free: server-side cursors (iterator()) can't span them
+        database['DISABLE_SERVER_SIDE_CURSORS'] = True
+        database['PORT'] = environ.get('POSTGRES_PORT', '6432')
+    return database
+
+
+def replica_databases(primary, environ=os.environ):
+    """Aliases for the primary's read replicas: the same settings on another host"""
+    if primary['ENGINE'] != 'django.db.backends.postgresql':
+        return {}
+    hosts = [host.strip() for host in environ.get('POSTGRES_REPLICA_HOSTS', '').split(',') if host.strip()]
+    return {
+        f"replica_{index}": dict(primary, HOST=host, TEST={'MIRROR': 'default'})
+        for index, host in enumerate(hosts, 1)
+    }
+
+
+def database_from_environment(base_dir, environ=os.environ):
+    profile = environ.get('DATABASE_PROFILE', 'sqlite')
+    if profile == 'postgres':
+        return postgres_database(environ)
+    if profile == 'sqlite':
+        return sqlite_database(environ.get('SQLITE_PATH', base_dir / 'db.sqlite3'),
+                               tuned=environ.get('SQLITE_TUNED', '1') != '0')
+    raise ValueError(f"Unknown DATABASE_PROFILE {profile!r}")
@@ -0,0 +1,185 @@
+"""
+``Idempotency-Key`` support for POST actions that clients retry.
+
+The first request with a given key runs the action; its response is kept in
+the cache for ``IDEMPOTENCY_TTL_SECONDS`` and replayed (with an
+``Idempotent-Replayed: true`` header) to every retry carrying the same key.
+A retry that arrives while the first request is still running waits for
+its response instead of running the action a second time, for up to
+``IDEMPOTENCY_WAIT_SECONDS`` (then 409). Reusing a key for a different
+request body or target is a 422. Async views get the same, with JSON
+responses.
+
+Keys are per user and per action. The pending marker and the responses are
+in the cache, so how far this reaches depends on it: with ``REDIS_URL`` set
+every worker process shares them and ``cache.add`` makes them exclude each
+other; with the default per-process cache only retries reaching the same
+process are coalesced or replayed, and one landing on another worker runs
+the action again. Client errors are stored like any other response,
+including DRF's ``APIException``s (``ValidationError``, ``PermissionDenied``...),
+which are rendered by the view's exception handler first. Server errors and
+other exceptions are not stored, the next retry runs the action again.
+"""
+import asyncio
+import functools
+import hashlib
+import json
+import threading
+import time
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.http import JsonResponse
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.response import Response
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+POLL_SECONDS = 0.05
+
+# Events of the requests running in this process, so waiters here wake up
+# as soon as the response is stored instead of at the next poll
+_running = {}
+_running_lock = threading.Lock()
+
+
+def _fingerprint(request, kwargs):
+    payload = json.dumps([kwargs, request.data], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _settled(record, fingerprint, deadline, respond):
+    """The answer to a retry that found ``record``, or ``None`` to keep waiting"""
+    if record['fingerprint'] != fingerprint:
+        return respond({"error": f"{HEADER} was already used for a different request"},
+                       status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+    if record['state'] == 'done':
+        headers = dict(record['headers'], **{'Idempotent-Replayed': 'true'})
+        return respond(record['data'], status=record['status'], headers=headers)
+    if time.monotonic() >= deadline:
+        return respond({"error": f"A request with this {HEADER} is still in progress"},
+                       status=status.HTTP_409_CONFLICT)
+    return None
+
+
+def _record(response, fingerprint, data):
+    return {
+        'state': 'done',
+        'fingerprint': fingerprint,
+        'status': response.status_code,
+        'data': data,
+        'headers': {name: response[name] for name in ('Location',) if response.has_header(name)},
+    }
+
+
+def _json_response(data, status, headers=None):
+    return JsonResponse(data, status=status, headers=headers, safe=False)
+
+
+def idempotent(scope):
+    """Decorate a DRF view method (``create``, an ``@action``), or an async view
+    function returning a ``JsonResponse``, to honour ``Idempotency-Key``"""
+    def decorator(view_method):
+        if iscoroutinefunction(view_method):
+            return _async_idempotent(scope, view_method)
+
+        @functools.wraps(view_method)
+        def wrapper(view, request, *args, **kwargs):
+            key = request.headers.get(HEADER)
+            if not key:
+                return view_method(view, request, *args, **kwargs)
+            if len(key) > MAX_KEY_LENGTH:
+                return Response({"error": f"{HEADER} is longer than {MAX_KEY_LENGTH} characters"},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+            cache_key = _cache_key(scope, request, key)
+            fingerprint = _fingerprint(request, kwargs)
+            deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT_SECONDS
+            while True:
+                if cache.add(cache_key, {'state': 'running', 'fingerprint': fingerprint},
+                             settings.IDEMPOTENCY_LOCK_SECONDS):
+                    return _run(view_method, view, request, args, kwargs, cache_key, fingerprint)
+                record = cache.get(cache_key)
+                if record is None:
+                    continue  # The first request failed (or its marker expired): take over
+                response = _settled(record, fingerprint, deadline, Response)
+                if response is not None:
+                    return response
+                remaining = max(deadline - time.monotonic(), 0)
+                event = _running.get(cache_key)
+                if event is not None:
+                    event.wait(remaining)
+                else:
+                    time.sleep(min(POLL_SECONDS, remaining))
+        return wrapper
+    return decorator
+
+
+def _cache_key(scope, request, key):
+    digest = hashlib.sha256(key.encode()).hexdigest()
+    return f"idem:{scope}:{request.user.pk}:{digest}"
+
+
+def _run(view_method, view, request, args, kwargs, cache_key, fingerprint):
+    event = threading.Event()
+    with _running_lock:
+        _running[cache_key] = event
+    stored = False
+    try:
+        try:
+            response = view_method(view, request, *args, **kwargs)
+        except APIException as exc:
+            # What dispatch() would answer, so the retry gets the same
+            response = view.handle_exception(exc)
+        if response.status_code < 500:
+            cache.set(cache_key, _record(response, fingerprint, response.data),
+                      settings.IDEMPOTENCY_TTL_SECONDS)
+            stored = True
+        return response
+    finally:
+        if not stored:
+            cache.delete(cache_key)
+        with _running_lock:
+            _running.pop(cache_key, None)
+        event.set()
+
+
+def _async_idempotent(scope, view_function):
+    # Waiters poll the cache: a threading.Event would block the event loop
+    @functools.wraps(view_function)
+    async def wrapper(request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key:
+            return await view_function(request, *args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return _json_response({"error": f"{HEADER} is longer than {MAX_KEY_LENGTH} characters"},
+                                  status=status.HTTP_400_BAD_REQUEST)
+
+        cache_key = _cache_key(scope, request, key)
+        fingerprint = _fingerprint(request, kwargs)
+        deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT_SECONDS
+        while True:
+            if await cache.aadd(cache_key, {'state': 'running', 'fingerprint': fingerprint},
+                                settings.IDEMPOTENCY_LOCK_SECONDS):
+                break
+            record = await cache.aget(cache_key)
+            if record is None:
+                continue
+            response = _settled(record, fingerprint, deadline, _json_response)
+            if response is not None:
+                return response
+            await asyncio.sleep(min(POLL_SECONDS, deadline - time.monotonic()))
+
+        stored = False
+        try:
+            response = await view_function(request, *args, **kwargs)
+            if response.status_code < 500:
+                await cache.aset(cache_key, _record(response, fingerprint, json.loads(response.content)),
+                                 settings.IDEMPOTENCY_TTL_SECONDS)
+                stored = True
+            return response
+        finally:
+            if not stored:
+                await cache.adelete(cache_key)
+    return wrapper
@@ -0,0 +1,376 @@
+"""
+Channel layer for several ASGI worker processes on one host, without Redis.
+
+A small broker process (``manage.py run_channel_broker``) listens on a
+Unix-domain socket and owns the group memberships. Every worker keeps one
+connection to it per event loop:
+
+* Process-specific channels (``specific.<client id>!...``, what consumers
+  use) are pushed by the broker to the connection that created them and
+  queued locally, where capacity and message expiry are enforced.
+* Group sends are fanned out by the broker with a single frame per worker
+  connection, however many of its channels are in the group.
+* Plain named channels are queued in the broker itself, with the same
+  capacity and expiry, and handed to the next ``receive()`` on any worker.
+
+Frames are a 4-byte big-endian length followed by a MessagePack array, so
+messages must be MessagePack-serializable (as with the Redis layer). A
+worker that reads its connection too slowly is not allowed to hold the
+broker's memory: once more than ``max_buffer`` bytes wait to be sent to it,
+deliveries to it are dropped (as the channel layers drop group messages to a
+full channel) until it catches up.
+Memberships live only in the broker: restarting it drops them, like a Redis
+flush.
+"""
+import asyncio
+import logging
+import os
+import random
+import string
+import struct
+import time
+import uuid
+from collections import defaultdict, deque
+
+import msgpack
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+HEADER = struct.Struct('>I')
+
+logger = logging.getLogger(__name__)
+
+
+async def read_frame(reader):
+    size = HEADER.unpack(await reader.readexactly(HEADER.size))[0]
+    return msgpack.unpackb(await reader.readexactly(size), strict_map_key=False)
+
+
+def write_frame(writer, frame):
+    data = msgpack.packb(frame)
+    writer.write(HEADER.pack(len(data)) + data)
+
+
+def channel_owner(channel):
+    """Client id of a process-specific channel, ``None`` for a plain named channel"""
+    if '!' not in channel:
+        return None
+    return channel[:channel.index('!')].rsplit('.', 1)[-1]
+
+
+class ChannelBroker:
+    """The broker side: group memberships, routing and the named channel queues"""
+
+    def __init__(self, path, capacity=100, expiry=60, group_expiry=86400, max_buffer=4 * 1024 * 1024):
+        self.path = path
+        self.capacity = capacity
+        self.expiry = expiry
+        self.group_expiry = group_expiry
+        self.max_buffer = max_buffer
+        self.clients = {}  # client id -> writer
+        self.lagging = set()  # Client ids whose deliveries are being dropped
+        self.groups = defaultdict(dict)  # group -> {channel: joined at}
+        self.queues = defaultdict(deque)  # named channel -> (expires at, message)
+        self.waiters = defaultdict(deque)  # named channel -> (writer, request id)
+
+    async def serve_forever(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # Stale socket of a previous broker
+        server = await asyncio.start_unix_server(self.handle, path=self.path)
+        os.chmod(self.path, 0o600)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        client_id = None
+        try:
+            while True:
+                frame = await read_frame(reader)
+                op = frame[0]
+                if op == 'hello':
+                    client_id = frame[1]
+                    self.clients[client_id] = writer
+                elif op == 'group_send':
+                    self.group_send(frame[1], frame[2])
+                elif op == 'send':
+                    self.send(frame[1], frame[2])
+                elif op == 'group_add':
+                    self.groups[frame[1]][frame[2]] = time.time()
+                elif op == 'group_discard':
+                    members = self.groups.get(frame[1])
+                    if members is not None:
+                        members.pop(frame[2], None)
+                        if not members:
+                            del self.groups[frame[1]]
+                elif op == 'send_checked':
+                    full = self.send(frame[2], frame[3])
+                    write_frame(writer, ['reply', frame[1], 'full' if full else None])
+                elif op == 'receive':
+                    self.receive(writer, frame[1], frame[2])
+                elif op == 'flush':
+                    self.groups.clear()
+                    self.queues.clear()
+                    write_frame(writer, ['reply', frame[1], None])
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if client_id is not None and self.clients.get(client_id) is writer:
+                del self.clients[client_id]
+                self.lagging.discard(client_id)
+                self.forget_client(client_id)
+            for waiting in self.waiters.values():
+                for entry in [entry for entry in waiting if entry[0] is writer]:
+                    waiting.remove(entry)
+            writer.close()
+
+    def forget_client(self, client_id):
+        for group, members in list(self.groups.items()):
+            for channel in [c for c in members if channel_owner(c) == client_id]:
+                del members[channel]
+            if not members:
+                del self.groups[group]
+
+    def deliver(self, owner, channels, message):
+        """Push a message to a worker, unless too much is already waiting to be sent to it"""
+        writer = self.clients.get(owner)
+        if writer is None:
+            return
+        if writer.transport.get_write_buffer_size() > self.max_buffer:
+            if owner not in self.lagging:
+                self.lagging.add(owner)
+                logger.warning("Channel broker: worker %s is not keeping up, dropping its messages", owner)
+            return
+        self.lagging.discard(owner)
+        write_frame(writer, ['deliver', channels, message])
+
+    def send(self, channel, message):
+        """Route one message; returns True if a named channel queue was full"""
+        owner = channel_owner(channel)
+        if owner is not None:
+            self.deliver(owner, [channel], message)
+            return False
+        waiting = self.waiters.get(channel)
+        if waiting:
+            writer, request_id = waiting.popleft()
+            write_frame(writer, ['reply', request_id, message])
+            return False
+        queue = self.queues[channel]
+        self.expire(queue)
+        if len(queue) >= self.capacity:
+            return True
+        queue.append((time.time() + self.expiry, message))
+        return False
+
+    def group_send(self, group, message):
+        members = self.groups.get(group)
+        if not members:
+            return
+        stale = time.time() - self.group_expiry
+        by_owner = defaultdict(list)
+        for channel, joined in list(members.items()):
+            if joined < stale:
+                del members[channel]
+                continue
+            owner = channel_owner(channel)
+            if owner is None:
+                self.send(channel, message)
+            else:
+                by_owner[owner].append(channel)
+        # One frame per worker connection, however many of its sockets are in the group
+        for owner, channels in by_owner.items():
+            self.deliver(owner, channels, message)
+
+    def receive(self, writer, request_id, channel):
+        queue = self.queues.get(channel)
+        if queue:
+            self.expire(queue)
+        if queue:
+            write_frame(writer, ['reply', request_id, queue.popleft()[1]])
+        else:
+            self.waiters[channel].append((writer, request_id))
+
+    def expire(self, queue):
+        now = time.time()
+        while queue and queue[0][0] < now:
+            queue.popleft()
+
+
+class BrokerConnection:
+    """One worker event loop's connection to the broker"""
+
+    def __init__(self, layer, client_id):
+        self.layer = layer
+        self.client_id = client_id
+        self.writer = None
+        self.reader_task = None
+        self.replies = {}
+        self.request_ids = 0
+        self.lock = asyncio.Lock()
+
+    async def ensure_open(self):
+        if self.writer is not None and not self.writer.is_closing():
+            return
+        async with self.lock:
+            if self.writer is not None and not self.writer.is_closing():
+                return
+            reader, self.writer = await asyncio.open_unix_connection(self.layer.path)
+            write_frame(self.writer, ['hello', self.client_id])
+            self.reader_task = asyncio.ensure_future(self.read(reader))
+
+    async def read(self, reader):
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if frame[0] == 'deliver':
+                    for channel in frame[1]:
+                        self.layer.deliver(channel, frame[2])
+                else:  # reply
+                    future = self.replies.pop(frame[1], None)
+                    if future is not None and not future.done():
+                        future.set_result(frame[2])
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.writer.close()
+            for future in self.replies.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('Channel broker connection lost'))
+            self.replies.clear()
+
+    async def post(self, *frame):
+        await self.ensure_open()
+        write_frame(self.writer, list(frame))
+        await self.writer.drain()
+
+    async def request(self, op, *args):
+        await self.ensure_open()
+        self.request_ids += 1
+        future = asyncio.get_running_loop().create_future()
+        self.replies[self.request_ids] = future
+        write_frame(self.writer, [op, self.request_ids, *args])
+        await self.writer.drain()
+        return await future
+
+    def close(self):
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+
+class UnixSocketChannelLayer(BaseChannelLayer):
+    """
+    Channel layer shared by the worker processes of one host through the
+    broker listening on ``path``.
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, path='/tmp/indrive-channels.sock', expiry=60, group_expiry=86400,
+                 capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.path = path
+        self.group_expiry = group_expiry
+        self.connections = {}  # event loop -> BrokerConnection
+        self.channels = {}  # process-specific channel -> asyncio.Queue of (expires at, message)
+        self.cleaned_at = 0
+
+    def connection(self):
+        loop = asyncio.get_running_loop()
+        connection = self.connections.get(loop)
+        if connection is None:
+            # Sync views run async_to_sync on throwaway loops under WSGI; drop their connections
+            for old_loop in [l for l in self.connections if l.is_closed()]:
+                self.connections.pop(old_loop).close()
+            connection = self.connections[loop] = BrokerConnection(self, uuid.uuid4().hex[:12])
+        return connection
+
+    def deliver(self, channel, message):
+        queue = self.channels.get(channel)
+        if queue is None:
+            queue = self.channels[channel] = asyncio.Queue()
+        if queue.qsize() < self.get_capacity(channel):
+            queue.put_nowait((time.time() + self.expiry, message))
+        # Over capacity: dropped, as the in-memory layer does for group sends
+
+    def clean_expired(self):
+        """Drop expired messages and the queues of channels nobody reads any more (at most once a second)"""
+        now = time.time()
+        if now - self.cleaned_at < 1:
+            return
+        self.cleaned_at = now
+        for channel, queue in list(self.channels.items()):
+            while not queue.empty() and queue._queue[0][0] < now:
+                queue.get_nowait()
+            if queue.empty() and not queue._getters:
+                del self.channels[channel]
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        assert '__asgi_channel__' not in message
+        owner = channel_owner(channel)
+        if owner is not None and any(c.client_id == owner for c in self.connections.values()):
+            # Our own channel: no broker round trip, and a full queue can be reported
+            queue = self.channels.get(channel)
+            if queue is not None and queue.qsize() >= self.get_capacity(channel):
+                raise ChannelFull(channel)
+            self.deliver(channel, message)
+        elif owner is not None:
+            await self.connection().post('send', channel, message)
+        elif await self.connection().request('send_checked', channel, message) == 'full':
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        if channel_owner(channel) is None:
+            return await self.connection().request('receive', channel)
+        await self.connection().ensure_open()
+        self.clean_expired()
+        queue = self.channels.get(channel)
+        if queue is None:
+            queue = self.channels[channel] = asyncio.Queue()
+        try:
+            while True:
+                expires_at, message = await queue.get()
+                if expires_at >= time.time():
+                    return message
+        finally:
+            if queue.empty() and self.channels.get(channel) is queue:
+                del self.channels[channel]
+
+    async def new_channel(self, prefix='specific.'):
+        connection = self.connection()
+        await connection.ensure_open()
+        return '%s%s!%s' % (prefix, connection.client_id,
+                            ''.join(random.choice(string.ascii_letters) for _ in range(12)))
+
+    async def flush(self):
+        self.channels = {}
+        await self.connection().request('flush')
+
+    async def close(self):
+        for connection in self.connections.values():
+            connection.close()
+        self.connections = {}
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        await self.connection().post('group_add', group, channel)
+
+    async def group_discard(self, group, channel):
+        assert self.valid_channel_name(channel), 'Invalid channel name'
+        assert self.valid_group_name(group), 'Invalid group name'
+        await self.connection().post('group_discard', group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        assert self.valid_group_name(group), 'Invalid group name'
+        await self.connection().post('group_send', group, message)
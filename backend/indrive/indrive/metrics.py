@@ -0,0 +1,355 @@
+"""
+Request and WebSocket message metrics, exposed in the Prometheus text
+format on ``/metrics``.
+
+Every HTTP request (``MetricsMiddleware``) and every message a consumer
+handles (``MetricsConsumerMixin``) is timed and charged with the database
+queries and geo provider calls made on its behalf. The charges go to a
+``Usage`` held in a context variable, so they follow the work into
+``database_sync_to_async`` threads; database time is measured by a cursor
+wrapper installed on every new connection, geo time by the provider
+returned from ``rides.geo.get_geo_provider()``.
+
+Recording takes no lock: every metric keeps one shard of values per thread,
+written only by that thread, and ``/metrics`` sums the shards. The shards
+of threads that have exited are folded into one, so pools replacing their
+threads don't grow the list. Histograms have fixed buckets, so an
+observation is a ``bisect`` and two additions.
+
+``/metrics`` answers requests carrying ``Authorization: Bearer
+<METRICS_TOKEN>`` and staff sessions (the admin's login).
+"""
+import secrets
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from channels.exceptions import StopConsumer
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse, HttpResponseForbidden
+from .tracing import set_trace_name
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._local = threading.local()
+        self._shards = []  # (thread, shard)
+        self._retired = {}  # The shards of exited threads, merged
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            # Once per thread: the only time a writer takes the lock
+            shard = self._local.shard = {}
+            with self._lock:
+                self._retire()
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _retire(self):
+        # With the lock held. An exited thread no longer writes its shard
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                self._merge(self._retired, shard)
+        self._shards = live
+
+    def collect(self):
+        totals = {}
+        with self._lock:
+            self._retire()
+            self._merge(totals, self._retired)
+            shards = [shard for _, shard in self._shards]
+        for shard in shards:
+            self._merge(totals, shard)
+        return totals
+
+    def _label_text(self, values, extra=()):
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+                   for _, value in pairs)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, total in sorted(self.collect().items()):
+            lines.extend(self.render_sample(values, total))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, values, amount=1):
+        shard = self._shard()
+        shard[values] = shard.get(values, 0) + amount
+
+    def _merge(self, totals, shard):
+        for values, amount in list(shard.items()):
+            totals[values] = totals.get(values, 0) + amount
+
+    def render_sample(self, values, total):
+        return [f"{self.name}{self._label_text(values)} {total}"]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, values, value):
+        shard = self._shard()
+        counts = shard.get(values)
+        if counts is None:
+            # One count per bucket plus +Inf, then sum and count
+            counts = shard[values] = [0] * (len(self.buckets) + 1) + [0, 0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def _merge(self, totals, shard):
+        for values, counts in list(shard.items()):
+            total = totals.setdefault(values, [0] * len(counts))
+            for index, count in enumerate(list(counts)):
+                total[index] += count
+
+    def render_sample(self, values, total):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), total):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{self._label_text(values, [('le', bound)])} {cumulative}")
+        lines.append(f"{self.name}_sum{self._label_text(values)} {total[-2]}")
+        lines.append(f"{self.name}_count{self._label_text(values)} {total[-1]}")
+        return lines
+
+
+class Gauge(Metric):
+    """A current value, set from any thread (a plain store, no shards)"""
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels):
+        super().__init__(name, help, labels)
+        self._values = {}
+
+    def set(self, values, value):
+        self._values[values] = value
+
+    def collect(self):
+        return dict(self._values)
+
+    def render_sample(self, values, total):
+        return [f"{self.name}{self._label_text(values)} {total}"]
+
+
+HANDLER_LABELS = ('transport', 'handler')
+
+handler_seconds = Histogram(
+    'indrive_handler_seconds', 'Time to handle an HTTP request or WebSocket message',
+    HANDLER_LABELS + ('outcome',))
+handler_queries = Histogram(
+    'indrive_handler_db_queries', 'Database queries per HTTP request or WebSocket message',
+    HANDLER_LABELS, buckets=QUERY_BUCKETS)
+handler_db_seconds = Counter(
+    'indrive_handler_db_seconds_total', 'Time spent in database queries', HANDLER_LABELS)
+handler_geo_calls = Counter(
+    'indrive_handler_geo_calls_total', 'Geo provider calls (geocoding, directions)', HANDLER_LABELS)
+handler_geo_seconds = Counter(
+    'indrive_handler_geo_seconds_total', 'Time spent in geo provider calls', HANDLER_LABELS)
+
+
+# Geo provider resilience, see rides.geo.ResilientGeoProvider
+geo_coalesced = Counter(
+    'indrive_geo_coalesced_total', 'Geo lookups answered by an identical call already in flight',
+    ('operation',))
+geo_fallbacks = Counter(
+    'indrive_geo_fallbacks_total', 'Geo lookups answered by the local estimate instead of the provider',
+    ('operation', 'reason'))
+geo_breaker_transitions = Counter(
+    'indrive_geo_breaker_transitions_total', 'Geo provider circuit breaker state changes',
+    ('operation', 'state'))
+geo_breaker_state = Gauge(
+    'indrive_geo_breaker_state', 'Geo provider circuit breaker state: 0 closed, 1 half-open, 2 open',
+    ('operation',))
+# Ride requests outside the service area, see rides.geofence
+geofence_rejections = Counter(
+    'indrive_geofence_rejections_total', 'Ride requests and fare estimates with a pickup or destination out of area',
+    ('end',))
+
+REGISTRY = [handler_seconds, handler_queries, handler_db_seconds, handler_geo_calls, handler_geo_seconds,
+            geo_coalesced, geo_fallbacks, geo_breaker_transitions, geo_breaker_state, geofence_rejections]
+
+
+class Usage:
+    """What one request or message cost, besides its own time"""
+    __slots__ = ('handler', 'queries', 'db_seconds', 'geo_calls', 'geo_seconds')
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.geo_calls = 0
+        self.geo_seconds = 0.0
+
+
+_usage = ContextVar('metrics_usage', default=None)
+
+
+@contextmanager
+def measure(transport, handler, expected=()):
+    """Time the block and record it with the database and geo work done inside it;
+    exceptions other than ``expected`` ones count as errors"""
+    usage = Usage(handler)
+    token = _usage.set(usage)
+    outcome = {'value': 'ok'}
+    began = time.perf_counter()
+    try:
+        yield outcome
+    except expected:
+        raise
+    except BaseException:
+        outcome['value'] = 'error'
+        raise
+    finally:
+        elapsed = time.perf_counter() - began
+        _usage.reset(token)
+        labels = (transport, usage.handler)
+        handler_seconds.observe(labels + (outcome['value'],), elapsed)
+        handler_queries.observe(labels, usage.queries)
+        if usage.queries:
+            handler_db_seconds.inc(labels, usage.db_seconds)
+        if usage.geo_calls:
+            handler_geo_calls.inc(labels, usage.geo_calls)
+            handler_geo_seconds.inc(labels, usage.geo_seconds)
+
+
+def set_handler(handler):
+    """Name what is being measured once it is known, e.g. a WebSocket message's type"""
+    usage = _usage.get()
+    if usage is not None:
+        usage.handler = handler
+
+
+@contextmanager
+def geo_call():
+    began = time.perf_counter()
+    try:
+        yield
+    finally:
+        usage = _usage.get()
+        if usage is not None:
+            usage.geo_calls += 1
+            usage.geo_seconds += time.perf_counter() - began
+
+
+def _count_query(execute, sql, params, many, context):
+    usage = _usage.get()
+    if usage is None:
+        return execute(sql, params, many, context)
+    began = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        usage.queries += 1
+        usage.db_seconds += time.perf_counter() - began
+
+
+def install_query_counter(sender, connection, **kwargs):
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, _count_query)
+
+
+connection_created.connect(install_query_counter, dispatch_uid='indrive.metrics')
+# Connections this thread opened before this module was imported
+for _connection in connections.all(initialized_only=True):
+    install_query_counter(None, _connection)
+
+
+class MetricsMiddleware:
+    """Records every request under its URL name (``ride-list``, ``ride-driver-bid``...)"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with measure('http', 'unmatched') as outcome:
+            response = self.get_response(request)
+            self.label(request, response, outcome)
+        return response
+
+    async def __acall__(self, request):
+        with measure('http', 'unmatched') as outcome:
+            response = await self.get_response(request)
+            self.label(request, response, outcome)
+        return response
+
+    def label(self, request, response, outcome):
+        match = getattr(request, 'resolver_match', None)
+        if match is not None:
+            set_handler(f"{request.method} {match.view_name}")
+        outcome['value'] = str(response.status_code)
+
+
+class MetricsConsumerMixin:
+    """Records every message a consumer handles: channel layer events under their
+    type, client frames under the type passed to ``measure_as``"""
+    # Client frame types recorded by name; anything else a client sends is `other`
+    client_message_types = ()
+
+    async def dispatch(self, message):
+        # StopConsumer is how a consumer finishes on disconnect
+        with measure('ws', f"{type(self).__name__} {message['type']}", expected=(StopConsumer,)):
+            await super().dispatch(message)
+
+    def measure_as(self, message_type):
+        if message_type not in self.client_message_types:
+            message_type = 'other'
+        set_handler(f"{type(self).__name__} {message_type}")
+        set_trace_name(f"{type(self).__name__} {message_type}")
+
+
+def metrics_allowed(request):
+    # Behind a reverse proxy every request comes from a local address: no IP allowlist
+    token = settings.METRICS_TOKEN
+    if token and secrets.compare_digest(request.headers.get('Authorization', '').encode(),
+                                        f"Bearer {token}".encode()):
+        return True
+    user = getattr(request, 'user', None)
+    return user is not None and user.is_staff
+
+
+def metrics_view(request):
+    if not metrics_allowed(request):
+        return HttpResponseForbidden()
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return HttpResponse('\n'.join(lines) + '\n', content_type=CONTENT_TYPE)
@@ -0,0 +1,124 @@
+"""
+Read-replica routing.
+
+Writes always go to ``default``. Reads go to ``default`` as well, except
+inside a safe (GET/HEAD/OPTIONS) HTTP request, where
+``ReplicaRoutingMiddleware`` lets ``ReplicaRouter`` spread them over the
+aliases in ``DATABASE_REPLICAS``. Everything else keeps reading the
+primary without having to opt out: POST/PATCH actions and state
+transitions, WebSocket consumers, background tasks, management commands.
+
+Read-your-writes: after a user's unsafe request, their safe requests stay
+on the primary for ``REPLICA_STICKY_SECONDS``, longer than replication
+normally lags, so they see what they just wrote. The flag is kept in the
+cache, which must be shared by every worker (settings refuse replicas
+without ``REDIS_URL``): the next request may well land on another one.
+"""
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.functional import SimpleLazyObject, empty
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_replica_reads = ContextVar('replica_reads', default=False)
+
+
+@contextmanager
+def replica_reads(allowed=True):
+    """Allow (or, with ``allowed=False``, forbid) replica reads in the block"""
+    token = _replica_reads.set(allowed)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def sticky_key(user_id):
+    return f"db:sticky:{user_id}"
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        replicas = settings.DATABASE_REPLICAS
+        if replicas and _replica_reads.get():
+            return random.choice(replicas)
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True  # Replicas hold the same data as the primary
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
+
+
+class ReplicaRoutingMiddleware:
+    """Decides per request whether its reads may use a replica"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        allowed, key = self.sticky_check(request)
+        with replica_reads(allowed and (key is None or cache.get(key) is None)):
+            response = self.get_response(request)
+        user_id = self.writer_id(request)
+        if user_id is not None:
+            cache.set(sticky_key(user_id), 1, settings.REPLICA_STICKY_SECONDS)
+        return response
+
+    async def __acall__(self, request):
+        # The shared cache is a network round trip: kept off the event loop
+        allowed, key = self.sticky_check(request)
+        with replica_reads(allowed and (key is None or await cache.aget(key) is None)):
+            response = await self.get_response(request)
+        user_id = self.writer_id(request)
+        if user_id is not None:
+            await cache.aset(sticky_key(user_id), 1, settings.REPLICA_STICKY_SECONDS)
+        return response
+
+    def sticky_check(self, request):
+        """Whether the request may read a replica at all, and the sticky key that would keep it off"""
+        if request.method not in SAFE_METHODS or not settings.DATABASE_REPLICAS:
+            return False, None
+        user_id = self.token_user_id(request)
+        return True, None if user_id is None else sticky_key(user_id)
+
+    def writer_id(self, request):
+        """The user to keep on the primary after this request, if any"""
+        # The API authenticates inside the view, which sets the user on the request.
+        # An untouched session user stays unloaded (a sync query, even under ASGI)
+        user = getattr(request, 'user', None)
+        if isinstance(user, SimpleLazyObject) and user._wrapped is empty:
+            return None
+        if (request.method not in SAFE_METHODS and user is not None and user.is_authenticated
+                and settings.DATABASE_REPLICAS):
+            return user.pk
+        return None
+
+    def token_user_id(self, request):
+        # Only picks the database: the view still authenticates the token properly
+        authentication = JWTAuthentication()
+        header = authentication.get_header(request)
+        raw_token = header and authentication.get_raw_token(header)
+        if not raw_token:
+            return None
+        try:
+            return AccessToken(raw_token, verify=False)[jwt_settings.USER_ID_CLAIM]
+        except Exception:
+            return None
@@ -10,7 +10,11 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
+from django.core.exceptions import ImproperlyConfigured
+from dotenv import load_dotenv
+from indrive.databases import database_from_environment, replica_databases
 
 # Ride matching algorithm configuration
 RIDE_MATCHING_WEIGHTS = {
@@ -21,10 +25,39 @@ RIDE_MATCHING_WEIGHTS = {
 }
 MAX_DRIVERS_TO_NOTIFY = 5  # Max drivers to notify per ride
 DRIVER_SEARCH_RADIUS_KM = 20  # Consider drivers within this radius
+DRIVER_STATS_EWMA_ALPHA = 0.2  # Weight of the newest sample in average_fare/avg_response_time (rides.stats)
+
+# Ride event streams: every ride_update/bid_update carries a per-ride sequence
+# number and is logged (rides.streams) for resuming clients
+RIDE_EVENT_REPLAY_LIMIT = 100  # Events kept per ride; clients that missed older ones refetch the ride
+
+# Driver presence (rides.presence): drivers silent on the ride WebSocket for
+# longer than the grace period go offline and stop being matched
+PRESENCE_GRACE_SECONDS = 45  # Clients send a `ping` at least every 15 seconds
+PRESENCE_FLUSH_SECONDS = 5  # Batched write-back of is_online/last_seen_at
+
+# Chat messages are saved in batches by chat.batcher and broadcast once saved
+CHAT_BATCH_SIZE = 100  # Messages per bulk INSERT
+CHAT_BATCH_DELAY_MS = 20  # Longest a message waits for its batch
+CHAT_MAX_PENDING = 10000  # Unsaved messages held while the database fails; more are refused
+CHAT_SAVE_TIMEOUT_SECONDS = 5  # Longest a sender waits for its message to be saved
+CHAT_ARCHIVE_AFTER_DAYS = 30  # `manage.py archive_chats` compacts chats of rides that ended earlier
+CHAT_ARCHIVE_DELETE_BATCH = 500  # Hot rows deleted per statement
+RIDE_ARCHIVE_AFTER_DAYS = 90  # `manage.py archive_rides` moves rides that ended earlier to the archive
+RIDE_ARCHIVE_BATCH = 500  # Rides moved per transaction
+
+# Idempotency-Key on ride requests and bids (indrive.idempotency); across worker
+# processes only with the shared cache of REDIS_URL, else per process
+IDEMPOTENCY_TTL_SECONDS = 24 * 60 * 60  # How long a response is replayed to retries
+IDEMPOTENCY_LOCK_SECONDS = 30  # Longest a request holds its key while running
+IDEMPOTENCY_WAIT_SECONDS = 10  # Longest a concurrent retry waits for it
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# Local overrides of the environment (DATABASE_PROFILE, POSTGRES_*...) from backend/indrive/.env
+load_dotenv(BASE_DIR / '.env')
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.2/howto/deployment/checklist/
@@ -35,6 +68,16 @@ SECRET_KEY = 'django-insecure-7(gd@7tkrjj0%eu40+7(wwm=tjd%=+ac58ajthwlp*j$37bxr)
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
 
+# Sampled hot-path traces (indrive.tracing), listed at /debug/traces/
+TRACE_SAMPLE_RATE = 0.01
+TRACE_BUFFER_SIZE = 500
+# Honour the X-Profile request header, from staff or with X-Profile-Token: <METRICS_TOKEN>
+TRACE_PROFILING = os.environ.get('TRACE_PROFILING') == '1'
+
+# Prometheus scrapes /metrics with `Authorization: Bearer <METRICS_TOKEN>`;
+# otherwise it is only shown to staff logged in to the admin
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
 ALLOWED_HOSTS = ['*']  # Temporary wildcard for testing
 
 
@@ -51,6 +94,7 @@ INSTALLED_APPS = [
     'rest_framework_simplejwt',
     'users', # Our new users app
     'rides', # Our new rides app
+    'chat',
     'channels', # Add channels
 ]
 
@@ -59,7 +103,10 @@ AUTH_USER_MODEL = 'users.User' # Specify our custom user model
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework_simplejwt.authentication.JWTAuthentication',
-    )
+    ),
+    # Reverse proxies in front of the app; throttles trust only the X-Forwarded-For
+    # entry the last of them added (with none, the client can write it: use REMOTE_ADDR)
+    'NUM_PROXIES': int(os.environ.get('NUM_PROXIES', 0)),
 }
 
 ASGI_APPLICATION = 'indrive.asgi.application' # Configure ASGI application
@@ -69,6 +116,16 @@ CHANNEL_LAYERS = {
         'BACKEND': 'channels.layers.InMemoryChannelLayer', # For development, use in-memory
     },
 }
+if os.environ.get('CHANNEL_LAYER') == 'unix':
+    # Several ASGI workers on one host, sharing `manage.py run_channel_broker`
+    CHANNEL_LAYERS['default'] = {
+        'BACKEND': 'indrive.layers.UnixSocketChannelLayer',
+        'CONFIG': {
+            'path': os.environ.get('CHANNEL_BROKER_SOCKET', '/tmp/indrive-channels.sock'),
+            'capacity': 100,  # Messages queued per channel
+            'expiry': 60,  # Seconds before an undelivered message is dropped
+        },
+    }
 
 from datetime import timedelta
 
@@ -105,11 +162,14 @@ SIMPLE_JWT = {
 }
 
 MIDDLEWARE = [
+    'indrive.metrics.MetricsMiddleware',  # Outermost, so it times the whole request
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'indrive.tracing.TracingMiddleware',  # After authentication: profiling is for staff
+    'indrive.routers.ReplicaRoutingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -137,19 +197,51 @@ WSGI_APPLICATION = 'indrive.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# Profile chosen with DATABASE_PROFILE=sqlite|postgres, see indrive/databases.py
 DATABASES = {
+    'default': database_from_environment(BASE_DIR)
+}
+DATABASES.update(replica_databases(DATABASES['default']))
+
+# Safe reads of HTTP requests go to a replica, everything else to the
+# primary; a user who just wrote reads the primary for a few seconds after
+DATABASE_ROUTERS = ['indrive.routers.ReplicaRouter']
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias.startswith('replica')]
+REPLICA_STICKY_SECONDS = 5
+
+# One-time login codes (users.otp) and their token-bucket throttles
+# (users.throttles): (burst capacity, seconds to earn one more request)
+OTP_TTL_SECONDS = 300
+OTP_THROTTLE_RATES = {
+    'send_phone': (3, 60),
+    'send_ip': (20, 6),
+    'verify_phone': (5, 60),
+    'verify_ip': (60, 1),
+}
+
+# REDIS_URL (redis://host:6379/0) shares the cache between worker processes;
+# without it each process has its own
+if os.environ.get('REDIS_URL'):
+    CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['REDIS_URL'],
+    }
+    }
+else:
+    CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'unique-snowflake',
+        # The default of 300 entries lets a burst of sign-ups evict each other's codes
+        'OPTIONS': {'MAX_ENTRIES': 50000},
+    }
     }
-}
 
-CACHES = {
-'default': {
-    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-    'LOCATION': 'unique-snowflake',
-}
-}
+# Replica stickiness is a cache entry, set by the worker that served the write and
+# read by whichever serves the next request
+if DATABASE_REPLICAS and not os.environ.get('REDIS_URL'):
+    raise ImproperlyConfigured("Read replicas need a cache shared by every worker: set REDIS_URL")
 
 
 # Password validation
@@ -195,3 +287,44 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Google Maps API Key for Backend Geocoding
 GOOGLE_MAPS_API_KEY = 'YOUR_BACKEND_GOOGLE_MAPS_API_KEY_HERE'
+
+# Geo provider for geocoding and directions. rides.geo.FakeGeoProvider answers
+# offline from straight-line geometry (load tests, local development).
+GEO_PROVIDER = os.environ.get('GEO_PROVIDER', 'rides.geo.GoogleMapsProvider')
+FAKE_GEO_LATENCY_MS = 0  # Simulated round trip of the fake provider
+# Hour-of-day speed profiles of rides.estimates (manage.py estimate_rides)
+SPEED_PROFILE_MIN_SAMPLES = 20  # Trips an hour needs before its own speed is used
+SPEED_PROFILE_REFRESH_SECONDS = 300  # How long a process keeps the profiles it loaded
+# Supply/demand heatmap and fare suggestions (rides.heatmap, /api/rides/fare-estimate/)
+HEATMAP_CELL_DEGREES = 0.01  # About 1.1 km
+HEATMAP_DEMAND_WINDOW_SECONDS = 900  # Open rides older than this no longer count
+HEATMAP_SUPPLY_WINDOW_SECONDS = 120  # Drivers silent for longer no longer count
+HEATMAP_REFRESH_SECONDS = 5  # How long computed surge multipliers are reused
+HEATMAP_PRIOR = 2  # Rides and drivers added to every area, so sparse ones don't surge
+SURGE_SENSITIVITY = 0.25  # Multiplier increase per unit of demand/supply ratio above 1
+SURGE_MAX = 2.0
+FARE_BASE = 50
+FARE_PER_KM = 30
+FARE_PER_MINUTE = 2
+FARE_RANGE_SPREAD = 0.1  # Suggested range: the fare +/- 10%
+# Shared-ride pooling candidates (rides.pooling)
+POOL_CELL_DEGREES = 0.005  # Route cells, about 550 m
+POOL_PICKUP_KM = 1.0
+POOL_DESTINATION_KM = 1.5
+POOL_MIN_OVERLAP = 0.6  # Share of the shorter route's cells on the other route
+POOL_WINDOW_SECONDS = 600  # Requested at most this far apart
+POOL_MAX_SUGGESTIONS = 3  # Sent with each ride offer
+# Service areas and zones (rides.geofence): a GeoJSON FeatureCollection, unset to
+# serve everywhere; service_areas.example.geojson is a sample for Kathmandu
+GEOFENCE_FILE = os.environ.get('GEOFENCE_FILE', '')
+GEOFENCE_CELL_DEGREES = 0.01  # Index cells, about 1.1 km
+GEO_TIMEOUT_SECONDS = 5  # Per Google Maps request, retries included
+# Circuit breaker per geo operation (rides.geo.CircuitBreaker): opens when
+# GEO_BREAKER_FAILURE_RATE of the last GEO_BREAKER_WINDOW calls (at least
+# GEO_BREAKER_MIN_CALLS) failed or took over GEO_SLOW_CALL_SECONDS, then
+# answers locally for GEO_BREAKER_OPEN_SECONDS before probing the provider
+GEO_SLOW_CALL_SECONDS = 2.0
+GEO_BREAKER_WINDOW = 20
+GEO_BREAKER_MIN_CALLS = 10
+GEO_BREAKER_FAILURE_RATE = 0.5
+GEO_BREAKER_OPEN_SECONDS = 30
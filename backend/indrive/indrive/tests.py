@@ -0,0 +1,473 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from contextlib import asynccontextmanager
+from pathlib import Path
+from decimal import Decimal
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.db.utils import ConnectionHandler
+from django.http import JsonResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from channels.exceptions import ChannelFull
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework.views import APIView
+from rest_framework_simplejwt.tokens import AccessToken
+from users.models import User
+from .codecs import (JSON_CODEC, JSON_SUBPROTOCOL, MSGPACK_CODEC, MSGPACK_SUBPROTOCOL, decode_frame,
+                     encode_frame, msgpack, negotiate_codec)
+from .databases import database_from_environment, replica_databases, sqlite_database
+from .idempotency import HEADER, MAX_KEY_LENGTH, idempotent
+from .layers import ChannelBroker, UnixSocketChannelLayer
+from .metrics import Counter, Histogram, handler_queries, handler_seconds, measure
+from .routers import ReplicaRouter, ReplicaRoutingMiddleware, replica_reads
+from .tracing import span, start_trace, traced, traced_block, traces
+
+
+class CountingView(APIView):
+    authentication_classes = []
+    permission_classes = []
+    calls = 0
+    status_code = 201
+    raises = None
+
+    @idempotent('test')
+    def post(self, request):
+        type(self).calls += 1
+        if self.raises is not None:
+            raise self.raises
+        return Response({'call': self.calls, 'data': request.data}, status=self.status_code,
+                        headers={'Location': f'/things/{self.calls}/'})
+
+
+class IdempotencyTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        CountingView.calls = 0
+        CountingView.status_code = 201
+        CountingView.raises = None
+        self.factory = APIRequestFactory()
+        self.view = CountingView.as_view()
+
+    def post(self, data, key='key-1'):
+        headers = {} if key is None else {'HTTP_IDEMPOTENCY_KEY': key}
+        return self.view(self.factory.post('/things/', data, format='json', **headers))
+
+    def test_retry_replays_the_first_response(self):
+        first = self.post({'amount': 10})
+        retry = self.post({'amount': 10})
+        self.assertEqual(CountingView.calls, 1)
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry['Location'], '/things/1/')
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertFalse(first.has_header('Idempotent-Replayed'))
+
+    def test_other_keys_and_no_key_run_the_action(self):
+        self.post({'amount': 10})
+        self.post({'amount': 10}, key='key-2')
+        self.post({'amount': 10}, key=None)
+        self.post({'amount': 10}, key=None)
+        self.assertEqual(CountingView.calls, 4)
+
+    def test_key_reused_for_another_request_is_rejected(self):
+        self.post({'amount': 10})
+        response = self.post({'amount': 20})
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(CountingView.calls, 1)
+
+    def test_server_errors_are_not_stored(self):
+        CountingView.status_code = 503
+        self.post({'amount': 10})
+        CountingView.status_code = 201
+        response = self.post({'amount': 10})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(CountingView.calls, 2)
+
+    def test_client_errors_are_replayed(self):
+        CountingView.status_code = 400
+        self.post({'amount': 10})
+        response = self.post({'amount': 10})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(CountingView.calls, 1)
+
+    def test_raised_client_errors_are_replayed(self):
+        CountingView.raises = ValidationError({'amount': ['Too low.']})
+        first = self.post({'amount': 10})
+        retry = self.post({'amount': 10})
+        self.assertEqual(CountingView.calls, 1)
+        self.assertEqual(retry.status_code, 400)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+
+    def test_unhandled_exceptions_release_the_key(self):
+        CountingView.raises = RuntimeError('boom')
+        with self.assertRaises(RuntimeError):
+            self.post({'amount': 10})
+        CountingView.raises = None
+        self.assertEqual(self.post({'amount': 10}).status_code, 201)
+        self.assertEqual(CountingView.calls, 2)
+
+    def test_overlong_key_is_rejected(self):
+        response = self.post({'amount': 10}, key='k' * (MAX_KEY_LENGTH + 1))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(CountingView.calls, 0)
+
+    def test_async_view_replays(self):
+        calls = []
+
+        @idempotent('test-async')
+        async def view(request):
+            calls.append(request.data)
+            return JsonResponse({'call': len(calls)}, status=201)
+
+        def request(data):
+            request = RequestFactory().post('/things/', headers={HEADER: 'key-1'})
+            request.user = AnonymousUser()
+            request.data = data
+            return asyncio.run(view(request))
+
+        first = request({'amount': 10})
+        retry = request({'amount': 10})
+        other = request({'amount': 20})
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(json.loads(retry.content), json.loads(first.content))
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(other.status_code, 422)
+
+
+class CodecTests(SimpleTestCase):
+    payload = {'type': 'ride_update', 'ride_id': '7', 'seq': 3,
+               'message': {'id': 7, 'proposed_fare': Decimal('250.00'), 'custom': [{'amount': '1'}]}}
+
+    def test_negotiation_prefers_msgpack_and_falls_back_to_json(self):
+        self.assertEqual(negotiate_codec([JSON_SUBPROTOCOL, MSGPACK_SUBPROTOCOL])[1],
+                         MSGPACK_SUBPROTOCOL if msgpack else JSON_SUBPROTOCOL)
+        self.assertEqual(negotiate_codec([JSON_SUBPROTOCOL]), (JSON_CODEC, JSON_SUBPROTOCOL))
+        self.assertEqual(negotiate_codec([]), (JSON_CODEC, None))
+
+    def test_json_frames_keep_full_names(self):
+        frame = JSON_CODEC.encode(self.payload)
+        self.assertEqual(decode_frame(text_data=frame)['message']['proposed_fare'], '250.00')
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_msgpack_frames_are_compact_and_round_trip(self):
+        frame = MSGPACK_CODEC.encode(self.payload)
+        raw = msgpack.unpackb(frame)
+        self.assertEqual(raw['t'], 1)
+        self.assertEqual(raw['m']['pf'], '250.00')
+        self.assertEqual(raw['m']['custom'], [{'am': '1'}])
+        decoded = decode_frame(bytes_data=frame)
+        self.assertEqual(decoded, json.loads(JSON_CODEC.encode(self.payload)))
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_binary_frames_must_be_maps(self):
+        with self.assertRaises(ValueError):
+            decode_frame(bytes_data=msgpack.packb([1, 2]))
+
+    def test_cached_frames_are_encoded_once_per_format(self):
+        first = encode_frame(JSON_CODEC, self.payload, cache_key=('ride_7', 3))
+        again = encode_frame(JSON_CODEC, {'type': 'other'}, cache_key=('ride_7', 3))
+        self.assertIs(again, first)
+        if MSGPACK_CODEC is not None:
+            self.assertIsInstance(encode_frame(MSGPACK_CODEC, self.payload, cache_key=('ride_7', 3)), bytes)
+
+
+class ChannelBrokerTests(SimpleTestCase):
+    @asynccontextmanager
+    async def workers(self, count=2, **broker_options):
+        """A broker on a temporary socket and ``count`` worker layers connected to it"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'channels.sock')
+            self.broker = ChannelBroker(path, **broker_options)
+            server = asyncio.ensure_future(self.broker.serve_forever())
+            while not os.path.exists(path):
+                await asyncio.sleep(0.01)
+            layers = [UnixSocketChannelLayer(path, capacity=2) for _ in range(count)]
+            try:
+                yield layers
+            finally:
+                for layer in layers:
+                    await layer.close()
+                await self.until(lambda: not self.broker.clients)
+                server.cancel()
+
+    async def until(self, condition):
+        for _ in range(100):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+
+    async def settle(self, layer):
+        # Checked sends wait for the broker's reply, so it has read everything this worker sent before
+        await layer.send('settle', {'type': 'settle'})
+
+    async def test_group_send_reaches_every_worker(self):
+        async with self.workers() as (first, second):
+            channels = [await first.new_channel(), await first.new_channel(), await second.new_channel()]
+            for layer, channel in zip((first, first, second), channels):
+                await layer.group_add('ride_1', channel)
+            await self.settle(first)
+            await self.settle(second)
+            await second.group_send('ride_1', {'type': 'ride_update', 'seq': 1})
+            for layer, channel in zip((first, first, second), channels):
+                message = await asyncio.wait_for(layer.receive(channel), 1)
+                self.assertEqual(message, {'type': 'ride_update', 'seq': 1})
+
+    async def test_group_discard(self):
+        async with self.workers() as (first, second):
+            kept, dropped = await first.new_channel(), await first.new_channel()
+            await first.group_add('ride_1', kept)
+            await first.group_add('ride_1', dropped)
+            await first.group_discard('ride_1', dropped)
+            await self.settle(first)
+            await second.group_send('ride_1', {'type': 'ride_update'})
+            await asyncio.wait_for(first.receive(kept), 1)
+            self.assertNotIn(dropped, first.channels)
+
+    async def test_named_channels_are_shared_and_bounded(self):
+        async with self.workers(capacity=2) as (first, second):
+            await first.send('jobs', {'type': 'job', 'n': 1})
+            self.assertEqual(await asyncio.wait_for(second.receive('jobs'), 1), {'type': 'job', 'n': 1})
+            await first.send('jobs', {'type': 'job', 'n': 2})
+            await first.send('jobs', {'type': 'job', 'n': 3})
+            with self.assertRaises(ChannelFull):
+                await first.send('jobs', {'type': 'job', 'n': 4})
+
+    async def test_disconnected_workers_leave_their_groups(self):
+        async with self.workers() as (first, second):
+            channel = await first.new_channel()
+            await first.group_add('ride_1', channel)
+            await self.settle(first)
+            self.assertIn('ride_1', self.broker.groups)
+            await first.close()
+            await self.until(lambda: 'ride_1' not in self.broker.groups)
+            self.assertNotIn('ride_1', self.broker.groups)
+
+    def test_lagging_workers_lose_deliveries_until_they_catch_up(self):
+        class Writer:
+            def __init__(self):
+                self.buffered, self.frames = 0, []
+                self.transport = self
+
+            def get_write_buffer_size(self):
+                return self.buffered
+
+            def write(self, data):
+                self.frames.append(data)
+
+        broker = ChannelBroker('unused', max_buffer=100)
+        writer = broker.clients['worker'] = Writer()
+        broker.groups['ride_1'] = {'specific.worker!a': time.time()}
+        writer.buffered = 101
+        with self.assertLogs('indrive.layers', 'WARNING'):
+            broker.group_send('ride_1', {'type': 'ride_update'})
+        broker.group_send('ride_1', {'type': 'ride_update'})
+        self.assertEqual((writer.frames, broker.lagging), ([], {'worker'}))
+        writer.buffered = 0
+        broker.group_send('ride_1', {'type': 'ride_update'})
+        self.assertEqual((len(writer.frames), broker.lagging), (1, set()))
+
+
+class DatabaseProfileTests(SimpleTestCase):
+    def test_profiles(self):
+        base = Path('/srv/indrive')
+        self.assertEqual(database_from_environment(base, {})['ENGINE'], 'indrive.backends.sqlite3')
+        self.assertEqual(database_from_environment(base, {'SQLITE_TUNED': '0'}),
+                         {'ENGINE': 'django.db.backends.sqlite3', 'NAME': base / 'db.sqlite3'})
+        postgres = database_from_environment(base, {'DATABASE_PROFILE': 'postgres', 'DB_POOL': 'pgbouncer'})
+        self.assertEqual((postgres['PORT'], postgres['DISABLE_SERVER_SIDE_CURSORS']), ('6432', True))
+        with self.assertRaises(ValueError):
+            database_from_environment(base, {'DATABASE_PROFILE': 'oracle'})
+
+    def test_replicas_mirror_the_primary(self):
+        primary = database_from_environment(Path('.'), {'DATABASE_PROFILE': 'postgres'})
+        replicas = replica_databases(primary, {'POSTGRES_REPLICA_HOSTS': 'r1, r2,'})
+        self.assertEqual({alias: database['HOST'] for alias, database in replicas.items()},
+                         {'replica_1': 'r1', 'replica_2': 'r2'})
+        self.assertEqual(replicas['replica_1']['TEST'], {'MIRROR': 'default'})
+        self.assertEqual(replica_databases(sqlite_database('db.sqlite3'), {'POSTGRES_REPLICA_HOSTS': 'r1'}), {})
+
+    def test_tuned_sqlite_sets_only_connection_pragmas(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'db.sqlite3')
+            connection = ConnectionHandler({'default': sqlite_database(path)})['default']
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute('PRAGMA busy_timeout')
+                    self.assertEqual(cursor.fetchone()[0], 5000)
+                    cursor.execute('PRAGMA synchronous')
+                    self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+                    cursor.execute('PRAGMA journal_mode')
+                    self.assertEqual(cursor.fetchone()[0], 'delete')
+                    cursor.execute('CREATE TABLE t (x INTEGER)')
+            finally:
+                connection.close()
+            self.assertEqual(os.listdir(directory), ['db.sqlite3'])
+
+
+@override_settings(DATABASE_REPLICAS=['replica_1'], REPLICA_STICKY_SECONDS=5)
+class ReplicaRoutingTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User(id=7, phone_number='+9779800000007')
+        self.token = str(AccessToken.for_user(self.user))
+        self.factory = RequestFactory()
+
+    def view(self, request):
+        # What a view's reads would use; an API view authenticates its user first
+        if request.method == 'POST':
+            request.user = self.user
+        return JsonResponse({'read_from': ReplicaRouter().db_for_read(User)})
+
+    async def async_view(self, request):
+        return self.view(request)
+
+    def request(self, method, token=None):
+        headers = {'HTTP_AUTHORIZATION': f'Bearer {token}'} if token else {}
+        request = getattr(self.factory, method.lower())('/api/rides/', **headers)
+        return json.loads(ReplicaRoutingMiddleware(self.view)(request).content)['read_from']
+
+    def test_router(self):
+        router = ReplicaRouter()
+        self.assertEqual(router.db_for_read(User), 'default')
+        with replica_reads():
+            self.assertEqual(router.db_for_read(User), 'replica_1')
+            self.assertEqual(router.db_for_write(User), 'default')
+            with replica_reads(False):
+                self.assertEqual(router.db_for_read(User), 'default')
+        self.assertFalse(router.allow_migrate('replica_1', 'rides'))
+
+    def test_only_safe_requests_read_replicas(self):
+        self.assertEqual(self.request('GET'), 'replica_1')
+        self.assertEqual(self.request('GET', self.token), 'replica_1')
+        self.assertEqual(self.request('POST', self.token), 'default')
+
+    def test_writers_read_the_primary_for_a_while(self):
+        self.request('POST', self.token)
+        self.assertEqual(self.request('GET', self.token), 'default')
+        self.assertEqual(self.request('GET'), 'replica_1')
+        cache.delete('db:sticky:7')
+        self.assertEqual(self.request('GET', self.token), 'replica_1')
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_without_replicas_everything_reads_the_primary(self):
+        self.assertEqual(self.request('GET'), 'default')
+        self.request('POST', self.token)
+        self.assertIsNone(cache.get('db:sticky:7'))
+
+    def test_async_requests(self):
+        middleware = ReplicaRoutingMiddleware(self.async_view)
+        post = self.factory.post('/api/rides/', HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        get = self.factory.get('/api/rides/', HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        asyncio.run(middleware(post))
+        self.assertEqual(json.loads(asyncio.run(middleware(get)).content)['read_from'], 'default')
+        self.assertEqual(json.loads(asyncio.run(middleware(self.factory.get('/'))).content)['read_from'],
+                         'replica_1')
+
+
+class MetricsTests(TestCase):
+    def test_histograms_render_cumulative_buckets(self):
+        histogram = Histogram('test_seconds', 'Test', ('handler',), buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.7, 3):
+            histogram.observe(('h',), value)
+        self.assertEqual(histogram.render()[2:], [
+            'test_seconds_bucket{handler="h",le="0.1"} 1',
+            'test_seconds_bucket{handler="h",le="1"} 3',
+            'test_seconds_bucket{handler="h",le="+Inf"} 4',
+            'test_seconds_sum{handler="h"} 4.25',
+            'test_seconds_count{handler="h"} 4',
+        ])
+
+    def test_shards_of_exited_threads_are_folded(self):
+        counter = Counter('test_total', 'Test', ('handler',))
+        for _ in range(3):
+            thread = threading.Thread(target=counter.inc, args=(('h',),))
+            thread.start()
+            thread.join()
+        counter.inc(('h',))
+        self.assertEqual(counter.collect(), {('h',): 4})
+        self.assertEqual(len(counter._shards), 1)
+
+    def test_queries_are_charged_to_the_measured_block(self):
+        before = handler_queries.collect().get(('test', 'count'), [0])[-1]
+        with measure('test', 'count'):
+            User.objects.count()
+            User.objects.exists()
+        counts = handler_queries.collect()[('test', 'count')]
+        self.assertEqual(counts[-1], before + 1)  # One block
+        self.assertGreaterEqual(counts[-2], 2)  # Its queries
+
+    def test_requests_are_recorded_under_their_url_name(self):
+        self.client.get('/api/rides/history/')
+        self.assertIn(('http', 'GET rider-ride-history', '401'), handler_seconds.collect())
+
+    @override_settings(METRICS_TOKEN='s3cret')
+    def test_metrics_need_the_token_or_staff(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer s3cret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE indrive_handler_seconds histogram', response.content)
+        staff = User.objects.create_user('+9779800000010', is_staff=True)
+        self.client.force_login(staff)
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+
+class TracingTests(TestCase):
+    def setUp(self):
+        traces.clear()
+        self.staff = User.objects.create_user('+9779800000011', is_staff=True)
+
+    def test_spans_nest_inside_a_trace(self):
+        @traced('inner')
+        def inner():
+            with span('leaf'):
+                pass
+
+        with traced_block(start_trace('job', force=True)) as trace:
+            with span('outer'):
+                inner()
+        self.assertEqual([(name, parent) for name, parent, _, _ in trace.spans],
+                         [('outer', None), ('inner', 0), ('leaf', 1)])
+        self.assertIs(traces[-1], trace)
+        self.assertTrue(all(duration is not None for *_, duration in trace.spans))
+
+    @override_settings(TRACE_SAMPLE_RATE=0)
+    def test_unsampled_work_is_not_traced(self):
+        with traced_block(start_trace('job')) as trace:
+            with span('outer'):
+                pass
+        self.assertIsNone(trace)
+        self.assertEqual(len(traces), 0)
+
+    @override_settings(TRACE_SAMPLE_RATE=0, TRACE_PROFILING=True)
+    def test_staff_can_profile_a_request(self):
+        self.assertFalse(self.client.get('/api/rides/history/', HTTP_X_PROFILE='cprofile').has_header('X-Trace-Id'))
+        self.client.force_login(self.staff)
+        response = self.client.get('/api/rides/history/', HTTP_X_PROFILE='cprofile')
+        api = APIClient()
+        api.force_authenticate(self.staff)
+        trace = api.get('/debug/traces/', {'id': response['X-Trace-Id']}).json()
+        self.assertIn('function calls', trace['profile'])
+
+    @override_settings(TRACE_SAMPLE_RATE=0, TRACE_PROFILING=True, METRICS_TOKEN='s3cret')
+    def test_the_metrics_token_allows_profiling(self):
+        headers = {'HTTP_X_PROFILE': 'cprofile', 'HTTP_X_PROFILE_TOKEN': 'wrong'}
+        self.assertFalse(self.client.get('/api/rides/history/', **headers).has_header('X-Trace-Id'))
+        headers['HTTP_X_PROFILE_TOKEN'] = 's3cret'
+        self.assertTrue(self.client.get('/api/rides/history/', **headers).has_header('X-Trace-Id'))
+
+    @override_settings(TRACE_SAMPLE_RATE=0, TRACE_PROFILING=False)
+    def test_profiling_is_off_by_default(self):
+        self.client.force_login(self.staff)
+        self.assertFalse(self.client.get('/api/rides/history/', HTTP_X_PROFILE='cprofile').has_header('X-Trace-Id'))
+
+    def test_trace_list_is_for_staff(self):
+        self.assertEqual(self.client.get('/debug/traces/').status_code, 401)
@@ -0,0 +1,234 @@
+"""
+Sampled traces of the hot paths.
+
+A trace covers one HTTP request (``TracingMiddleware``) or one WebSocket
+message (``TracingConsumerMixin``) and holds the ``span``s opened while it
+ran: matching, ETA, geocoding, geo provider calls, serializers, channel
+layer sends. ``TRACE_SAMPLE_RATE`` of them are kept, in a ring buffer of the
+last ``TRACE_BUFFER_SIZE``; ``/debug/traces/`` (``indrive.views``) lists
+the slowest, to staff. Outside a sampled trace a span costs a context
+variable lookup.
+
+With ``TRACE_PROFILING`` on, a request sent with ``X-Profile: cprofile`` (or
+``pyinstrument``, when installed) by a staff session or with
+``X-Profile-Token: <METRICS_TOKEN>`` is always traced and profiled as a
+whole; the response's ``X-Trace-Id`` finds it at
+``/debug/traces/?id=<id>``. The profilers are only imported then.
+"""
+import functools
+import inspect
+import io
+import itertools
+import random
+import secrets
+import time
+from collections import deque
+from contextvars import ContextVar
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+_trace = ContextVar('trace', default=None)
+_parent = ContextVar('trace_parent', default=None)
+_ids = itertools.count(1)
+
+# Sampled traces, newest last; deque appends are thread-safe
+traces = deque(maxlen=settings.TRACE_BUFFER_SIZE)
+
+
+class Trace:
+    __slots__ = ('id', 'name', 'started_at', 'began', 'duration', 'spans', 'profile')
+
+    def __init__(self, name):
+        self.id = next(_ids)
+        self.name = name
+        self.started_at = time.time()
+        self.began = time.perf_counter()
+        self.duration = None
+        self.spans = []  # [name, parent index, start offset, duration]
+        self.profile = None
+
+    def as_dict(self, profile=False):
+        data = {
+            'id': self.id,
+            'name': self.name,
+            'started_at': self.started_at,
+            'duration_ms': round(self.duration * 1000, 3),
+            'spans': [
+                {'name': name, 'parent': parent, 'start_ms': round(start * 1000, 3),
+                 'duration_ms': None if duration is None else round(duration * 1000, 3)}
+                for name, parent, start, duration in self.spans
+            ],
+        }
+        if profile:
+            data['profile'] = self.profile
+        return data
+
+
+def start_trace(name, force=False):
+    """Start a trace of the current context if it is sampled; returns it (or ``None``)"""
+    if not force and random.random() >= settings.TRACE_SAMPLE_RATE:
+        return None
+    return Trace(name)
+
+
+class traced_block:
+    """Run a block inside ``trace`` (which may be ``None``) and keep the trace when it ends"""
+
+    def __init__(self, trace):
+        self.trace = trace
+
+    def __enter__(self):
+        if self.trace is not None:
+            self.tokens = _trace.set(self.trace), _parent.set(None)
+        return self.trace
+
+    def __exit__(self, *exc_info):
+        trace = self.trace
+        if trace is not None:
+            trace.duration = time.perf_counter() - trace.began
+            _trace.reset(self.tokens[0])
+            _parent.reset(self.tokens[1])
+            traces.append(trace)
+
+
+def set_trace_name(name):
+    trace = _trace.get()
+    if trace is not None:
+        trace.name = name
+
+
+class span:
+    """Time a block as part of the current trace: ``with span('query'): ...``"""
+    __slots__ = ('name', 'trace', 'index', 'token')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        trace = self.trace = _trace.get()
+        if trace is not None:
+            self.index = len(trace.spans)
+            trace.spans.append([self.name, _parent.get(), time.perf_counter() - trace.began, None])
+            self.token = _parent.set(self.index)
+        return self
+
+    def __exit__(self, *exc_info):
+        trace = self.trace
+        if trace is not None:
+            record = trace.spans[self.index]
+            record[3] = time.perf_counter() - trace.began - record[2]
+            _parent.reset(self.token)
+
+
+def traced(name):
+    """Decorator form of ``span`` for functions and coroutine functions"""
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with span(name):
+                    return await function(*args, **kwargs)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with span(name):
+                    return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def profiling_mode(request):
+    """The ``X-Profile`` mode asked for, if ``request`` may have it profiled"""
+    mode = request.headers.get('X-Profile')
+    if not (mode and settings.TRACE_PROFILING):
+        return None
+    token = settings.METRICS_TOKEN
+    if token and secrets.compare_digest(request.headers.get('X-Profile-Token', '').encode(), token.encode()):
+        return mode
+    # Bearer tokens are the API's JWTs, so staff are recognised by their admin session
+    user = getattr(request, 'user', None)
+    return mode if user is not None and user.is_staff else None
+
+
+class TracingMiddleware:
+    """Goes after ``AuthenticationMiddleware``, which profiling needs"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        mode = profiling_mode(request)
+        trace = start_trace(f"{request.method} {request.path}", force=bool(mode))
+        with traced_block(trace):
+            if mode:
+                response, trace.profile = self.profiled(mode, request)
+            else:
+                response = self.get_response(request)
+            self.finish(request, response, trace)
+        return response
+
+    async def __acall__(self, request):
+        mode = profiling_mode(request)
+        trace = start_trace(f"{request.method} {request.path}", force=bool(mode))
+        with traced_block(trace):
+            if mode:
+                # Whatever else the event loop runs meanwhile is profiled too
+                import cProfile
+                profiler = cProfile.Profile()
+                profiler.enable()
+                try:
+                    response = await self.get_response(request)
+                finally:
+                    profiler.disable()
+                trace.profile = self.report(profiler)
+            else:
+                response = await self.get_response(request)
+            self.finish(request, response, trace)
+        return response
+
+    def finish(self, request, response, trace):
+        if trace is None:
+            return
+        match = getattr(request, 'resolver_match', None)
+        if match is not None:
+            trace.name = f"{request.method} {match.view_name}"
+        response['X-Trace-Id'] = str(trace.id)
+
+    def profiled(self, mode, request):
+        if mode == 'pyinstrument':
+            try:
+                import pyinstrument
+            except ImportError:  # Optional; fall back to cProfile
+                pass
+            else:
+                profiler = pyinstrument.Profiler()
+                profiler.start()
+                try:
+                    response = self.get_response(request)
+                finally:
+                    profiler.stop()
+                return response, profiler.output_text()
+        import cProfile
+        profiler = cProfile.Profile()
+        response = profiler.runcall(self.get_response, request)
+        return response, self.report(profiler)
+
+    def report(self, profiler):
+        import pstats
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(40)
+        return output.getvalue()
+
+
+class TracingConsumerMixin:
+    """Traces a sample of the messages a consumer handles"""
+
+    async def dispatch(self, message):
+        with traced_block(start_trace(f"{type(self).__name__} {message['type']}")):
+            await super().dispatch(message)
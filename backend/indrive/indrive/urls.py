@@ -16,6 +16,8 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from indrive.metrics import metrics_view
+from indrive.views import TraceListView
 from rest_framework_simplejwt.views import (
     TokenObtainPairView,
     TokenRefreshView,
@@ -27,4 +29,7 @@ urlpatterns = [
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path('api/auth/', include('users.urls')), # Include users app URLs
     path('api/rides/', include('rides.urls')), # Include rides app URLs
+    path('api/chat/', include('chat.urls')), # Chat history, unread counts
+    path('metrics', metrics_view, name='metrics'), # Prometheus scrape target, METRICS_TOKEN
+    path('debug/traces/', TraceListView.as_view(), name='traces'), # Slowest sampled traces, staff only
 ]
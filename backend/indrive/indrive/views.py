@@ -0,0 +1,27 @@
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from .tracing import traces
+
+
+class TraceListView(APIView):
+    """The slowest recent traces, or one trace with its profile (``?id=``)"""
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        snapshot = list(traces)
+        trace_id = request.query_params.get('id')
+        if trace_id is not None:
+            for trace in snapshot:
+                if str(trace.id) == trace_id:
+                    return Response(trace.as_dict(profile=True))
+            return Response({'error': 'Trace not found (or already evicted)'}, status=404)
+        try:
+            limit = int(request.query_params.get('limit', 20))
+        except ValueError:
+            limit = 20
+        name = request.query_params.get('name')
+        if name:
+            snapshot = [trace for trace in snapshot if name in trace.name]
+        snapshot.sort(key=lambda trace: trace.duration, reverse=True)
+        return Response([trace.as_dict() for trace in snapshot[:limit]])
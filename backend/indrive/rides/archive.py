@@ -0,0 +1,189 @@
+"""
+Ride archival.
+
+Rides that were completed or cancelled more than ``RIDE_ARCHIVE_AFTER_DAYS``
+ago are moved out of ``rides_ride`` (``manage.py archive_rides``) into an
+archive partitioned by the month they ended in, so the hot table and its
+indexes only hold active and recent rides:
+
+* PostgreSQL: ``rides_ride_archive`` is a native ``PARTITION BY RANGE
+  (ended_at)`` table with one ``rides_ride_archive_YYYY_MM`` partition per
+  month; inserts into the parent land in the right partition.
+* SQLite (and other databases): plain per-month ``rides_ride_archive_YYYY_MM``
+  tables, read together with ``UNION ALL``.
+
+Tables are created on demand with the columns ``Ride`` has at that time,
+plus ``ended_at``; a migration adding a ``Ride`` column must also run
+``add_missing_columns``. Rides are moved in batches, each one transaction of
+``INSERT ... SELECT`` and ``DELETE``. Their ``DriverNotification`` and
+``RideEvent`` rows go with them (cascade), the answered notifications'
+response times kept as ``ArchivedDriverResponse`` rows for
+``backfill_driver_stats``. Rides whose chat is still in the hot table are
+skipped until ``archive_chats`` has compacted it.
+
+``archived_rides`` reads archived rides back as ``Ride`` instances, so
+serializers can't tell the difference; ``all_archived_rides`` scans the
+whole archive for maintenance commands.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import Case, DateTimeField, F, Q, When
+from django.utils import timezone
+from .models import ArchivedDriverResponse, DriverNotification, Ride
+
+PARENT_TABLE = 'rides_ride_archive'
+
+
+def ended_at():
+    # Cancelled rides have no end time; they were cancelled soon after being requested
+    return Case(When(status='completed', then=F('completed_at')), default=F('created_at'),
+                output_field=DateTimeField())
+
+
+def archivable_rides(days=None):
+    """Rides that ended more than ``days`` ago and have no chat left in the hot table"""
+    days = settings.RIDE_ARCHIVE_AFTER_DAYS if days is None else days
+    cutoff = timezone.now() - timedelta(days=days)
+    ended = (Q(status='completed', completed_at__lt=cutoff) |
+             Q(status='cancelled', created_at__lt=cutoff))
+    return Ride.objects.filter(ended, messages__isnull=True)
+
+
+def month_start(moment):
+    moment = moment.astimezone(dt_timezone.utc)
+    return datetime(moment.year, moment.month, 1, tzinfo=dt_timezone.utc)
+
+
+def next_month(start):
+    return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+
+
+def partition_table(month):
+    return f"{PARENT_TABLE}_{month.year:04d}_{month.month:02d}"
+
+
+def _column_definitions(connection):
+    quote = connection.ops.quote_name
+    definitions = [
+        f"{quote(field.column)} {field.db_type(connection)} {'NULL' if field.null else 'NOT NULL'}"
+        for field in Ride._meta.concrete_fields
+    ]
+    definitions.append(f"{quote('ended_at')} {DateTimeField().db_type(connection)} NOT NULL")
+    return definitions
+
+
+def ensure_partition(connection, month):
+    """Create the archive table for ``month`` (and on PostgreSQL the parent) if missing"""
+    quote = connection.ops.quote_name
+    table = partition_table(month)
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            # The primary key of a partitioned table must contain the partition key
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {quote(PARENT_TABLE)} "
+                f"({', '.join(_column_definitions(connection))}, PRIMARY KEY (id, ended_at)) "
+                f"PARTITION BY RANGE (ended_at)")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {quote(PARENT_TABLE + '_rider')} "
+                           f"ON {quote(PARENT_TABLE)} (rider_id, created_at)")
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {quote(table)} PARTITION OF {quote(PARENT_TABLE)} "
+                f"FOR VALUES FROM (%s) TO (%s)", [month, next_month(month)])
+        else:
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS {quote(table)} "
+                           f"({', '.join(_column_definitions(connection))}, PRIMARY KEY (id))")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {quote(table + '_rider')} "
+                           f"ON {quote(table)} (rider_id, created_at)")
+    return table
+
+
+def archive_tables(connection):
+    """The tables a read has to look at, newest month first"""
+    names = connection.introspection.table_names()
+    if connection.vendor == 'postgresql':
+        return [PARENT_TABLE] if PARENT_TABLE in names else []
+    return sorted((name for name in names if name.startswith(PARENT_TABLE + '_')), reverse=True)
+
+
+def add_missing_columns(connection, model=Ride):
+    """Add the columns of ``model`` (a migration's historical ``Ride``) that
+    existing archive tables lack, as nullable: archived rows have no value"""
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        for table in archive_tables(connection):
+            existing = {column.name for column in connection.introspection.get_table_description(cursor, table)}
+            for field in model._meta.concrete_fields:
+                if field.column not in existing:
+                    cursor.execute(f"ALTER TABLE {quote(table)} ADD COLUMN "
+                                   f"{quote(field.column)} {field.db_type(connection)} NULL")
+
+
+def archive_batch(days=None, batch_size=None):
+    """Move one batch of archivable rides; returns the number moved (0 once there are none left)"""
+    batch_size = batch_size or settings.RIDE_ARCHIVE_BATCH
+    connection = connections[router.db_for_write(Ride)]
+    quote = connection.ops.quote_name
+    columns = ', '.join(quote(field.column) for field in Ride._meta.concrete_fields)
+    ended_sql = "CASE WHEN status = 'completed' THEN completed_at ELSE created_at END"
+    with transaction.atomic(using=connection.alias):
+        rides = list(archivable_rides(days).annotate(ended_at=ended_at())
+                     .order_by('id').values_list('id', 'ended_at')[:batch_size])
+        if not rides:
+            return 0
+        months = {}
+        for ride_id, ended in rides:
+            months.setdefault(month_start(ended), []).append(ride_id)
+        tables = {month: ensure_partition(connection, month) for month in months}
+        with connection.cursor() as cursor:
+            # PostgreSQL routes rows inserted into the parent to their partition
+            targets = ([(PARENT_TABLE, [ride_id for ride_id, _ in rides])]
+                       if connection.vendor == 'postgresql'
+                       else [(tables[month], ids) for month, ids in months.items()])
+            for table, ids in targets:
+                cursor.execute(
+                    f"INSERT INTO {quote(table)} ({columns}, ended_at) "
+                    f"SELECT {columns}, {ended_sql} FROM {quote(Ride._meta.db_table)} "
+                    f"WHERE id IN ({', '.join(['%s'] * len(ids))})", ids)
+        ride_ids = [ride_id for ride_id, _ in rides]
+        ArchivedDriverResponse.objects.using(connection.alias).bulk_create([
+            ArchivedDriverResponse(driver_id=driver_id, notified_at=created_at, response_time=response_time)
+            for driver_id, created_at, response_time in DriverNotification.objects.using(connection.alias)
+            .filter(ride_id__in=ride_ids, responded=True, response_time__isnull=False)
+            .values_list('driver_id', 'created_at', 'response_time')
+        ])
+        Ride.objects.filter(id__in=ride_ids).delete()
+    return len(rides)
+
+
+def archived_rides(rider_id=None, driver_id=None):
+    """A rider's (or driver's) archived rides as ``Ride`` instances, newest first"""
+    alias = router.db_for_read(Ride)
+    connection = connections[alias]
+    tables = archive_tables(connection)
+    if not tables:
+        return []
+    quote = connection.ops.quote_name
+    column, value = ('rider_id', rider_id) if rider_id is not None else ('driver_id', driver_id)
+    columns = ', '.join(quote(field.column) for field in Ride._meta.concrete_fields)
+    sql = ' UNION ALL '.join(
+        f"SELECT {columns} FROM {quote(table)} WHERE {column} = %s" for table in tables
+    ) + ' ORDER BY created_at DESC'
+    return list(Ride.objects.db_manager(alias).raw(sql, [value] * len(tables)))
+
+
+def all_archived_rides(fields, order_by, where=None):
+    """Every archived ride, only ``fields`` loaded, in ``order_by`` order (a column).
+
+    ``where`` is an SQL condition on the archive's columns.
+    """
+    alias = router.db_for_read(Ride)
+    connection = connections[alias]
+    tables = archive_tables(connection)
+    if not tables:
+        return iter(())
+    quote = connection.ops.quote_name
+    columns = ', '.join(quote(Ride._meta.get_field(name).column) for name in ['id', *fields])
+    sql = ' UNION ALL '.join(
+        f"SELECT {columns} FROM {quote(table)}" + (f" WHERE {where}" if where else '') for table in tables
+    ) + f" ORDER BY {quote(order_by)}"
+    return Ride.objects.db_manager(alias).raw(sql).iterator()  # Streams the rows where the database can
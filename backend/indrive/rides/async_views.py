@@ -0,0 +1,224 @@
+"""
+Async-native versions of the busiest ride actions: request a ride, bid,
+accept a bid and the status transitions of ``RideDetailView.patch``.
+
+Under ASGI the DRF views in ``views`` run in the server's single sync
+thread, and each of their channel layer sends hops back onto the event
+loop through ``async_to_sync``. These views stay on the event loop: the
+ORM is used through its async API, channel layer sends are awaited, and
+the geo provider calls of a new ride are made concurrently. Authentication,
+permissions and responses match the DRF views, as JSON.
+
+Each ORM call still runs in a thread (Django's async ORM wraps the sync
+one); writes that need a transaction, like
+``stats.arecord_notification_response``, go through ``sync_to_async``.
+Compare both paths with the ``bench_async_views`` command.
+"""
+import functools
+import json
+from django.http import JsonResponse
+from django.utils import timezone
+from channels.layers import get_channel_layer
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from indrive.idempotency import idempotent
+from users.models import User
+from .dispatch import adispatch_ride
+from .estimates import ahourly_speeds, trip_fields
+from .models import Ride
+from .serializers import BidSerializer, RideSerializer, ageo_fields
+from .streams import publish_ride_event
+from . import stats
+
+
+def _error(detail, status):
+    return JsonResponse({"error": detail} if isinstance(detail, str) else detail, status=status)
+
+
+async def authenticate(request):
+    """The user of the request's JWT access token; raises ``AuthenticationFailed``"""
+    authentication = JWTAuthentication()
+    header = authentication.get_header(request)
+    raw_token = header and authentication.get_raw_token(header)
+    if not raw_token:
+        raise AuthenticationFailed("Authentication credentials were not provided.")
+    token = authentication.get_validated_token(raw_token)
+    try:
+        user = await User.objects.aget(pk=token[jwt_settings.USER_ID_CLAIM])
+    except (KeyError, User.DoesNotExist):
+        raise AuthenticationFailed("User not found")
+    if not user.is_active:
+        raise AuthenticationFailed("User is inactive")
+    return user
+
+
+def async_api(*methods):
+    """Allow ``methods``, authenticate the JWT and parse the JSON body into ``request.data``"""
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return JsonResponse({"detail": f'Method "{request.method}" not allowed.'}, status=405,
+                                    headers={'Allow': ', '.join(methods)})
+            try:
+                request.user = await authenticate(request)
+            except AuthenticationFailed as e:
+                return JsonResponse({"detail": str(e.detail)}, status=401)
+            try:
+                request.data = json.loads(request.body or b'{}')
+            except ValueError:
+                return _error("Malformed JSON body", 400)
+            return await view(request, *args, **kwargs)
+        # Token authentication, like the DRF views; csrf_exempt() is not async-aware in 4.2
+        wrapper.csrf_exempt = True
+        return wrapper
+    return decorator
+
+
+async def _get_ride(pk):
+    try:
+        return await Ride.objects.select_related('rider', 'driver').aget(pk=pk)
+    except Ride.DoesNotExist:
+        return None
+
+
+async def _publish_update(channel_layer, group, ride):
+    await publish_ride_event(channel_layer, group, ride, {
+        "type": "ride_update",
+        "message": RideSerializer(ride).data
+    })
+
+
+@async_api('POST')
+@idempotent('ride-create')
+async def create_ride(request):
+    if request.user.role != 'rider':
+        return _error("Only riders can request rides", 403)
+
+    serializer = RideSerializer(data=request.data)
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors, status=400)
+    data = serializer.validated_data
+    data.update(await ageo_fields(data))
+    data.update(trip_fields(data, await ahourly_speeds()))
+    ride = Ride(**data, rider=request.user, status='requested')
+    await ride.asave()
+
+    channel_layer = get_channel_layer()
+    await _publish_update(channel_layer, "rides", ride)
+    # Subscribe the rider's open sockets to the ride's own stream
+    await channel_layer.group_send(
+        f"user_{ride.rider_id}", {"type": "ride.subscribe", "ride_id": str(ride.id)}
+    )
+    await adispatch_ride(ride)
+    return JsonResponse(RideSerializer(ride).data, status=201)
+
+
+@async_api('POST')
+@idempotent('driver-bid')
+async def submit_driver_bid(request, pk):
+    ride = await _get_ride(pk)
+    if ride is None:
+        return _error("Not found.", 404)
+    if request.user.role != 'driver':
+        return _error("Only drivers can bid", 403)
+
+    serializer = BidSerializer(data=request.data)
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors, status=400)
+    amount = serializer.validated_data['amount']
+    ride.driver_proposals.append({
+        'driver': request.user.id,
+        'amount': str(amount),
+        'timestamp': timezone.now().isoformat(),
+        'message': serializer.validated_data.get('message', '')
+    })
+    await ride.asave()
+
+    await stats.arecord_bid(request.user.id, amount)
+    await stats.arecord_notification_response(request.user.id, ride.id)
+
+    await publish_ride_event(get_channel_layer(), f"user_{ride.rider_id}", ride, {
+        "type": "bid_update",
+        "bid": str(amount)
+    })
+    return JsonResponse(RideSerializer(ride).data)
+
+
+@async_api('POST')
+async def accept_bid(request, pk, bid_index):
+    ride = await _get_ride(pk)
+    if ride is None:
+        return _error("Not found.", 404)
+    if ride.rider_id != request.user.id:
+        return _error("Only the ride's rider can accept a bid", 403)
+    if ride.status != 'requested':
+        return _error("Only requested rides can accept a bid", 400)
+    try:
+        bid = ride.driver_proposals[bid_index]
+    except IndexError:
+        return _error("Invalid bid index", 400)
+
+    ride.accepted_proposal = bid
+    ride.status = 'accepted'
+    ride.driver = await User.objects.aget(id=bid['driver'])
+    ride.final_fare = bid['amount']
+    await ride.asave()
+
+    channel_layer = get_channel_layer()
+    await channel_layer.group_send(
+        f"user_{ride.driver_id}", {"type": "ride.subscribe", "ride_id": str(ride.id)}
+    )
+    await _publish_update(channel_layer, f"ride_{ride.id}", ride)
+    return JsonResponse(RideSerializer(ride).data)
+
+
+@async_api('PATCH')
+async def update_status(request, pk):
+    """The status transitions of ``RideDetailView.patch``"""
+    ride = await _get_ride(pk)
+    if ride is None:
+        return _error("Not found.", 404)
+    user = request.user
+    new_status = request.data.get('status')
+    channel_layer = get_channel_layer()
+
+    if new_status == 'accepted':
+        if not (user.role == 'driver' and ride.status == 'requested' and ride.driver is None):
+            return JsonResponse({"detail": "Cannot accept this ride."}, status=400)
+        ride.driver = user
+        ride.status = 'accepted'
+        ride.accepted_at = timezone.now()
+        await ride.asave()
+        await stats.arecord_notification_response(user.id, ride.id)
+        await _publish_update(channel_layer, f"user_{ride.rider_id}", ride)
+        # Add driver's sockets to the ride's specific group
+        await channel_layer.group_send(
+            f"user_{user.id}", {"type": "ride.subscribe", "ride_id": str(ride.id)}
+        )
+    elif new_status == 'started':
+        if not (user.role == 'driver' and ride.driver_id == user.id and ride.status == 'accepted'):
+            return JsonResponse({"detail": "Cannot start this ride."}, status=400)
+        ride.status = 'started'
+        ride.started_at = timezone.now()
+        await ride.asave()
+        await _publish_update(channel_layer, f"ride_{ride.id}", ride)
+    elif new_status == 'completed':
+        if not (user.role == 'driver' and ride.driver_id == user.id and ride.status == 'started'):
+            return JsonResponse({"detail": "Cannot complete this ride."}, status=400)
+        ride.status = 'completed'
+        ride.completed_at = timezone.now()
+        await ride.asave()
+        await stats.arecord_ride_completed(ride)
+        await _publish_update(channel_layer, f"ride_{ride.id}", ride)
+    elif new_status == 'cancelled':
+        if not (user.role == 'rider' and ride.rider_id == user.id and ride.status == 'requested'):
+            return JsonResponse({"detail": "Cannot cancel this ride."}, status=400)
+        ride.status = 'cancelled'
+        await ride.asave()
+        await _publish_update(channel_layer, f"ride_{ride.id}", ride)
+    else:
+        # Other partial updates go through RideDetailView
+        return _error("status must be one of accepted, started, completed, cancelled", 400)
+    return JsonResponse(RideSerializer(ride).data)
@@ -0,0 +1,59 @@
+"""
+Conditional GET for polled ride endpoints.
+
+Validators come from ``Ride.version`` and ``Ride.updated_at`` alone, so a
+poll that finds nothing new costs one small query and no serialization:
+
+* a ride's strong ETag is ``"<id>.<version>"``,
+* a list's ETag hashes the count, the summed versions and the latest
+  ``updated_at`` of the rows it would return (one aggregate query), which
+  changes when any ride in it changes, joins or leaves it.
+
+The nested rider and driver objects are not covered: a poll sees their
+changes with the next change of the ride.
+"""
+import hashlib
+from django.db.models import Count, Max, Sum
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from .models import Ride
+
+
+def ride_validators(pk):
+    """``(etag, last_modified)`` of a ride, or ``None`` if there is no such ride"""
+    try:
+        row = Ride.objects.filter(pk=pk).values_list('version', 'updated_at').first()
+    except (TypeError, ValueError):
+        return None
+    if row is None:
+        return None
+    version, updated_at = row
+    return f'"{pk}.{version}"', updated_at
+
+
+def list_validators(queryset):
+    """``(etag, last_modified)`` of the rows of ``queryset``"""
+    summary = queryset.order_by().aggregate(count=Count('id'), versions=Sum('version'), latest=Max('updated_at'))
+    latest = summary['latest']
+    digest = hashlib.sha1(
+        f"{summary['count']}:{summary['versions']}:{latest.isoformat() if latest else ''}".encode()
+    ).hexdigest()[:20]
+    return f'"{digest}"', latest
+
+
+def not_modified(request, validators):
+    """The 304 response if the client's copy is current, else ``None``"""
+    etag, last_modified = validators
+    response = get_conditional_response(
+        request, etag=etag, last_modified=int(last_modified.timestamp()) if last_modified else None)
+    if response is not None:
+        set_validators(response, validators)
+    return response
+
+
+def set_validators(response, validators):
+    etag, last_modified = validators
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    return response
@@ -1,16 +1,26 @@
-import json
+import logging
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from datetime import datetime
 from .models import Ride
-from .utils import calculate_eta
+from .utils import calculate_eta, parse_coordinates
+from .streams import events_since, latest_seq
+from .presence import presence
+from .heatmap import heatmap
 from asgiref.sync import async_to_sync
 from django.contrib.auth import get_user_model
+from django.db.models import Q
 from rest_framework_simplejwt.tokens import AccessToken
+from indrive.codecs import CodecConsumerMixin, decode_frame
+from indrive.metrics import MetricsConsumerMixin
+from indrive.tracing import TracingConsumerMixin
 
 User = get_user_model()
+logger = logging.getLogger(__name__)
+
+class RideConsumer(MetricsConsumerMixin, TracingConsumerMixin, CodecConsumerMixin, AsyncWebsocketConsumer):
+    client_message_types = ('ping', 'resume', 'location_ping', 'location_update')
 
-class RideConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         # Extract token from query string
         query_string = self.scope['query_string'].decode()
@@ -20,15 +30,10 @@ class RideConsumer(AsyncWebsocketConsumer):
         if token_param:
             try:
                 # Authenticate user using JWT token
-                print(f"Attempting WebSocket authentication with token: {token_param[:20]}...") # Print first 20 chars
                 access_token = AccessToken(token_param)
                 self.user = await self.get_user(access_token['user_id'])
-                if self.user and self.user.is_authenticated:
-                    print(f"WebSocket authenticated user: {self.user.phone_number}")
-                else:
-                    print("WebSocket authentication failed: User not authenticated after token processing.")
             except Exception as e:
-                print(f"WebSocket authentication failed: {e}")
+                logger.info("WebSocket authentication failed: %s", e)
                 await self.close()
                 return
 
@@ -39,6 +44,7 @@ class RideConsumer(AsyncWebsocketConsumer):
         self.user_id = str(self.user.id)
         self.user_group_name = f'user_{self.user_id}'
         self.ride_group_name = 'rides' # General group for all ride updates
+        self.tracks_presence = self.user.role == 'driver'
 
         # Add user to their personal group and general rides group
         await self.channel_layer.group_add(
@@ -50,12 +56,20 @@ class RideConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
 
-        await self.accept()
-        await self.send(text_data=json.dumps({
+        # Follow the streams of the rides this user is taking part in
+        self.ride_groups = set()
+        for ride_id in await self.get_active_ride_ids():
+            await self.join_ride_group(ride_id)
+
+        await self.accept_negotiated()
+        if self.tracks_presence:
+            presence.connect(self.user.id)
+            presence.ensure_sweeper()
+        await self.send_payload({
             'type': 'websocket.connected',
             'message': 'WebSocket connected!',
             'user_id': self.user_id
-        }))
+        })
 
     async def disconnect(self, close_code):
         if self.user:
@@ -67,16 +81,42 @@ class RideConsumer(AsyncWebsocketConsumer):
                 self.ride_group_name,
                 self.channel_name
             )
+            for group in getattr(self, 'ride_groups', ()):
+                await self.channel_layer.group_discard(group, self.channel_name)
+            if getattr(self, 'tracks_presence', False):
+                presence.disconnect(self.user.id)
 
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
+        text_data_json = decode_frame(text_data, bytes_data)
         message_type = text_data_json.get('type')
+        self.measure_as(message_type)
+
+        # Every message is a sign of life; location pings also refresh current_location
+        if self.tracks_presence:
+            presence.heartbeat(self.user.id, text_data_json.get('latitude'), text_data_json.get('longitude'))
+
+        if message_type == 'ping':
+            await self.send_payload({'type': 'pong'})
+            return
+
+        # Reconnecting client catching up on a ride stream
+        if message_type == 'resume':
+            await self.resume_ride_stream(text_data_json.get('ride_id'), text_data_json.get('last_seq', 0))
+            return
 
         # Real-time location tracking handler
         if message_type == 'location_ping':
             ride_id = text_data_json.get('ride_id')
-            lat = text_data_json.get('latitude')
-            lng = text_data_json.get('longitude')
+            location = parse_coordinates(text_data_json.get('latitude'), text_data_json.get('longitude'))
+            if location is None:
+                await self.send_payload({'type': 'error', 'message': 'Invalid location'})
+                return
+            lat, lng = location
+            if not ride_id:
+                # Idle driver heartbeat, nobody to broadcast to; counts as supply
+                if self.tracks_presence:
+                    heatmap.driver_seen(self.user.id, lat, lng)
+                return
             
             # Broadcast to ride group
             await self.channel_layer.group_send(
@@ -85,7 +125,8 @@ class RideConsumer(AsyncWebsocketConsumer):
                     "latitude": lat,
                     "longitude": lng,
                     "timestamp": datetime.now().isoformat(),
-                    "driver_id": str(self.user.id)
+                    "user_id": str(self.user.id),
+                    "ride_id": ride_id
                 }
             )
             
@@ -115,20 +156,94 @@ class RideConsumer(AsyncWebsocketConsumer):
     # Receive message from channel layer group (for general ride updates)
     async def ride_update(self, event):
         message = event['message']
-        await self.send(text_data=json.dumps({
+        # Sequenced events are identical for every recipient: encode once per format
+        cache_key = ('ride_update', event['ride_id'], event['seq']) if 'seq' in event else None
+        await self.send_payload({
             'type': 'ride_update',
-            'content': message
-        }))
+            'content': message,
+            'ride_id': event.get('ride_id'),
+            'seq': event.get('seq')
+        }, cache_key=cache_key)
+
+    # Receive message from channel layer group (new bid on one of the rider's rides)
+    async def bid_update(self, event):
+        await self.send_payload({
+            'type': 'bid_update',
+            'ride_id': event['ride_id'],
+            'bid': event['bid'],
+            'seq': event.get('seq')
+        })
+
+    # Receive message from channel layer group (route progress for a ride)
+    async def eta_update(self, event):
+        await self.send_payload({
+            'type': 'eta_update',
+            'ride_id': event.get('ride_id'),
+            'eta': event['eta'],
+            'distance': event['distance'],
+            'polyline': event['polyline']
+        })
+
+    # Receive message from channel layer group (a new ride offered to this driver)
+    async def ride_offer(self, event):
+        await self.send_payload({
+            'type': 'ride_offer',
+            'ride_id': event['ride_id'],
+            'pickup_location': event['pickup_location'],
+            'destination_location': event['destination_location'],
+            'pickup_zone': event.get('pickup_zone'),
+            'destination_zone': event.get('destination_zone'),
+            'proposed_fare': event['proposed_fare'],
+            'distance_km': event['distance_km'],
+            'pool_with': event.get('pool_with', []),
+        })
+
+    # Sent to the user's group when they become a participant of a ride
+    async def ride_subscribe(self, event):
+        await self.join_ride_group(event['ride_id'])
+
+    async def join_ride_group(self, ride_id):
+        group = f"ride_{ride_id}"
+        if group not in self.ride_groups:
+            self.ride_groups.add(group)
+            await self.channel_layer.group_add(group, self.channel_name)
+
+    async def resume_ride_stream(self, ride_id, last_seq):
+        """Replay the ride events missed since ``last_seq`` or ask the client to refetch"""
+        try:
+            ride_id = int(ride_id)
+            last_seq = int(last_seq or 0)
+        except (TypeError, ValueError):
+            await self.send_payload({'type': 'error', 'message': 'Invalid resume request'})
+            return
+        if not await self.is_ride_participant(ride_id):
+            await self.send_payload({'type': 'error', 'message': 'Not a participant of this ride'})
+            return
+
+        await self.join_ride_group(ride_id)
+        missed = await database_sync_to_async(events_since)(ride_id, last_seq)
+        if missed is None:
+            # Some were already deleted: the client has to refetch the ride
+            await self.send_payload({
+                'type': 'resync_required',
+                'ride_id': str(ride_id),
+                'seq': await database_sync_to_async(latest_seq)(ride_id)
+            })
+            return
+        my_groups = {self.user_group_name, self.ride_group_name} | self.ride_groups
+        for group, event in missed:
+            if group in my_groups:  # Only what this socket would have received live
+                await self.dispatch(event)
 
     # Receive message from channel layer group (for location updates)
     async def location_update(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send_payload({
             'type': 'location_update',
             'latitude': event['latitude'],
             'longitude': event['longitude'],
             'user_id': event['user_id'],
             'ride_id': event['ride_id'],
-        }))
+        })
 
     # Helper to get user asynchronously
     @database_sync_to_async
@@ -138,6 +253,17 @@ class RideConsumer(AsyncWebsocketConsumer):
         except User.DoesNotExist:
             return None
 
+    @database_sync_to_async
+    def get_active_ride_ids(self):
+        return list(Ride.objects.filter(
+            Q(rider=self.user) | Q(driver=self.user),
+            status__in=['requested', 'accepted', 'started']
+        ).values_list('id', flat=True))
+
+    @database_sync_to_async
+    def is_ride_participant(self, ride_id):
+        return Ride.objects.filter(Q(rider=self.user) | Q(driver=self.user), id=ride_id).exists()
+
     @database_sync_to_async
     def update_ride_eta(self, ride_id, current_lat, current_lng):
         """Update ride ETA and broadcast to connected clients"""
@@ -158,12 +284,13 @@ class RideConsumer(AsyncWebsocketConsumer):
                 async_to_sync(self.channel_layer.group_send)(
                     f"ride_{ride_id}", {
                         "type": "eta.update",
+                        "ride_id": str(ride_id),
                         "eta": eta_data['eta'],
                         "distance": eta_data['distance'],
                         "polyline": eta_data['polyline']
                     }
                 )
         except Ride.DoesNotExist:
-            print(f"Ride {ride_id} not found for ETA update")
-        except Exception as e:
-            print(f"Error updating ETA: {e}")
+            logger.info("Ride %s not found for ETA update", ride_id)
+        except Exception:
+            logger.exception("Error updating ETA")
@@ -0,0 +1,71 @@
+"""
+Ride dispatch: offering a new ride to the best matching drivers.
+
+``dispatch_ride`` costs two queries however many drivers are notified: the
+candidate driver SELECT in ``find_best_drivers`` and one ``bulk_create`` of
+their ``DriverNotification`` rows. Offers are then pushed to every
+driver's ``user_<id>`` group in one hop onto the event loop, with the
+ride's zones (``rides.geofence``) and the open rides the new one could be
+pooled with (``rides.pooling``, from memory).
+``adispatch_ride`` is the same for async views, which await the pushes.
+"""
+import asyncio
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from indrive.tracing import span, traced
+from .models import DriverNotification
+from .pooling import pool
+from .utils import candidate_drivers, find_best_drivers, score_drivers
+
+
+def dispatch_ride(ride):
+    """Notify the best drivers for ``ride``; returns the created notifications"""
+    matches = find_best_drivers(ride)
+    if not matches:
+        return []
+    notifications = DriverNotification.objects.bulk_create([
+        DriverNotification(driver=match['driver'], ride=ride, score=match['score'], details=match['details'])
+        for match in matches
+    ])
+    async_to_sync(push_offers)(get_channel_layer(), ride, notifications, pool_candidates(ride))
+    return notifications
+
+
+async def adispatch_ride(ride):
+    with span('find_best_drivers'):
+        with span('query'):
+            drivers = [driver async for driver in candidate_drivers()]
+        matches = score_drivers(ride, drivers)
+    if not matches:
+        return []
+    notifications = await DriverNotification.objects.abulk_create([
+        DriverNotification(driver=match['driver'], ride=ride, score=match['score'], details=match['details'])
+        for match in matches
+    ])
+    await push_offers(get_channel_layer(), ride, notifications, pool_candidates(ride))
+    return notifications
+
+
+def pool_candidates(ride):
+    """Ids of the open rides ``ride`` could share a driver with, best first"""
+    with span('pool_candidates'):
+        return [match['ride_id'] for match in pool.candidates(ride.id, limit=settings.POOL_MAX_SUGGESTIONS)]
+
+
+@traced('push_offers')
+async def push_offers(channel_layer, ride, notifications, pool_with=()):
+    await asyncio.gather(*(
+        channel_layer.group_send(f"user_{notification.driver_id}", {
+            "type": "ride.offer",
+            "ride_id": str(ride.id),
+            "pickup_location": ride.pickup_location,
+            "destination_location": ride.destination_location,
+            "pickup_zone": ride.pickup_zone,
+            "destination_zone": ride.destination_zone,
+            "proposed_fare": str(ride.proposed_fare),
+            "distance_km": notification.details['distance_km'],
+            "pool_with": [str(ride_id) for ride_id in pool_with],
+        })
+        for notification in notifications
+    ))
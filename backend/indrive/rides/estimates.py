@@ -0,0 +1,102 @@
+"""
+Local trip estimates: a ride's road distance and duration from its
+coordinates, without a geo provider call, so new rides have
+``distance_km`` and ``estimated_duration`` from the start.
+
+Distance is the haversine distance stretched by ``ROAD_CIRCUITY``. Duration
+divides it by the average speed of the hour of day, from ``SpeedProfile``;
+hours without enough observed trips use ``ESTIMATE_SPEED_KMH``.
+``manage.py estimate_rides`` learns the speeds from completed rides
+(``started_at`` to ``completed_at``, over the same estimated distance, so a
+circuity that is off for a city cancels out) and fills in older rides.
+
+``fare_range`` turns an estimate into the fare suggested to riders.
+"""
+import time
+from collections import defaultdict
+from decimal import Decimal
+from django.conf import settings
+from django.utils import timezone
+from .geo import ESTIMATE_SPEED_KMH, ROAD_CIRCUITY, calculate_distance
+from .models import SpeedProfile
+
+# Observed speeds outside this range are GPS gaps or rides closed late, not traffic
+PLAUSIBLE_SPEED_KMH = (3, 120)
+
+_speeds = {}
+_loaded_at = None
+
+
+def _stale():
+    return _loaded_at is None or time.monotonic() - _loaded_at > settings.SPEED_PROFILE_REFRESH_SECONDS
+
+
+def _store(rows):
+    global _speeds, _loaded_at
+    _speeds = dict(rows)
+    _loaded_at = time.monotonic()
+    return _speeds
+
+
+def hourly_speeds():
+    """``{hour: km/h}`` of the learned profiles, loaded at most every ``SPEED_PROFILE_REFRESH_SECONDS``"""
+    if _stale():
+        return _store(SpeedProfile.objects.values_list('hour', 'speed_kmh'))
+    return _speeds
+
+
+async def ahourly_speeds():
+    if _stale():
+        return _store([row async for row in SpeedProfile.objects.values_list('hour', 'speed_kmh')])
+    return _speeds
+
+
+def road_distance(pickup, destination):
+    """Estimated road kilometers between two ``(lat, lng)`` points"""
+    return calculate_distance(pickup[0], pickup[1], destination[0], destination[1]) * ROAD_CIRCUITY
+
+
+def estimate_trip(pickup, destination, when=None, speeds=None):
+    """``(km, minutes)`` for a trip starting at ``when`` (default: now)"""
+    distance = road_distance(pickup, destination)
+    hour = timezone.localtime(when).hour
+    speed = (hourly_speeds() if speeds is None else speeds).get(hour, ESTIMATE_SPEED_KMH)
+    return round(distance, 3), int(round(distance / speed * 60))
+
+
+def trip_fields(data, speeds=None, when=None):
+    """``distance_km`` and ``estimated_duration`` for a ride's data, when it
+    has both coordinates and those fields are still empty"""
+    pickup = (data.get('pickup_latitude'), data.get('pickup_longitude'))
+    destination = (data.get('destination_latitude'), data.get('destination_longitude'))
+    if None in pickup + destination:
+        return {}
+    distance, minutes = estimate_trip(pickup, destination, when=when, speeds=speeds)
+    fields = {'distance_km': distance, 'estimated_duration': minutes}
+    return {field: value for field, value in fields.items() if data.get(field) is None}
+
+
+def fare_range(distance, minutes, surge=1.0):
+    """``(low, high)`` fare for a trip: the distance and time tariff times the
+    surge multiplier, plus or minus ``FARE_RANGE_SPREAD``"""
+    fare = (settings.FARE_BASE + settings.FARE_PER_KM * distance + settings.FARE_PER_MINUTE * minutes) * surge
+    spread = settings.FARE_RANGE_SPREAD
+    return tuple(Decimal(round(fare * factor)).quantize(Decimal('0.01')) for factor in (1 - spread, 1 + spread))
+
+
+def calibrate(trips, min_samples=None):
+    """``{hour: (km/h, trips)}`` from ``(started_at, completed_at, km)`` of
+    completed trips, for the hours with at least ``min_samples`` of them"""
+    if min_samples is None:
+        min_samples = settings.SPEED_PROFILE_MIN_SAMPLES
+    totals = defaultdict(lambda: [0.0, 0.0, 0])  # km, hours, trips
+    for started_at, completed_at, distance in trips:
+        hours = (completed_at - started_at).total_seconds() / 3600
+        if hours <= 0 or not PLAUSIBLE_SPEED_KMH[0] <= distance / hours <= PLAUSIBLE_SPEED_KMH[1]:
+            continue
+        total = totals[timezone.localtime(started_at).hour]
+        total[0] += distance
+        total[1] += hours
+        total[2] += 1
+    # Total distance over total time: long trips weigh more than short ones
+    return {hour: (km / hours, count) for hour, (km, hours, count) in totals.items() if count >= min_samples}
@@ -0,0 +1,352 @@
+"""
+Geo provider boundary.
+
+Every maps lookup the backend makes (reverse geocoding, directions) goes
+through the provider returned by ``get_geo_provider()``, chosen with the
+``GEO_PROVIDER`` setting. ``FakeGeoProvider`` answers from straight-line
+geometry so load tests and local development run fully offline.
+
+The provider is wrapped in ``ResilientGeoProvider``: concurrent identical
+lookups share one call (``SingleFlight``), and a ``CircuitBreaker`` per
+operation stops calling the provider while too many of its calls fail or
+are slow. Lookups it does not make, or that fail, are answered locally:
+directions from ``estimate_route``, addresses as coordinates.
+"""
+import math
+import threading
+import time
+from datetime import datetime
+from django.conf import settings
+from django.utils.module_loading import import_string
+from indrive.metrics import (geo_breaker_state, geo_breaker_transitions, geo_call, geo_coalesced,
+                             geo_fallbacks)
+from indrive.tracing import span
+
+
+def calculate_distance(lat1, lon1, lat2, lon2):
+    """Calculate distance between two points in kilometers using Haversine formula"""
+    R = 6371  # Earth radius in km
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = (math.sin(dlat/2) * math.sin(dlat/2) +
+         math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) *
+         math.sin(dlon/2) * math.sin(dlon/2))
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
+    return R * c
+
+
+# Straight line to road distance, and the average speed, of the local estimate
+ROAD_CIRCUITY = 1.3
+ESTIMATE_SPEED_KMH = 30.0
+ROUTE_POINTS = 16
+
+
+def estimate_route(origin, destination):
+    """``directions()`` from straight-line geometry: no network, no traffic"""
+    origin, destination = tuple(map(float, origin)), tuple(map(float, destination))
+    distance = calculate_distance(origin[0], origin[1], destination[0], destination[1]) * ROAD_CIRCUITY
+    steps = ROUTE_POINTS - 1
+    points = [
+        (origin[0] + (destination[0] - origin[0]) * i / steps,
+         origin[1] + (destination[1] - origin[1]) * i / steps)
+        for i in range(ROUTE_POINTS)
+    ]
+    return {
+        'eta': int(distance / ESTIMATE_SPEED_KMH * 60),
+        'distance': round(distance, 3),
+        'polyline': encode_polyline(points)
+    }
+
+
+def encode_polyline(points):
+    """Encode ``[(lat, lng), ...]`` with Google's encoded polyline algorithm"""
+    result = []
+    prev_lat = prev_lng = 0
+    for lat, lng in points:
+        lat, lng = int(round(lat * 1e5)), int(round(lng * 1e5))
+        for delta in (lat - prev_lat, lng - prev_lng):
+            delta = ~(delta << 1) if delta < 0 else delta << 1
+            while delta >= 0x20:
+                result.append(chr((0x20 | (delta & 0x1f)) + 63))
+                delta >>= 5
+            result.append(chr(delta + 63))
+        prev_lat, prev_lng = lat, lng
+    return ''.join(result)
+
+
+def decode_polyline(polyline):
+    """Decode a Google encoded polyline into ``[(lat, lng), ...]``"""
+    points = []
+    index = lat = lng = 0
+    length = len(polyline)
+    while index < length:
+        deltas = []
+        for _ in range(2):
+            shift = value = 0
+            while True:
+                byte = ord(polyline[index]) - 63
+                index += 1
+                value |= (byte & 0x1f) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            deltas.append(~(value >> 1) if value & 1 else value >> 1)
+        lat += deltas[0]
+        lng += deltas[1]
+        points.append((lat / 1e5, lng / 1e5))
+    return points
+
+
+class GoogleMapsProvider:
+    """Google Maps Geocoding and Directions APIs"""
+
+    def __init__(self):
+        self._client = None
+
+    @property
+    def client(self):
+        # One client (and HTTP session) per process instead of one per call
+        if self._client is None:
+            # Imported here: googlemaps pulls in requests, which processes
+            # that never call Google (workers, commands) shouldn't load
+            import googlemaps
+            # retry_timeout too: the client otherwise retries failed calls for up to 60s
+            self._client = googlemaps.Client(key=settings.GOOGLE_MAPS_API_KEY,
+                                             timeout=settings.GEO_TIMEOUT_SECONDS,
+                                             retry_timeout=settings.GEO_TIMEOUT_SECONDS)
+        return self._client
+
+    def reverse_geocode(self, latitude, longitude):
+        """Formatted address of the point, or ``None``"""
+        results = self.client.reverse_geocode((latitude, longitude))
+        if results:
+            return results[0]['formatted_address']
+        return None
+
+    def directions(self, origin, destination, traffic=False):
+        """``{'eta': minutes, 'distance': km, 'polyline': str}`` for a driving route, or ``None``"""
+        options = {'mode': 'driving'}
+        if traffic:
+            options.update(departure_time=datetime.now(), traffic_model='best_guess')
+        directions = self.client.directions(origin, destination, **options)
+        if not directions:
+            return None
+        leg = directions[0]['legs'][0]
+        duration = leg.get('duration_in_traffic', leg['duration'])
+        return {
+            'eta': duration['value'] // 60,  # minutes
+            'distance': leg['distance']['value'] / 1000,  # kilometers
+            'polyline': directions[0]['overview_polyline']['points']
+        }
+
+
+class FakeGeoProvider:
+    """Offline provider for load tests and local development.
+
+    Routes are ``estimate_route``'s. ``latency`` (seconds) simulates the
+    network round trip.
+    """
+
+    def __init__(self, latency=None):
+        self.latency = settings.FAKE_GEO_LATENCY_MS / 1000 if latency is None else latency
+
+    def reverse_geocode(self, latitude, longitude):
+        if self.latency:
+            time.sleep(self.latency)
+        return f"{latitude:.5f}, {longitude:.5f}"
+
+    def directions(self, origin, destination, traffic=False):
+        if self.latency:
+            time.sleep(self.latency)
+        return estimate_route(origin, destination)
+
+
+class MeteredGeoProvider:
+    """Charges the calls of the provider it wraps to the current request's metrics"""
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    def reverse_geocode(self, latitude, longitude):
+        with geo_call(), span('geo.reverse_geocode'):
+            return self.provider.reverse_geocode(latitude, longitude)
+
+    def directions(self, origin, destination, traffic=False):
+        with geo_call(), span('geo.directions'):
+            return self.provider.directions(origin, destination, traffic=traffic)
+
+
+class SingleFlight:
+    """Runs one call per key at a time; callers arriving meanwhile get its result"""
+
+    class Call:
+        __slots__ = ('done', 'result', 'error')
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function):
+        """``(result, shared)``: ``shared`` is true if another caller's call answered"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self.Call()
+        if not leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = function()
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        if call.error is not None:
+            raise call.error
+        return call.result, not leader
+
+
+class CircuitBreaker:
+    """Stops calls to a dependency while too many of its recent calls failed or were slow.
+
+    Closed: calls go through, and the outcomes of the last ``window`` are kept.
+    Once at least ``min_calls`` of them are known and ``failure_rate`` of them
+    failed or took longer than ``slow_seconds``, it opens: calls are refused
+    for ``open_seconds``. Then it is half-open: one probe call goes through
+    (the others are still refused); its success closes the breaker, its
+    failure opens it again.
+    """
+    CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name, window, min_calls, failure_rate, slow_seconds, open_seconds):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_seconds = slow_seconds
+        self.open_seconds = open_seconds
+        self._lock = threading.Lock()
+        self._outcomes = []  # True for a failed or slow call, oldest first
+        self._opened_at = None
+        self._probing = False
+        self.state = None
+        self._set_state(self.CLOSED)
+
+    def allow(self):
+        """Whether a call may go to the dependency now; if so, ``record`` its outcome"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    return False
+                self._set_state(self.HALF_OPEN)
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record(self, seconds, failed=False):
+        bad = failed or seconds > self.slow_seconds
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+                if bad:
+                    self._open()
+                else:
+                    self._outcomes.clear()
+                    self._set_state(self.CLOSED)
+                return
+            if self.state == self.OPEN:
+                return  # A call let through before the breaker opened
+            self._outcomes.append(bad)
+            del self._outcomes[:-self.window]
+            if len(self._outcomes) >= self.min_calls and (
+                    sum(self._outcomes) / len(self._outcomes) >= self.failure_rate):
+                self._open()
+
+    def _open(self):
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        self._set_state(self.OPEN)
+
+    def _set_state(self, state):
+        if state != self.state and self.state is not None:
+            geo_breaker_transitions.inc((self.name, state))
+        self.state = state
+        geo_breaker_state.set((self.name,), self.STATE_VALUES[state])
+
+
+class ResilientGeoProvider:
+    """Coalesces identical concurrent lookups and answers locally while the
+    provider is failing, instead of tying up a worker thread per call"""
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.flights = SingleFlight()
+        self.breakers = {
+            operation: CircuitBreaker(
+                operation,
+                window=settings.GEO_BREAKER_WINDOW,
+                min_calls=settings.GEO_BREAKER_MIN_CALLS,
+                failure_rate=settings.GEO_BREAKER_FAILURE_RATE,
+                slow_seconds=settings.GEO_SLOW_CALL_SECONDS,
+                open_seconds=settings.GEO_BREAKER_OPEN_SECONDS,
+            )
+            for operation in ('reverse_geocode', 'directions')
+        }
+
+    def reverse_geocode(self, latitude, longitude):
+        return self._lookup('reverse_geocode', (latitude, longitude), {},
+                            lambda: f"{latitude:.5f}, {longitude:.5f}")
+
+    def directions(self, origin, destination, traffic=False):
+        return self._lookup('directions', (tuple(origin), tuple(destination)), {'traffic': traffic},
+                            lambda: estimate_route(origin, destination))
+
+    def _lookup(self, operation, args, kwargs, fallback):
+        key = (operation, args, tuple(sorted(kwargs.items())))
+        result, shared = self.flights.do(key, lambda: self._call(operation, args, kwargs, fallback))
+        if shared:
+            geo_coalesced.inc((operation,))
+        return result
+
+    def _call(self, operation, args, kwargs, fallback):
+        breaker = self.breakers[operation]
+        if not breaker.allow():
+            geo_fallbacks.inc((operation, 'open'))
+            return fallback()
+        began = time.monotonic()
+        try:
+            result = getattr(self.provider, operation)(*args, **kwargs)
+        except Exception:
+            breaker.record(time.monotonic() - began, failed=True)
+            geo_fallbacks.inc((operation, 'error'))
+            return fallback()
+        breaker.record(time.monotonic() - began)
+        return result
+
+
+_provider = None
+
+
+def get_geo_provider():
+    global _provider
+    if _provider is None:
+        _provider = ResilientGeoProvider(MeteredGeoProvider(import_string(settings.GEO_PROVIDER)()))
+    return _provider
+
+
+def set_geo_provider(provider):
+    """Swap the process-wide provider (load tests, management commands)"""
+    global _provider
+    _provider = ResilientGeoProvider(MeteredGeoProvider(provider))
@@ -0,0 +1,174 @@
+"""
+Service-area geofencing: which operating areas and zones a point is in.
+
+Areas are the GeoJSON ``Polygon`` and ``MultiPolygon`` features of
+``GEOFENCE_FILE``, each with an ``id`` and a ``kind`` property.
+``service_area`` polygons are where rides may start and end; ``zone``
+polygons name parts of it for matching and pricing, and an optional
+``fare_multiplier`` applies to fares from or to the zone. Zones may overlap:
+a point's zone is the first listed that holds it, so list specific zones
+(an airport) before the districts around them.
+
+The polygons are indexed once per process, when this module is imported,
+on a grid of ``GEOFENCE_CELL_DEGREES`` cells. Each cell lists the areas that
+reach it, marked as covering it when none of their edges cross it. A point
+in a covered cell needs no geometry at all; in a boundary cell it is ray
+cast against only the edges spanning its row of cells, precomputed per
+area. A lookup takes microseconds (``manage.py bench_geofence`` measures
+it), so ``RideSerializer`` classifies every new ride's pickup and
+destination and rejects those outside the service area before any geo
+provider call. Without a ``GEOFENCE_FILE`` every point is in service.
+"""
+import json
+import math
+from collections import namedtuple
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+KINDS = ('service_area', 'zone')
+
+
+class Place(namedtuple('Place', 'in_service service_area zones fare_multiplier')):
+    __slots__ = ()
+
+    @property
+    def zone(self):
+        """The first listed zone holding the point, or None"""
+        return self.zones[0] if self.zones else None
+
+
+class Area:
+    """One configured polygon (holes and parts included), prepared for point tests"""
+
+    def __init__(self, id, kind, rings, cell_degrees, fare_multiplier=1.0):
+        self.id = id
+        self.kind = kind
+        self.rings = rings  # [[(lat, lng), ...]], not closed
+        self.fare_multiplier = fare_multiplier
+        self.cell_degrees = cell_degrees
+        latitudes = [lat for ring in rings for lat, _ in ring]
+        longitudes = [lng for ring in rings for _, lng in ring]
+        self.bounds = (min(latitudes), min(longitudes), max(latitudes), max(longitudes))
+        # The edges a ray from a point may cross, by the row of cells the point is in, as
+        # (lowest lat, highest lat, lat, lng, lng per degree of lat); horizontal ones never count
+        self._bands = {}
+        for (lat1, lng1), (lat2, lng2) in edges(rings):
+            if lat1 == lat2:
+                continue
+            edge = (min(lat1, lat2), max(lat1, lat2), lat1, lng1, (lng2 - lng1) / (lat2 - lat1))
+            for row in range(math.floor(edge[0] / cell_degrees), math.floor(edge[1] / cell_degrees) + 1):
+                self._bands.setdefault(row, []).append(edge)
+
+    def contains(self, latitude, longitude):
+        # Even-odd rule on a ray going east: holes and separate parts come out right
+        inside = False
+        for low, high, lat, lng, slope in self._bands.get(math.floor(latitude / self.cell_degrees), ()):
+            if low <= latitude < high and lng + (latitude - lat) * slope > longitude:
+                inside = not inside
+        return inside
+
+
+def edges(rings):
+    for ring in rings:
+        yield from zip(ring, ring[1:] + ring[:1])
+
+
+class Geofence:
+    def __init__(self, features, cell_degrees=None):
+        self.cell_degrees = cell_degrees or settings.GEOFENCE_CELL_DEGREES
+        self.areas = [self._area(index, feature) for index, feature in enumerate(features)]
+        ids = [area.id for area in self.areas]
+        if len(set(ids)) != len(ids):
+            raise ImproperlyConfigured("GEOFENCE_FILE: area ids must be unique")
+        # Without service areas nothing is out of area
+        self.enforced = any(area.kind == 'service_area' for area in self.areas)
+        cells = {}  # cell -> [(area, covers the whole cell)], in file order
+        for area in self.areas:
+            for cell, covered in self._cover(area):
+                cells.setdefault(cell, []).append((area, covered))
+        self._cells = {cell: tuple(entries) for cell, entries in cells.items()}
+
+    def __len__(self):
+        return len(self._cells)
+
+    def classify(self, latitude, longitude):
+        """The ``Place`` of a point: whether it is in service, and its zones"""
+        latitude, longitude = float(latitude), float(longitude)
+        service_area, zones, multiplier = None, [], 1.0
+        cell = (math.floor(latitude / self.cell_degrees), math.floor(longitude / self.cell_degrees))
+        for area, covered in self._cells.get(cell, ()):
+            if covered or area.contains(latitude, longitude):
+                if area.kind == 'zone':
+                    zones.append(area.id)
+                    multiplier = max(multiplier, area.fare_multiplier)
+                elif service_area is None:
+                    service_area = area.id
+        return Place(service_area is not None or not self.enforced, service_area, tuple(zones), multiplier)
+
+    def covered_share(self):
+        """Share of the indexed cells that need no point-in-polygon test"""
+        entries = [covered for areas in self._cells.values() for _, covered in areas]
+        return sum(entries) / len(entries) if entries else 0.0
+
+    def _cover(self, area):
+        """``(cell, covered)`` of every cell ``area`` reaches"""
+        size = self.cell_degrees
+        boundary = set()
+        for (lat1, lng1), (lat2, lng2) in edges(area.rings):
+            # In pieces no longer than a cell, so each piece's bounding box holds few cells
+            pieces = max(1, math.ceil(max(abs(lat2 - lat1), abs(lng2 - lng1)) / size))
+            for piece in range(pieces):
+                start, end = piece / pieces, (piece + 1) / pieces
+                latitudes = (lat1 + (lat2 - lat1) * start, lat1 + (lat2 - lat1) * end)
+                longitudes = (lng1 + (lng2 - lng1) * start, lng1 + (lng2 - lng1) * end)
+                for row in range(math.floor(min(latitudes) / size), math.floor(max(latitudes) / size) + 1):
+                    for column in range(math.floor(min(longitudes) / size), math.floor(max(longitudes) / size) + 1):
+                        boundary.add((row, column))
+        south, west, north, east = area.bounds
+        for row in range(math.floor(south / size), math.floor(north / size) + 1):
+            for column in range(math.floor(west / size), math.floor(east / size) + 1):
+                if (row, column) in boundary:
+                    yield (row, column), False
+                # No edge crosses the cell: it is all inside or all outside, like its centre
+                elif area.contains((row + 0.5) * size, (column + 0.5) * size):
+                    yield (row, column), True
+
+    def _area(self, index, feature):
+        try:
+            properties = feature.get('properties') or {}
+            geometry = feature['geometry']
+            polygons = {'Polygon': [geometry['coordinates']],
+                        'MultiPolygon': geometry['coordinates']}[geometry['type']]
+            rings = []
+            for polygon in polygons:
+                for ring in polygon:
+                    points = [(float(lat), float(lng)) for lng, lat, *_ in ring]  # GeoJSON is lng, lat
+                    if points and points[0] == points[-1]:
+                        points.pop()
+                    if len(points) < 3:
+                        raise ValueError("a ring needs at least 3 points")
+                    rings.append(points)
+            kind = properties.get('kind', 'zone')
+            if kind not in KINDS:
+                raise ValueError(f"kind must be one of {', '.join(KINDS)}")
+            return Area(str(properties['id']), kind, rings, self.cell_degrees,
+                        float(properties.get('fare_multiplier', 1.0)))
+        except (KeyError, TypeError, ValueError) as e:
+            raise ImproperlyConfigured(f"GEOFENCE_FILE feature {index}: {e!r}")
+
+
+def load(path, cell_degrees=None):
+    """The ``Geofence`` of a GeoJSON file; one without areas when ``path`` is empty"""
+    if not path:
+        return Geofence([], cell_degrees)
+    try:
+        with open(path) as f:
+            collection = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ImproperlyConfigured(f"GEOFENCE_FILE {path}: {e}")
+    if not isinstance(collection, dict) or collection.get('type') != 'FeatureCollection':
+        raise ImproperlyConfigured(f"GEOFENCE_FILE {path}: not a GeoJSON FeatureCollection")
+    return Geofence(collection.get('features', []), cell_degrees)
+
+
+geofence = load(settings.GEOFENCE_FILE)
@@ -0,0 +1,170 @@
+"""
+Supply and demand heatmap, for fare suggestions.
+
+The map is a grid of ``HEATMAP_CELL_DEGREES`` cells. Demand is the rides
+still ``requested`` that were opened in the last
+``HEATMAP_DEMAND_WINDOW_SECONDS``; supply is the drivers whose last idle
+location ping (a ``location_ping`` without a ride) is from the last
+``HEATMAP_SUPPLY_WINDOW_SECONDS``, counted in the cell they were last in.
+Both are kept up to date from events: every ``Ride`` save
+(``ride_saved``, a ``post_save`` receiver) and every idle ping. Entries
+leave their window lazily, from a time-ordered log, so nothing is queried
+or scanned.
+
+``surge`` is a multiplier per cell from the demand/supply ratio of it and
+its 8 neighbours, computed with NumPy for all active cells at once and
+cached for ``HEATMAP_REFRESH_SECONDS``. Like ``presence``, the map is per
+process: with several workers each sees the rides and drivers it served.
+"""
+import math
+import threading
+import time
+from collections import Counter, deque
+from django.conf import settings
+
+
+class Heatmap:
+    def __init__(self, cell_degrees=None, demand_window=None, supply_window=None):
+        self.cell_degrees = cell_degrees or settings.HEATMAP_CELL_DEGREES
+        self.demand_window = demand_window or settings.HEATMAP_DEMAND_WINDOW_SECONDS
+        self.supply_window = supply_window or settings.HEATMAP_SUPPLY_WINDOW_SECONDS
+        self._rides = {}  # ride_id -> (cell, opened at)
+        self._drivers = {}  # driver_id -> (cell, seen at)
+        self._demand = Counter()
+        self._supply = Counter()
+        # (time, id) of every open and sighting, oldest first; superseded ones are skipped
+        self._ride_log = deque()
+        self._driver_log = deque()
+        self._lock = threading.Lock()
+        self._surge = {}
+        self._surge_at = None
+
+    def cell(self, latitude, longitude):
+        return (math.floor(float(latitude) / self.cell_degrees),
+                math.floor(float(longitude) / self.cell_degrees))
+
+    def ride_opened(self, ride_id, latitude, longitude):
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if ride_id in self._rides:
+                return  # Bids and counter offers save the ride again
+            cell = self.cell(latitude, longitude)
+            self._rides[ride_id] = (cell, now)
+            self._demand[cell] += 1
+            self._ride_log.append((now, ride_id))
+
+    def ride_closed(self, ride_id):
+        with self._lock:
+            self._remove(self._rides, self._demand, ride_id)
+
+    def driver_seen(self, driver_id, latitude, longitude):
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            self._remove(self._drivers, self._supply, driver_id)
+            cell = self.cell(latitude, longitude)
+            self._drivers[driver_id] = (cell, now)
+            self._supply[cell] += 1
+            self._driver_log.append((now, driver_id))
+
+    def driver_busy(self, driver_id):
+        """The driver took a ride: not supply until their next idle ping"""
+        with self._lock:
+            self._remove(self._drivers, self._supply, driver_id)
+
+    def counts(self, latitude, longitude):
+        """``(open rides, idle drivers)`` in the cell of a point"""
+        cell = self.cell(latitude, longitude)
+        with self._lock:
+            self._expire(time.monotonic())
+            return self._demand[cell], self._supply[cell]
+
+    def surge(self, latitude, longitude):
+        """The fare multiplier of the cell of a point, 1.0 when supply keeps up"""
+        now = time.monotonic()
+        if self._surge_at is None or now - self._surge_at > settings.HEATMAP_REFRESH_SECONDS:
+            with self._lock:
+                self._expire(now)
+                demand, supply = +self._demand, +self._supply  # Copies without zero counts
+            self._surge = surge_multipliers(demand, supply)
+            self._surge_at = now
+        return self._surge.get(self.cell(latitude, longitude), 1.0)
+
+    def ride_saved(self, sender, instance, **kwargs):
+        """``post_save`` receiver for ``Ride``"""
+        if instance.status == 'requested':
+            if instance.pickup_latitude is not None and instance.pickup_longitude is not None:
+                self.ride_opened(instance.id, instance.pickup_latitude, instance.pickup_longitude)
+            return
+        self.ride_closed(instance.id)
+        if instance.driver_id is not None and instance.status in ('accepted', 'started'):
+            self.driver_busy(instance.driver_id)
+
+    def _remove(self, entries, counts, key):
+        entry = entries.pop(key, None)
+        if entry is not None:
+            counts[entry[0]] -= 1
+            if not counts[entry[0]]:
+                del counts[entry[0]]
+
+    def _expire(self, now):
+        for log, entries, counts, window in ((self._ride_log, self._rides, self._demand, self.demand_window),
+                                             (self._driver_log, self._drivers, self._supply, self.supply_window)):
+            cutoff = now - window
+            while log and log[0][0] < cutoff:
+                seen, key = log.popleft()
+                entry = entries.get(key)
+                if entry is not None and entry[1] == seen:  # Not seen again since
+                    self._remove(entries, counts, key)
+
+
+def surge_multipliers(demand, supply):
+    """``{cell: multiplier}`` of the cells where demand outruns supply.
+
+    A cell's ratio is its 3x3 neighbourhood's demand over supply, each plus
+    ``HEATMAP_PRIOR`` so a single ride in an empty area does not surge. The
+    multiplier rises by ``SURGE_SENSITIVITY`` per unit of ratio above 1, in
+    steps of 0.05, up to ``SURGE_MAX``.
+    """
+    cells = sorted(set(demand) | set(supply))
+    if not cells:
+        return {}
+    # Imported here: only processes that serve fare estimates need it
+    import numpy as np
+
+    rows = np.array([row for row, _ in cells], dtype=np.int64)
+    columns = np.array([column for _, column in cells], dtype=np.int64)
+    # Cells are looked up by one integer: the rank of their row among the active rows,
+    # times the number of active columns, plus the rank of their column. It stays small
+    # wherever the cells are, and is sorted like cells
+    row_values, row_ranks = np.unique(rows, return_inverse=True)
+    column_values, column_ranks = np.unique(columns, return_inverse=True)
+    width = len(column_values)
+    keys = row_ranks * width + column_ranks
+    cell_demand = np.array([demand.get(cell, 0) for cell in cells], dtype=np.float64)
+    cell_supply = np.array([supply.get(cell, 0) for cell in cells], dtype=np.float64)
+
+    area_demand = np.zeros(len(cells))
+    area_supply = np.zeros(len(cells))
+    for row_offset in (-1, 0, 1):
+        for column_offset in (-1, 0, 1):
+            neighbour_rows, neighbour_columns = rows + row_offset, columns + column_offset
+            row_index = np.minimum(np.searchsorted(row_values, neighbour_rows), len(row_values) - 1)
+            column_index = np.minimum(np.searchsorted(column_values, neighbour_columns), width - 1)
+            neighbours = row_index * width + column_index
+            index = np.minimum(np.searchsorted(keys, neighbours), len(keys) - 1)
+            # The neighbour's row and column are both active, and so is the cell they make
+            found = ((row_values[row_index] == neighbour_rows) & (column_values[column_index] == neighbour_columns)
+                     & (keys[index] == neighbours))
+            area_demand += np.where(found, cell_demand[index], 0)
+            area_supply += np.where(found, cell_supply[index], 0)
+
+    prior = settings.HEATMAP_PRIOR
+    ratio = (area_demand + prior) / (area_supply + prior)
+    multiplier = np.clip(1 + settings.SURGE_SENSITIVITY * (ratio - 1), 1.0, settings.SURGE_MAX)
+    multiplier = np.round(multiplier * 20) / 20
+    return {cells[i]: float(multiplier[i]) for i in np.flatnonzero(multiplier > 1.0)}
+
+
+heatmap = Heatmap()
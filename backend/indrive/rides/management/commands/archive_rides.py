@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from rides.archive import archivable_rides, archive_batch
+
+
+class Command(BaseCommand):
+    help = (
+        'Move rides completed or cancelled long ago from the rides table into the monthly '
+        'partitioned ride archive, in batches. Rides whose chat is still in the hot table are '
+        'skipped: run archive_chats first.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.RIDE_ARCHIVE_AFTER_DAYS,
+                            help='Archive rides completed or cancelled more than this many days ago')
+        parser.add_argument('--batch-size', type=int, default=settings.RIDE_ARCHIVE_BATCH,
+                            help='Rides moved per transaction')
+        parser.add_argument('--limit', type=int, default=None, help='Archive at most this many rides')
+
+    def handle(self, *args, **options):
+        moved = 0
+        limit = options['limit']
+        while limit is None or moved < limit:
+            batch_size = options['batch_size'] if limit is None else min(options['batch_size'], limit - moved)
+            count = archive_batch(options['days'], batch_size)
+            if not count:
+                break
+            moved += count
+        self.stdout.write(f"Archived {moved} rides")
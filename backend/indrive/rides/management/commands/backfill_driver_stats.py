@@ -0,0 +1,121 @@
+import heapq
+import itertools
+from datetime import timedelta
+from decimal import Decimal
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+from rides.archive import all_archived_rides
+from rides.models import ArchivedDriverResponse, DriverNotification, Ride
+from rides.stats import DriverStats
+from users.models import User
+
+
+def in_event_order(batches):
+    """Events from ``(watermark, events)`` batches, in time order.
+
+    No event of a batch or of any later one may be earlier than the batch's
+    ``watermark``, so buffered events up to it are final.
+    """
+    pending = []
+    tiebreak = itertools.count()
+    for watermark, events in batches:
+        while pending and pending[0][0] <= watermark:
+            yield heapq.heappop(pending)[2]
+        for event in events:
+            heapq.heappush(pending, (event[0], next(tiebreak), event))
+    while pending:
+        yield heapq.heappop(pending)[2]
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute the driver statistics used for matching (average fare, response time, rating, '
+        'completed rides) from ride and notification history, archived rides included. Reads bids, '
+        'completions and notification responses as three streams, each in the order the events '
+        'happened, merged in a single pass. Drivers without any history are left alone. Updates '
+        'made while it runs are overwritten, so run it when drivers are quiet.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows fetched per round trip')
+        parser.add_argument('--dry-run', action='store_true', help='Compute but do not save')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        stats = {}
+        events = 0
+        for _, kind, driver_id, value in heapq.merge(
+                self.bids(chunk_size), self.completions(chunk_size), self.responses(chunk_size),
+                key=lambda event: event[0]):
+            driver = stats.get(driver_id)
+            if driver is None:
+                driver = stats[driver_id] = DriverStats()
+            if kind == 'bid':
+                driver.add_fare(value)
+            elif kind == 'completed':
+                final_fare, rating = value
+                driver.add_completed_ride(final_fare)
+                if rating is not None:
+                    driver.add_rating(rating)
+            else:
+                driver.add_response_time(value)
+            events += 1
+
+        if not options['dry_run']:
+            self.save(stats)
+        self.stdout.write(f"Replayed {events} events for {len(stats)} drivers"
+                          + (' (dry run)' if options['dry_run'] else ''))
+
+    def bids(self, chunk_size):
+        # Bids are stored on their ride and made after it was created: in creation order,
+        # the bids of earlier rides up to a ride's creation are all known
+        rides = heapq.merge(
+            Ride.objects.order_by('created_at')
+            .values_list('created_at', 'driver_proposals').iterator(chunk_size=chunk_size),
+            ((ride.created_at, ride.driver_proposals)
+             for ride in all_archived_rides(['created_at', 'driver_proposals'], 'created_at')),
+            key=lambda ride: ride[0])
+        return in_event_order(
+            (created_at, [(parse_datetime(bid['timestamp']), 'bid', bid['driver'], Decimal(str(bid['amount'])))
+                          for bid in ride_bids or []])
+            for created_at, ride_bids in rides
+        )
+
+    def completions(self, chunk_size):
+        fields = ['completed_at', 'driver_id', 'final_fare', 'driver_rating']
+        rides = heapq.merge(
+            Ride.objects.filter(status='completed', driver__isnull=False, completed_at__isnull=False)
+            .order_by('completed_at').values_list(*fields).iterator(chunk_size=chunk_size),
+            ((ride.completed_at, ride.driver_id, ride.final_fare, ride.driver_rating)
+             for ride in all_archived_rides(fields, 'completed_at', "status = 'completed' AND "
+                                            "driver_id IS NOT NULL AND completed_at IS NOT NULL")),
+            key=lambda ride: ride[0])
+        for completed_at, driver_id, final_fare, rating in rides:
+            yield completed_at, 'completed', driver_id, (final_fare, rating)
+
+    def responses(self, chunk_size):
+        # A response comes after its notification: ordered by when they answered, not when notified
+        notifications = heapq.merge(
+            DriverNotification.objects.filter(responded=True, response_time__isnull=False)
+            .order_by('created_at').values_list('created_at', 'driver_id', 'response_time')
+            .iterator(chunk_size=chunk_size),
+            ArchivedDriverResponse.objects.order_by('notified_at')
+            .values_list('notified_at', 'driver_id', 'response_time').iterator(chunk_size=chunk_size),
+            key=lambda notification: notification[0])
+        return in_event_order(
+            (created_at, [(created_at + timedelta(seconds=response_time), 'response', driver_id, response_time)])
+            for created_at, driver_id, response_time in notifications
+        )
+
+    def save(self, stats):
+        fields = DriverStats.fields
+        users = []
+        for driver_id, driver in stats.items():
+            user = User(id=driver_id)
+            for field in fields:
+                setattr(user, field, getattr(driver, field))
+            users.append(user)
+        # Drivers without history keep their values: nothing to recompute them from
+        with transaction.atomic():
+            User.objects.bulk_update(users, fields, batch_size=500)
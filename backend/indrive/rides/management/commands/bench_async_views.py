@@ -0,0 +1,138 @@
+import asyncio
+import json
+import tempfile
+import time
+from collections import defaultdict
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import (setup_databases, setup_test_environment, teardown_databases,
+                               teardown_test_environment)
+from channels.testing import HttpCommunicator
+from rest_framework_simplejwt.tokens import AccessToken
+from rides.geo import FakeGeoProvider, set_geo_provider
+from users.models import User
+from .bench_channel_layer import percentile
+
+RIDE = {
+    'pickup_location': 'Thamel', 'destination_location': 'Patan',
+    'pickup_latitude': 27.7154, 'pickup_longitude': 85.3123,
+    'destination_latitude': 27.6766, 'destination_longitude': 85.3149,
+    'proposed_fare': '250.00',
+}
+
+# The same ride flow through the DRF views and through rides.async_views
+PATHS = {
+    'sync': {
+        'create': ('POST', '/api/rides/'),
+        'bid': ('POST', '/api/rides/{id}/driver-bid/'),
+        'accept': ('POST', '/api/rides/{id}/accept-bid/0/'),
+        'status': ('PATCH', '/api/rides/{id}/status/'),
+    },
+    'async': {
+        'create': ('POST', '/api/rides/async/'),
+        'bid': ('POST', '/api/rides/async/{id}/driver-bid/'),
+        'accept': ('POST', '/api/rides/async/{id}/accept-bid/0/'),
+        'status': ('PATCH', '/api/rides/async/{id}/status/'),
+    },
+}
+STEPS = ('create', 'bid', 'accept', 'start', 'complete')
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare the sync (DRF) and async-native ride action views under Django\'s ASGI handler: '
+        'concurrent create, bid, accept, start, complete flows against a throwaway SQLite database, '
+        'with requests/sec and p50/p99 latency per step.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--flows', type=int, default=200, help='Ride flows per path')
+        parser.add_argument('--concurrency', type=int, default=20, help='Flows running at once')
+        parser.add_argument('--drivers', type=int, default=20, help='Online drivers the rides are dispatched to')
+        parser.add_argument('--geo-latency-ms', type=float, default=20,
+                            help='Simulated round trip of each geo provider call')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('The benchmark runs on a throwaway SQLite database')
+        database = tempfile.NamedTemporaryFile(prefix='bench_async_', suffix='.sqlite3', delete=False)
+        database.close()
+        connection.settings_dict['TEST']['NAME'] = database.name
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        set_geo_provider(FakeGeoProvider(latency=options['geo_latency_ms'] / 1000))
+        try:
+            pairs = self.create_users(options['concurrency'], options['drivers'])
+            connection.close()  # The ASGI handler's thread opens its own
+            results = asyncio.run(self.run(pairs, options['flows']))
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        self.stdout.write(f"{options['flows']} flows per path, {options['concurrency']} concurrent, "
+                          f"geo calls {options['geo_latency_ms']:g} ms")
+        self.stdout.write(f"{'path':<7}{'step':<10}{'req/s':>9}{'p50 ms':>10}{'p99 ms':>10}")
+        for path, (elapsed, latencies) in results.items():
+            everything = [latency for samples in latencies.values() for latency in samples]
+            for step in STEPS + ('all',):
+                samples = everything if step == 'all' else latencies[step]
+                rate = len(samples) / elapsed if step == 'all' else ''
+                self.stdout.write(f"{path:<7}{step:<10}{rate if rate == '' else format(rate, '.0f'):>9}"
+                                  f"{percentile(samples, 50) * 1000:>10.1f}{percentile(samples, 99) * 1000:>10.1f}")
+
+    def create_users(self, concurrency, drivers):
+        """``(rider, driver)`` token pairs, one per concurrent flow"""
+        bidders = [
+            User.objects.create_user(f'+97798{index:08d}', role='driver', is_available=True, is_online=True,
+                                     current_location=f'{27.71 + index * 0.0005},{85.31}')
+            for index in range(max(drivers, concurrency))
+        ]
+        return [
+            (str(AccessToken.for_user(User.objects.create_user(f'+97797{index:08d}', role='rider'))),
+             str(AccessToken.for_user(bidders[index])))
+            for index in range(concurrency)
+        ]
+
+    async def run(self, pairs, flows):
+        application = get_asgi_application()
+        results = {}
+        for path, routes in PATHS.items():
+            latencies = defaultdict(list)
+            remaining = iter(range(flows))
+
+            async def worker(rider, driver):
+                for _ in remaining:
+                    await self.flow(application, routes, rider, driver, latencies)
+
+            began = time.perf_counter()
+            await asyncio.gather(*(worker(rider, driver) for rider, driver in pairs))
+            results[path] = (time.perf_counter() - began, latencies)
+        return results
+
+    async def flow(self, application, routes, rider, driver, latencies):
+        ride = await self.request(application, routes['create'], rider, RIDE, latencies['create'], 201)
+        ride_id = ride['id']
+        await self.request(application, routes['bid'], driver, {'amount': '240.00'}, latencies['bid'], 200, ride_id)
+        await self.request(application, routes['accept'], rider, {}, latencies['accept'], 200, ride_id)
+        await self.request(application, routes['status'], driver, {'status': 'started'},
+                           latencies['start'], 200, ride_id)
+        await self.request(application, routes['status'], driver, {'status': 'completed'},
+                           latencies['complete'], 200, ride_id)
+
+    async def request(self, application, route, token, data, samples, expected, ride_id=None):
+        method, path = route
+        body = json.dumps(data).encode()
+        headers = [
+            (b'host', b'testserver'),
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+            (b'authorization', f'Bearer {token}'.encode()),
+        ]
+        communicator = HttpCommunicator(application, method, path.format(id=ride_id), body, headers)
+        began = time.perf_counter()
+        response = await communicator.get_response(timeout=60)
+        samples.append(time.perf_counter() - began)
+        if response['status'] != expected:
+            raise CommandError(f"{method} {path}: {response['status']} {response['body'][:500]!r}")
+        return json.loads(response['body'])
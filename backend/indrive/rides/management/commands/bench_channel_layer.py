@@ -0,0 +1,83 @@
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from channels.layers import InMemoryChannelLayer
+from indrive.layers import UnixSocketChannelLayer
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))] if ordered else float('nan')
+
+
+class Command(BaseCommand):
+    help = 'Compare group_send throughput and latency of the in-memory and Unix-socket channel layers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=5000, help='group_send calls per run')
+        parser.add_argument('--receivers', type=int, default=20, help='Channels in the group')
+        parser.add_argument('--rate', type=float, default=0,
+                            help='Pace group sends per second (default: as fast as possible, latency under saturation)')
+
+    def handle(self, *args, **options):
+        socket_path = os.path.join(tempfile.mkdtemp(prefix='indrive-bench-'), 'channels.sock')
+        broker = subprocess.Popen(
+            [sys.executable, str(settings.BASE_DIR / 'manage.py'), 'run_channel_broker', '--socket', socket_path,
+             '--capacity', str(options['messages'])],
+            stdout=subprocess.DEVNULL,
+        )
+        try:
+            for _ in range(100):
+                if os.path.exists(socket_path):
+                    break
+                time.sleep(0.05)
+            else:
+                raise CommandError('Channel broker did not start')
+            capacity = options['messages']  # Nothing may be dropped while measuring
+            layers = {
+                # In-memory: one process, one layer
+                'in-memory': lambda: [InMemoryChannelLayer(capacity=capacity)] * 2,
+                # Unix socket: sender and receivers on separate connections, as separate workers would be
+                'unix-socket': lambda: [UnixSocketChannelLayer(path=socket_path, capacity=capacity)
+                                        for _ in range(2)],
+            }
+            self.stdout.write(f"{'layer':<14}{'group_send/s':>14}{'deliveries/s':>14}{'p50 ms':>10}{'p99 ms':>10}")
+            for name, make in layers.items():
+                sender, receiver = make()
+                result = asyncio.run(self.run(sender, receiver, options['messages'], options['receivers'], options['rate']))
+                self.stdout.write(f"{name:<14}{result[0]:>14.0f}{result[1]:>14.0f}{result[2]:>10.3f}{result[3]:>10.3f}")
+        finally:
+            broker.terminate()
+            broker.wait()
+
+    async def run(self, sender, receiver, messages, receivers, rate):
+        channels = [await receiver.new_channel() for _ in range(receivers)]
+        for channel in channels:
+            await receiver.group_add('bench', channel)
+        await asyncio.sleep(0.1)  # Let the memberships reach the broker
+        latencies = []
+
+        async def consume(channel):
+            for _ in range(messages):
+                message = await receiver.receive(channel)
+                latencies.append(time.perf_counter() - message['sent'])
+
+        consumers = [asyncio.ensure_future(consume(channel)) for channel in channels]
+        started = time.perf_counter()
+        for i in range(messages):
+            await sender.group_send('bench', {'type': 'location.update', 'n': i, 'sent': time.perf_counter(),
+                                              'latitude': 27.7172, 'longitude': 85.324})
+            if rate:
+                await asyncio.sleep(1 / rate)
+        sent = time.perf_counter()
+        await asyncio.wait_for(asyncio.gather(*consumers), timeout=120)
+        elapsed = time.perf_counter() - started
+        await sender.close()
+        await receiver.close()
+        return (messages / (sent - started), messages * receivers / elapsed,
+                percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000)
@@ -0,0 +1,97 @@
+import os
+import tempfile
+import threading
+import time
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from indrive.databases import postgres_database, sqlite_database
+from rides.models import Ride
+from users.models import User
+
+
+def percentile(samples, pct):
+    if not samples:
+        return float('nan')
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare concurrent ride-creation throughput under the database profiles of '
+        'indrive/databases.py. Each worker thread creates rides and lists its rider\'s rides, '
+        'like POST /api/rides/ followed by the rider history. Runs against throwaway databases.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--rides', type=int, default=200, help='Rides created per thread')
+        parser.add_argument('--postgres', action='store_true',
+                            help='Also run the postgres profile, configured from the POSTGRES_* variables')
+
+    def handle(self, *args, **options):
+        directory = tempfile.mkdtemp(prefix='indrive-bench-')
+        profiles = [
+            ('sqlite default', sqlite_database(os.path.join(directory, 'default.sqlite3'), tuned=False)),
+            ('sqlite tuned', sqlite_database(os.path.join(directory, 'tuned.sqlite3'))),
+        ]
+        if options['postgres']:
+            profiles.append(('postgres', postgres_database()))
+
+        self.stdout.write(f"{'profile':<16}{'rides/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+        for label, database in profiles:
+            alias = 'bench_' + label.replace(' ', '_')
+            database = dict(database, TEST={'NAME': database['NAME'] if 'sqlite' in database['ENGINE'] else None})
+            connections.settings[alias] = connections.configure_settings(
+                {'default': connections.settings['default'], alias: database})[alias]
+            creation = connections[alias].creation
+            test_name = creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            try:
+                rate, latencies, errors = self.run(alias, options['threads'], options['rides'])
+            finally:
+                connections.close_all()
+                creation.destroy_test_db(test_name, verbosity=0)
+            self.stdout.write(f"{label:<16}{rate:>10.0f}{percentile(latencies, 50) * 1000:>10.2f}"
+                              f"{percentile(latencies, 99) * 1000:>10.2f}{errors:>8}")
+
+    def run(self, alias, threads, rides):
+        User.objects.db_manager(alias).bulk_create(
+            [User(phone_number=f"96{i:08d}", role='rider') for i in range(threads)])
+        riders = list(User.objects.using(alias).order_by('id'))
+        latencies = []
+        errors = [0]
+        lock = threading.Lock()
+        start = threading.Barrier(threads)
+
+        def worker(rider):
+            own = []
+            start.wait()
+            try:
+                for _ in range(rides):
+                    began = time.perf_counter()
+                    try:
+                        with transaction.atomic(using=alias):
+                            Ride.objects.using(alias).create(
+                                rider=rider, pickup_location='Thamel', destination_location='Patan',
+                                pickup_latitude=27.7154, pickup_longitude=85.3123,
+                                destination_latitude=27.6766, destination_longitude=85.3149,
+                                proposed_fare=250)
+                        list(Ride.objects.using(alias).filter(rider=rider).order_by('-created_at')[:20])
+                    except Exception:
+                        with lock:
+                            errors[0] += 1
+                        continue
+                    own.append(time.perf_counter() - began)
+            finally:
+                connections[alias].close()
+            with lock:
+                latencies.extend(own)
+
+        workers = [threading.Thread(target=worker, args=(rider,)) for rider in riders]
+        began = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - began
+        return len(latencies) / elapsed, latencies, errors[0]
@@ -0,0 +1,80 @@
+import random
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from rides.geofence import edges, load
+
+
+def ray_cast(rings, latitude, longitude):
+    """Point in polygon over every edge, without the index"""
+    inside = False
+    for (lat1, lng1), (lat2, lng2) in edges(rings):
+        if (lat1 <= latitude < lat2 or lat2 <= latitude < lat1) and \
+                lng1 + (latitude - lat1) * (lng2 - lng1) / (lat2 - lat1) > longitude:
+            inside = not inside
+    return inside
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark rides.geofence: index build, then classification of random points around '
+        'the configured areas, checked against a plain ray cast over every edge of every area. '
+        '--point classifies given points instead.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', help='GeoJSON areas (default GEOFENCE_FILE)')
+        parser.add_argument('--cell-degrees', type=float, help='Index cell size (default GEOFENCE_CELL_DEGREES)')
+        parser.add_argument('--points', type=int, default=100000, help='Random points to classify')
+        parser.add_argument('--point', action='append', metavar='LAT,LNG', help='Classify a point (repeatable)')
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        began = time.perf_counter()
+        fence = load(options['file'] or settings.GEOFENCE_FILE, options['cell_degrees'])
+        build_ms = (time.perf_counter() - began) * 1000
+        if not fence.areas:
+            raise CommandError("No areas configured: every point is in service. Set GEOFENCE_FILE "
+                               "or pass --file (service_areas.example.geojson is a sample)")
+        self.stdout.write(f"{len(fence.areas)} areas, {len(fence)} cells ({fence.covered_share():.0%} "
+                          f"of entries covered, no test needed), built in {build_ms:.1f} ms")
+
+        if options['point']:
+            for point in options['point']:
+                try:
+                    latitude, longitude = map(float, point.split(','))
+                except ValueError:
+                    raise CommandError(f"Not a LAT,LNG point: {point}")
+                place = fence.classify(latitude, longitude)
+                self.stdout.write(f"  {latitude},{longitude}: {'in' if place.in_service else 'OUT OF'} service, "
+                                  f"area {place.service_area}, zones {', '.join(place.zones) or '-'}, "
+                                  f"fare x{place.fare_multiplier}")
+            return
+
+        # Points over the areas' bounds, a fifth wider on every side, so some are out of area
+        south = min(area.bounds[0] for area in fence.areas)
+        west = min(area.bounds[1] for area in fence.areas)
+        north = max(area.bounds[2] for area in fence.areas)
+        east = max(area.bounds[3] for area in fence.areas)
+        margin_lat, margin_lng = (north - south) / 5, (east - west) / 5
+        rng = random.Random(options['seed'])
+        points = [(rng.uniform(south - margin_lat, north + margin_lat), rng.uniform(west - margin_lng, east + margin_lng))
+                  for _ in range(options['points'])]
+
+        began = time.perf_counter()
+        places = [fence.classify(latitude, longitude) for latitude, longitude in points]
+        lookup_us = (time.perf_counter() - began) / len(points) * 1e6
+
+        began = time.perf_counter()
+        for (latitude, longitude), place in zip(points, places):
+            holding = [area for area in fence.areas if ray_cast(area.rings, latitude, longitude)]
+            service_area = next((area.id for area in holding if area.kind == 'service_area'), None)
+            zones = tuple(area.id for area in holding if area.kind == 'zone')
+            if (place.service_area, place.zones) != (service_area, zones):
+                raise CommandError(f"{latitude},{longitude}: the index says {place.service_area} {place.zones}, "
+                                   f"the ray cast {service_area} {zones}")
+        brute_us = (time.perf_counter() - began) / len(points) * 1e6
+
+        in_service = sum(place.in_service for place in places)
+        self.stdout.write(f"{len(points)} points, {in_service / len(points):.0%} in service: "
+                          f"{lookup_us:.2f} us per lookup, {brute_us:.2f} us by ray cast over every edge")
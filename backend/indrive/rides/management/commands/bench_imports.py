@@ -0,0 +1,95 @@
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# What each kind of process imports before it can do any work
+TARGETS = {
+    'setup': 'import django; django.setup()',  # Management commands, workers
+    'wsgi': 'import indrive.wsgi',
+    'asgi': 'import indrive.asgi',
+}
+
+# Median import time allowed per target, in milliseconds: about 25% above
+# what they take on a development machine. Raise them deliberately
+BUDGET_MS = {
+    'setup': 340,
+    'wsgi': 410,
+    'asgi': 410,
+}
+
+# Modules only the code paths that need them may import
+LAZY_MODULES = ['googlemaps', 'requests', 'cProfile', 'pyinstrument', 'numpy']
+
+
+def parse_importtime(output):
+    """``[(module, self_us, cumulative_us, depth)]`` from ``python -X importtime`` output"""
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return modules
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure the import time of a fresh process per entry point (django.setup, wsgi, asgi) '
+        'with python -X importtime, by top-level package. Fails when a median exceeds its '
+        'budget or a module that should load lazily (googlemaps, profilers...) is imported '
+        'at startup.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5, help='Fresh processes per target')
+        parser.add_argument('--top', type=int, default=8, help='Packages listed per target')
+        parser.add_argument('--target', choices=sorted(TARGETS), action='append',
+                            help='Only measure this target (repeatable)')
+        parser.add_argument('--no-budget', action='store_true', help='Report without failing')
+
+    def handle(self, *args, **options):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'indrive.settings'))
+        failures = []
+        for target in options['target'] or list(TARGETS):
+            totals, walls = [], []
+            packages = defaultdict(list)
+            imported = set()
+            for _ in range(options['runs']):
+                began = time.perf_counter()
+                result = subprocess.run([sys.executable, '-X', 'importtime', '-c', TARGETS[target]],
+                                        cwd=settings.BASE_DIR, env=env, capture_output=True, text=True)
+                walls.append(time.perf_counter() - began)
+                if result.returncode:
+                    raise CommandError(f"{target} failed to import:\n{result.stderr[-2000:]}")
+                modules = parse_importtime(result.stderr)
+                totals.append(sum(self_us for _, self_us, _, _ in modules) / 1000)
+                by_package = defaultdict(int)
+                for name, self_us, _, _ in modules:
+                    by_package[name.split('.')[0]] += self_us
+                    imported.add(name)
+                for package, self_us in by_package.items():
+                    packages[package].append(self_us / 1000)
+
+            median = statistics.median(totals)
+            budget = BUDGET_MS[target]
+            self.stdout.write(f"{target}: imports {median:.1f} ms (budget {budget} ms), "
+                              f"process {statistics.median(walls) * 1000:.1f} ms, median of {options['runs']}")
+            ranked = sorted(packages.items(), key=lambda item: statistics.median(item[1]), reverse=True)
+            for package, samples in ranked[:options['top']]:
+                self.stdout.write(f"  {package:<32}{statistics.median(samples):>8.1f} ms")
+            eager = [module for module in LAZY_MODULES if module in imported]
+            if eager:
+                failures.append(f"{target} imports {', '.join(eager)} at startup")
+            if median > budget:
+                failures.append(f"{target} imports take {median:.1f} ms, over the {budget} ms budget")
+
+        for failure in failures:
+            self.stderr.write(failure)
+        if failures and not options['no_budget']:
+            raise CommandError(f"{len(failures)} import time regression(s)")
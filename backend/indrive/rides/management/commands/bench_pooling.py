@@ -0,0 +1,69 @@
+import random
+import time
+from django.core.management.base import BaseCommand, CommandError
+from rides.geo import estimate_route
+from rides.pooling import PoolingIndex
+
+# Kathmandu valley, where the synthetic rides start and end
+BOUNDS = ((27.65, 27.75), (85.28, 85.38))
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark rides.pooling on synthetic concurrent ride requests between hotspots: index '
+        'build, candidate lookups for every ride and disjoint pairing, checked against a '
+        'brute-force comparison of a sample with every other ride.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rides', type=int, action='append',
+                            help='Open rides (repeatable, default 1000, 5000 and 10000)')
+        parser.add_argument('--hotspots', type=int, default=40, help='Places rides start and end near')
+        parser.add_argument('--sample', type=int, default=200, help='Rides checked by brute force')
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'rides':>7}{'index ms':>10}{'lookup us':>11}{'brute us':>10}"
+                          f"{'pairs':>7}{'pooled':>8}{'pairs ms':>10}")
+        for count in options['rides'] or [1000, 5000, 10000]:
+            self.run(count, options['hotspots'], options['sample'], random.Random(options['seed']))
+
+    def run(self, count, hotspots, sample, rng):
+        places = [(rng.uniform(*BOUNDS[0]), rng.uniform(*BOUNDS[1])) for _ in range(hotspots)]
+
+        def near(place):
+            return place[0] + rng.gauss(0, 0.004), place[1] + rng.gauss(0, 0.004)
+
+        rides = []
+        for ride_id in range(count):
+            pickup, destination = near(rng.choice(places)), near(rng.choice(places))
+            rides.append((ride_id, pickup, destination, estimate_route(pickup, destination)['polyline']))
+
+        index = PoolingIndex()
+        now = time.monotonic()
+        began = time.perf_counter()
+        for ride_id, pickup, destination, polyline in rides:
+            index.add(ride_id, pickup, destination, polyline, opened_at=now)
+        index_ms = (time.perf_counter() - began) * 1000
+
+        began = time.perf_counter()
+        found = {ride_id: index.candidates(ride_id) for ride_id, *_ in rides}
+        lookup_us = (time.perf_counter() - began) / count * 1e6
+
+        # Brute force: every other ride, through the same compatibility test
+        checked = rng.sample(range(count), min(sample, count))
+        began = time.perf_counter()
+        for ride_id in checked:
+            route = index._routes[ride_id]
+            expected = {match['ride_id'] for match in (
+                index._match(route, other) for other_id, other in index._routes.items() if other_id != ride_id
+            ) if match is not None}
+            if expected != {match['ride_id'] for match in found[ride_id]}:
+                raise CommandError(f"Ride {ride_id}: the index missed or invented candidates")
+        brute_us = (time.perf_counter() - began) / len(checked) * 1e6
+
+        began = time.perf_counter()
+        pairs = index.pairs()
+        pairs_ms = (time.perf_counter() - began) * 1000
+        self.stdout.write(f"{count:>7}{index_ms:>10.1f}{lookup_us:>11.1f}{brute_us:>10.1f}"
+                          f"{len(pairs):>7}{2 * len(pairs) / count:>8.1%}{pairs_ms:>10.1f}")
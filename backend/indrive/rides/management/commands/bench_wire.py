@@ -0,0 +1,88 @@
+import json
+import timeit
+from decimal import Decimal
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from indrive import codecs
+from indrive.codecs import JSON_CODEC, MSGPACK_CODEC, encode_frame
+from rides.models import Ride
+from rides.serializers import RideSerializer
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = 'Compare encode cost and bytes on the wire of the WebSocket frame formats'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20000)
+        parser.add_argument('--fanout', type=int, default=50,
+                            help='Recipients per broadcast, each socket encodes its own frame')
+
+    def handle(self, *args, **options):
+        if MSGPACK_CODEC is None:
+            raise CommandError('msgpack is not installed')
+
+        frames = {
+            'location_update': {
+                'type': 'location_update',
+                'latitude': 27.717245,
+                'longitude': 85.323961,
+                'user_id': '1842',
+                'ride_id': '90311',
+            },
+            'ride_update': {
+                'type': 'ride_update',
+                'content': self.sample_ride(),
+                'ride_id': '90311',
+                'seq': 17,
+            },
+        }
+
+        iterations = options['iterations']
+        fanout = options['fanout']
+        self.stdout.write(f"{'frame':<16}{'format':<18}{'bytes':>8}{'us/encode':>12}{'ms/fanout':>12}")
+        for name, payload in frames.items():
+            # Sequenced events are encoded once per broadcast and shared by the recipients
+            cache_key = ('bench', name) if 'seq' in payload else None
+            formats = [('json', JSON_CODEC, payload, cache_key), ('msgpack', MSGPACK_CODEC, payload, cache_key)]
+            if name == 'ride_update':
+                # What the consumer sent before: the ride as a JSON string inside JSON,
+                # re-encoded by every socket
+                legacy = dict(payload, content=json.dumps(payload['content'], cls=DjangoJSONEncoder))
+                formats.insert(0, ('json (nested str)', JSON_CODEC, legacy, None))
+            for label, codec, frame, key in formats:
+                size = len(codec.encode(frame))
+                per_encode = timeit.timeit(lambda: codec.encode(frame), number=iterations) / iterations
+
+                def broadcast():
+                    codecs._frame_cache.clear()
+                    for _ in range(fanout):
+                        encode_frame(codec, frame, key)
+                per_fanout = timeit.timeit(broadcast, number=max(iterations // fanout, 1)) / max(iterations // fanout, 1)
+                self.stdout.write(
+                    f"{name:<16}{label:<18}{size:>8}{per_encode * 1e6:>12.2f}{per_fanout * 1e3:>12.3f}"
+                )
+
+    def sample_ride(self):
+        # Unsaved instances: the serializer output is what matters, not the rows
+        rider = User(phone_number='+9779800000001', role='rider')
+        driver = User(phone_number='+9779800000002', role='driver', is_available=True)
+        now = timezone.now()
+        ride = Ride(
+            id=90311, rider=rider, driver=driver,
+            pickup_location='Thamel Marg, Kathmandu 44600, Nepal',
+            destination_location='Tribhuvan International Airport, Ring Rd, Kathmandu 44600, Nepal',
+            pickup_latitude=27.717245, pickup_longitude=85.311961,
+            destination_latitude=27.698132, destination_longitude=85.359128,
+            status='accepted', proposal_type='driver', created_at=now, accepted_at=now,
+            proposed_fare=Decimal('450.00'), final_fare=Decimal('520.00'),
+            eta_minutes=14, distance_km=6.8, estimated_duration=18,
+            driver_proposals=[
+                {'driver': 2, 'amount': '520.00', 'timestamp': now.isoformat(), 'message': ''},
+                {'driver': 7, 'amount': '560.00', 'timestamp': now.isoformat(), 'message': 'Near you'},
+            ],
+            accepted_proposal={'driver': 2, 'amount': '520.00', 'timestamp': now.isoformat(), 'message': ''},
+            route_polyline='s{|fDcvpnOb@cBz@mCl@uBn@iCxA{EbAgDt@aC`@qAdAeDpAeEv@_CZ}@`@eAXu@f@oA',
+        )
+        return dict(RideSerializer(ride).data)
@@ -0,0 +1,126 @@
+import contextlib
+import sqlite3
+import tempfile
+import time
+from collections import Counter
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test.utils import (override_settings, setup_databases, setup_test_environment,
+                               teardown_databases, teardown_test_environment)
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from indrive.databases import sqlite_database
+from rides.geo import FakeGeoProvider, set_geo_provider
+from users.models import User
+
+RIDE = {
+    'pickup_location': 'Thamel', 'destination_location': 'Patan',
+    'pickup_latitude': 27.7154, 'pickup_longitude': 85.3123,
+    'destination_latitude': 27.6766, 'destination_longitude': 85.3149,
+    'proposed_fare': '250.00',
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Check indrive.routers on a local primary + replica pair of throwaway SQLite databases. '
+        'The replica is a snapshot of the primary that only changes when the check "replicates", '
+        'so a read that went to the wrong database returns visibly stale data.'
+    )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('The check builds its replica by copying a SQLite primary')
+        primary = tempfile.NamedTemporaryFile(prefix='replica_check_', suffix='.sqlite3', delete=False)
+        replica = tempfile.NamedTemporaryFile(prefix='replica_check_', suffix='.sqlite3', delete=False)
+        primary.close()
+        replica.close()
+        self.replica_path = replica.name
+        connection.settings_dict['TEST']['NAME'] = primary.name
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        connections.settings['replica'] = connections.configure_settings(
+            {'default': connections.settings['default'], 'replica': sqlite_database(replica.name)})['replica']
+        set_geo_provider(FakeGeoProvider())
+        self.failures = 0
+        try:
+            with override_settings(DATABASE_REPLICAS=['replica'], REPLICA_STICKY_SECONDS=1):
+                self.check_routing()
+        finally:
+            connections['replica'].close()
+            del connections['replica']
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+        if self.failures:
+            raise CommandError(f'{self.failures} routing check(s) failed')
+        self.stdout.write(self.style.SUCCESS('Replica routing OK'))
+
+    def replicate(self):
+        """Bring the replica up to date with the primary, like streaming replication catching up"""
+        connections['replica'].close()
+        source, target = sqlite3.connect(connection.settings_dict['NAME']), sqlite3.connect(self.replica_path)
+        try:
+            source.backup(target)
+        finally:
+            source.close()
+            target.close()
+
+    def request(self, user, method, path, data=None):
+        """Returns the response and the number of queries each database ran for it"""
+        queries = Counter()
+
+        def counter(alias):
+            def wrapper(execute, sql, params, many, context):
+                queries[alias] += 1
+                return execute(sql, params, many, context)
+            return wrapper
+
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+        with contextlib.ExitStack() as stack:
+            for alias in ('default', 'replica'):
+                stack.enter_context(connections[alias].execute_wrapper(counter(alias)))
+            response = getattr(client, method)(path, data, format='json')
+        return response, queries
+
+    def expect(self, label, ok, queries):
+        self.stdout.write(f"{'PASS' if ok else 'FAIL'}  {label:<58} "
+                          f"primary={queries['default']:<3} replica={queries['replica']}")
+        self.failures += not ok
+
+    def check_routing(self):
+        rider = User.objects.create(phone_number='9700000001', role='rider')
+        driver = User.objects.create(phone_number='9700000002', role='driver', is_available=True,
+                                     is_online=True, current_location='27.7150,85.3120')
+        self.replicate()
+
+        response, queries = self.request(rider, 'get', '/api/rides/history/')
+        self.expect('history of a user who has not written reads the replica',
+                    response.status_code == 200 and not queries['default'] and queries['replica'], queries)
+
+        response, queries = self.request(rider, 'post', '/api/rides/', RIDE)
+        self.expect('ride request writes and reads the primary only',
+                    response.status_code == 201 and not queries['replica'], queries)
+        ride_id = response.data['id']
+
+        response, queries = self.request(rider, 'get', '/api/rides/history/')
+        self.expect('history right after the write sticks to the primary',
+                    response.status_code == 200 and len(response.data) == 1 and not queries['replica'], queries)
+
+        response, queries = self.request(driver, 'get', '/api/rides/feed/')
+        self.expect('feed of another user reads the (stale) replica',
+                    response.status_code == 200 and len(response.data) == 0 and not queries['default'], queries)
+
+        response, queries = self.request(driver, 'post', f'/api/rides/{ride_id}/driver-bid/', {'amount': '280.00'})
+        self.expect('bid on a ride the replica lacks reads the primary',
+                    response.status_code == 200 and not queries['replica'], queries)
+
+        time.sleep(1.1)
+        response, queries = self.request(rider, 'get', '/api/rides/history/')
+        self.expect('history once stickiness expired reads the replica',
+                    response.status_code == 200 and len(response.data) == 0 and not queries['default'], queries)
+
+        self.replicate()
+        response, queries = self.request(rider, 'get', '/api/rides/history/')
+        self.expect('history after replication sees the ride on the replica',
+                    response.status_code == 200 and len(response.data) == 1 and not queries['default'], queries)
@@ -0,0 +1,74 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from rides.estimates import calibrate, hourly_speeds, road_distance, trip_fields
+from rides.models import Ride, SpeedProfile
+
+COORDINATES = ('pickup_latitude', 'pickup_longitude', 'destination_latitude', 'destination_longitude')
+
+
+class Command(BaseCommand):
+    help = (
+        'Recalibrate the hour-of-day speed profiles of rides.estimates from the trip times of '
+        'completed rides, then fill in distance_km and estimated_duration of the rides that have '
+        'coordinates but no estimate yet, in chunks.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rides per query and update')
+        parser.add_argument('--min-samples', type=int, help='Trips an hour needs (default SPEED_PROFILE_MIN_SAMPLES)')
+        parser.add_argument('--skip-calibration', action='store_true', help='Keep the current profiles')
+        parser.add_argument('--skip-backfill', action='store_true', help='Only recalibrate')
+        parser.add_argument('--dry-run', action='store_true', help='Compute but do not save')
+
+    def handle(self, *args, **options):
+        speeds = None
+        if not options['skip_calibration']:
+            speeds = self.calibrate(options['chunk_size'], options['min_samples'], options['dry_run'])
+        if not options['skip_backfill']:
+            self.backfill(options['chunk_size'], hourly_speeds() if speeds is None else speeds, options['dry_run'])
+
+    def calibrate(self, chunk_size, min_samples, dry_run):
+        rides = (Ride.objects.filter(status='completed', started_at__isnull=False, completed_at__isnull=False,
+                                     **{f'{field}__isnull': False for field in COORDINATES})
+                 .values_list('started_at', 'completed_at', *COORDINATES)
+                 .iterator(chunk_size=chunk_size))
+        profiles = calibrate(
+            ((started_at, completed_at, road_distance((pickup_lat, pickup_lng), (dest_lat, dest_lng)))
+             for started_at, completed_at, pickup_lat, pickup_lng, dest_lat, dest_lng in rides),
+            min_samples)
+        for hour, (speed, trips) in sorted(profiles.items()):
+            self.stdout.write(f"  {hour:02d}:00  {speed:6.1f} km/h  {trips:>7} trips")
+        self.stdout.write(f"Calibrated {len(profiles)} of 24 hours" + (' (dry run)' if dry_run else ''))
+        if not dry_run:
+            with transaction.atomic():
+                # Hours that no longer have enough trips fall back to the default speed
+                SpeedProfile.objects.all().delete()
+                SpeedProfile.objects.bulk_create(
+                    SpeedProfile(hour=hour, speed_kmh=speed, trips=trips) for hour, (speed, trips) in profiles.items())
+        return {hour: speed for hour, (speed, _) in profiles.items()}
+
+    def backfill(self, chunk_size, speeds, dry_run):
+        missing = Ride.objects.filter(
+            Q(distance_km__isnull=True) | Q(estimated_duration__isnull=True),
+            **{f'{field}__isnull': False for field in COORDINATES},
+        ).only('created_at', 'distance_km', 'estimated_duration', *COORDINATES).order_by('pk')
+        last_pk = 0
+        filled = 0
+        while True:
+            rides = list(missing.filter(pk__gt=last_pk)[:chunk_size])
+            if not rides:
+                break
+            last_pk = rides[-1].pk
+            now = timezone.now()
+            for ride in rides:
+                for field, value in trip_fields(vars(ride), speeds, when=ride.created_at).items():
+                    setattr(ride, field, value)
+                # bulk_update skips Ride.save(): bump the ETag validators here
+                ride.version = F('version') + 1
+                ride.updated_at = now
+            if not dry_run:
+                Ride.objects.bulk_update(rides, ['distance_km', 'estimated_duration', 'version', 'updated_at'])
+            filled += len(rides)
+        self.stdout.write(f"Estimated {filled} rides" + (' (dry run)' if dry_run else ''))
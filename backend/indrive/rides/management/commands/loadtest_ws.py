@@ -0,0 +1,442 @@
+import asyncio
+import contextlib
+import json
+import os
+import random
+import resource
+import tempfile
+import time
+import urllib.request
+from collections import defaultdict, deque
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import HttpCommunicator, WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_databases, teardown_databases
+from django.urls import re_path
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chat.consumers import ChatConsumer
+from chat.models import ChatMessage
+from indrive.codecs import JSON_CODEC, MSGPACK_CODEC, MSGPACK_SUBPROTOCOL, decode_frame
+from rides.consumers import RideConsumer
+from rides.geo import FakeGeoProvider, set_geo_provider
+from rides.models import Ride
+from users.models import User
+
+PHONE_PREFIX = '+1555'  # Load test users, removed again after a real-socket run
+CITY_CENTER = (27.7172, 85.3240)
+
+
+def percentile(samples, pct):
+    if not samples:
+        return float('nan')
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def resident_memory():
+    """Resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:  # Not Linux: peak RSS is the closest cheap figure
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def random_point(spread=0.05):
+    return (CITY_CENTER[0] + random.uniform(-spread, spread),
+            CITY_CENTER[1] + random.uniform(-spread, spread))
+
+
+class TokenUserMiddleware:
+    """Puts the user owning ``?token=`` in the scope, standing in for the session auth of AuthMiddlewareStack"""
+
+    def __init__(self, app, users_by_token):
+        self.app = app
+        self.users_by_token = users_by_token
+
+    async def __call__(self, scope, receive, send):
+        token = parse_qs(scope['query_string'].decode()).get('token', [None])[0]
+        scope = dict(scope, user=self.users_by_token.get(token, AnonymousUser()))
+        return await self.app(scope, receive, send)
+
+
+class InProcessSocket:
+    """A WebSocket client talking to the ASGI app in this process"""
+
+    def __init__(self, application, path, subprotocols):
+        self.communicator = WebsocketCommunicator(application, path, subprotocols=subprotocols)
+
+    async def connect(self, timeout):
+        connected, _ = await self.communicator.connect(timeout)
+        return connected
+
+    async def send(self, frame):
+        if isinstance(frame, bytes):
+            await self.communicator.send_input({'type': 'websocket.receive', 'bytes': frame})
+        else:
+            await self.communicator.send_input({'type': 'websocket.receive', 'text': frame})
+
+    async def recv(self):
+        # Straight from the output queue: a timed-out receive_output() would kill the consumer
+        message = await self.communicator.output_queue.get()
+        if message['type'] != 'websocket.send':
+            return None
+        return decode_frame(message.get('text'), message.get('bytes'))
+
+    async def close(self):
+        with contextlib.suppress(Exception):
+            await self.communicator.disconnect(timeout=5)
+
+
+class RealSocket:
+    """A WebSocket client talking to a running server"""
+
+    def __init__(self, url, subprotocols):
+        self.url = url
+        self.subprotocols = subprotocols
+        self.ws = None
+
+    async def connect(self, timeout):
+        import websockets  # Only needed for --url
+        self.ws = await asyncio.wait_for(
+            websockets.connect(self.url, subprotocols=self.subprotocols or None, max_queue=None), timeout)
+        return True
+
+    async def send(self, frame):
+        await self.ws.send(frame)
+
+    async def recv(self):
+        try:
+            data = await self.ws.recv()
+        except Exception:
+            return None
+        return decode_frame(data, None) if isinstance(data, str) else decode_frame(None, data)
+
+    async def close(self):
+        with contextlib.suppress(Exception):
+            await self.ws.close()
+
+
+class Command(BaseCommand):
+    help = (
+        'Load test the ride and chat WebSockets: drivers sending location_ping, riders creating '
+        'rides over HTTP and chatting. Runs in-process against a throwaway test database with '
+        'a fake geo provider, or against a running server with --url.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--drivers', type=int, default=1000)
+        parser.add_argument('--riders', type=int, default=200,
+                            help='Each rider creates one ride, which gets one of the drivers')
+        parser.add_argument('--ping-rate', type=float, default=1.0,
+                            help='location_ping messages per second per driver')
+        parser.add_argument('--chat-rate', type=float, default=0.2,
+                            help='Chat messages per second per rider (0 disables chat sockets)')
+        parser.add_argument('--duration', type=float, default=10.0, help='Seconds of steady traffic')
+        parser.add_argument('--connect-concurrency', type=int, default=100)
+        parser.add_argument('--geo-latency-ms', type=float, default=0.0,
+                            help='Simulated round trip of the fake geo provider')
+        parser.add_argument('--msgpack', action='store_true', help='Negotiate the MessagePack subprotocol')
+        parser.add_argument('--url', help='ws://host:port of a running server instead of in-process')
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+
+    def handle(self, *args, **options):
+        if options['riders'] > options['drivers']:
+            raise CommandError('--riders cannot exceed --drivers')
+        if options['msgpack'] and MSGPACK_CODEC is None:
+            raise CommandError('msgpack is not installed')
+        self.options = options
+        self.codec = MSGPACK_CODEC if options['msgpack'] else JSON_CODEC
+        self.subprotocols = [MSGPACK_SUBPROTOCOL] if options['msgpack'] else []
+        self.real = bool(options['url'])
+        if self.real:
+            try:
+                import websockets  # noqa: F401
+            except ImportError:
+                raise CommandError('--url needs the "websockets" package')
+
+        old_config = None
+        if not self.real:
+            if connection.vendor == 'sqlite':
+                # A file rather than the shared-cache in-memory test database, which fails with
+                # "table is locked" once the consumers' DB thread and the HTTP views overlap
+                test_db = tempfile.NamedTemporaryFile(prefix='loadtest_', suffix='.sqlite3', delete=False)
+                test_db.close()
+                connection.settings_dict['TEST']['NAME'] = test_db.name
+            old_config = setup_databases(verbosity=0, interactive=False)
+            set_geo_provider(FakeGeoProvider(latency=options['geo_latency_ms'] / 1000))
+        try:
+            self.create_users()
+            # Consumers print on every connection; keep them from drowning the report
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                report = asyncio.run(self.run())
+        finally:
+            if self.real:
+                User.objects.filter(phone_number__startswith=PHONE_PREFIX).delete()
+            else:
+                teardown_databases(old_config, verbosity=0)
+        self.print_report(report)
+
+    def create_users(self):
+        User.objects.filter(phone_number__startswith=PHONE_PREFIX).delete()
+        users = []
+        for role, count, digit in (('driver', self.options['drivers'], 1), ('rider', self.options['riders'], 2)):
+            for i in range(count):
+                lat, lng = random_point()
+                user = User(phone_number=f'{PHONE_PREFIX}{digit}{i:07d}', role=role,
+                            is_available=role == 'driver', current_location=f'{lat},{lng}')
+                user.set_unusable_password()
+                users.append(user)
+        User.objects.bulk_create(users, batch_size=500)
+        users = list(User.objects.filter(phone_number__startswith=PHONE_PREFIX).order_by('phone_number'))
+        self.drivers = [u for u in users if u.role == 'driver']
+        self.riders = [u for u in users if u.role == 'rider']
+        self.tokens = {u.id: str(AccessToken.for_user(u)) for u in users}
+
+    def build_application(self):
+        users_by_token = {self.tokens[u.id]: u for u in self.drivers + self.riders}
+        return URLRouter([
+            re_path(r'ws/rides/', RideConsumer.as_asgi()),
+            re_path(r'ws/chat/(?P<ride_id>\w+)/$', TokenUserMiddleware(ChatConsumer.as_asgi(), users_by_token)),
+        ])
+
+    def open_socket(self, path):
+        if self.real:
+            return RealSocket(self.options['url'].rstrip('/') + path, self.subprotocols)
+        return InProcessSocket(self.ws_app, path, self.subprotocols)
+
+    async def run(self):
+        options = self.options
+        self.ws_app = None if self.real else self.build_application()
+        self.http_app = None if self.real else get_asgi_application()
+        self.connect_times = []
+        self.failed_connects = 0
+        stop = asyncio.Event()
+        lag_samples = []
+        lag_task = asyncio.ensure_future(self.monitor_loop_lag(lag_samples, stop))
+        limiter = asyncio.Semaphore(options['connect_concurrency'])
+
+        memory_before = resident_memory()
+
+        # Riders connect first so they see their rides being created and accepted
+        rider_sockets = await asyncio.gather(*(
+            self.connect(limiter, f'/ws/rides/?token={self.tokens[r.id]}') for r in self.riders))
+
+        ride_times = []
+        rides = await asyncio.gather(*(self.create_ride(limiter, rider, ride_times) for rider in self.riders))
+        ride_ids = [ride_id for ride_id in rides if ride_id is not None]
+        await database_sync_to_async(self.assign_drivers)(ride_ids)
+        ride_of_driver = {driver.id: ride_id for driver, ride_id in zip(self.drivers, ride_ids)}
+
+        driver_sockets = await asyncio.gather(*(
+            self.connect(limiter, f'/ws/rides/?token={self.tokens[d.id]}') for d in self.drivers))
+
+        chat_sockets = []
+        if options['chat_rate'] > 0 and not self.real:
+            chat_sockets = await asyncio.gather(*(
+                self.connect(limiter, f'/ws/chat/{ride_id}/?token={self.tokens[rider.id]}', greeting=False)
+                for rider, ride_id in zip(self.riders, ride_ids)))
+
+        connections = sum(1 for s in rider_sockets + driver_sockets + chat_sockets if s is not None)
+        memory_per_connection = None
+        if not self.real:
+            memory_per_connection = (resident_memory() - memory_before) / max(connections, 1)
+
+        # Steady traffic: every driver pings, riders chat with their driver
+        pending_pings = defaultdict(deque)  # ride_id -> send times, delivered in order
+        ping_latencies, chat_latencies = [], []
+        counters = defaultdict(int)
+        tasks = []
+        for driver, socket in zip(self.drivers, driver_sockets):
+            if socket is not None:
+                ride_id = ride_of_driver.get(driver.id)
+                tasks.append(self.drive(socket, ride_id, pending_pings, counters, stop))
+                tasks.append(self.drain(socket, stop))
+        for socket in rider_sockets:
+            if socket is not None:
+                tasks.append(self.watch_ride(socket, pending_pings, ping_latencies, counters, stop))
+        driver_of_ride = {ride_id: driver_id for driver_id, ride_id in ride_of_driver.items()}
+        for socket, ride_id in zip(chat_sockets, ride_ids):
+            if socket is not None:
+                tasks.append(self.chat(socket, driver_of_ride[ride_id], chat_latencies, counters, stop))
+        running = [asyncio.ensure_future(task) for task in tasks]
+
+        await asyncio.sleep(options['duration'])
+        stop.set()
+        await asyncio.sleep(0.5)  # Let in-flight messages land
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        await lag_task
+        await asyncio.gather(*(s.close() for s in rider_sockets + driver_sockets + chat_sockets if s is not None))
+        chats_stored = None if self.real else await database_sync_to_async(ChatMessage.objects.count)()
+
+        ms = lambda seconds: round(seconds * 1000, 3)
+        return {
+            'mode': 'socket' if self.real else 'in-process',
+            'format': 'msgpack' if options['msgpack'] else 'json',
+            'connections': connections,
+            'failed_connects': self.failed_connects,
+            'connect_ms': {'p50': ms(percentile(self.connect_times, 50)),
+                           'p99': ms(percentile(self.connect_times, 99))},
+            'ride_create_ms': {'count': len(ride_times), 'p50': ms(percentile(ride_times, 50)),
+                               'p99': ms(percentile(ride_times, 99))},
+            'pings': counters['pings'],
+            'location_delivery_ms': {'sent': counters['ride_pings'], 'delivered': len(ping_latencies),
+                                     'p50': ms(percentile(ping_latencies, 50)),
+                                     'p99': ms(percentile(ping_latencies, 99))},
+            'chat_delivery_ms': {'sent': counters['chats'], 'delivered': len(chat_latencies),
+                                 'p50': ms(percentile(chat_latencies, 50)),
+                                 'p99': ms(percentile(chat_latencies, 99)), 'stored': chats_stored},
+            'loop_lag_ms': {'p50': ms(percentile(lag_samples, 50)), 'p99': ms(percentile(lag_samples, 99)),
+                            'max': ms(max(lag_samples, default=0))},
+            'memory_per_connection_kib': (round(memory_per_connection / 1024, 1)
+                                          if memory_per_connection is not None else None),
+        }
+
+    async def connect(self, limiter, path, greeting=True):
+        async with limiter:
+            socket = self.open_socket(path)
+            started = time.perf_counter()
+            try:
+                if not await socket.connect(timeout=30):
+                    raise ConnectionError(path)
+                if greeting:
+                    await asyncio.wait_for(socket.recv(), 30)  # websocket.connected
+            except Exception:
+                self.failed_connects += 1
+                return None
+            self.connect_times.append(time.perf_counter() - started)
+            return socket
+
+    async def create_ride(self, limiter, rider, ride_times):
+        pickup, destination = random_point(), random_point()
+        body = json.dumps({
+            'pickup_location': 'Pickup', 'destination_location': 'Destination',
+            'pickup_latitude': pickup[0], 'pickup_longitude': pickup[1],
+            'destination_latitude': destination[0], 'destination_longitude': destination[1],
+            'proposed_fare': '350.00',
+        }).encode()
+        headers = [(b'content-type', b'application/json'),
+                   (b'content-length', str(len(body)).encode()),
+                   (b'authorization', f'Bearer {self.tokens[rider.id]}'.encode())]
+        async with limiter:
+            started = time.perf_counter()
+            if self.real:
+                status, data = await asyncio.to_thread(self.post_ride, body, dict(
+                    (k.decode(), v.decode()) for k, v in headers))
+            else:
+                communicator = HttpCommunicator(self.http_app, 'POST', '/api/rides/', body=body, headers=headers)
+                response = await communicator.get_response(timeout=60)
+                status, data = response['status'], response['body']
+            if status != 201:
+                return None
+            ride_times.append(time.perf_counter() - started)
+            return json.loads(data)['id']
+
+    def post_ride(self, body, headers):
+        url = self.options['url'].replace('ws', 'http', 1).rstrip('/') + '/api/rides/'
+        request = urllib.request.Request(url, data=body, headers=headers, method='POST')
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                return response.status, response.read()
+        except Exception:
+            return None, None
+
+    def assign_drivers(self, ride_ids):
+        rides = list(Ride.objects.filter(id__in=ride_ids))
+        drivers = {ride_id: driver for ride_id, driver in zip(ride_ids, self.drivers)}
+        for ride in rides:
+            ride.driver = drivers[ride.id]
+            ride.status = 'accepted'
+        Ride.objects.bulk_update(rides, ['driver', 'status'], batch_size=500)
+
+    async def drive(self, socket, ride_id, pending_pings, counters, stop):
+        interval = 1 / self.options['ping_rate']
+        await asyncio.sleep(random.random() * interval)  # Spread drivers over the interval
+        lat, lng = random_point()
+        while not stop.is_set():
+            lat, lng = lat + random.uniform(-1e-4, 1e-4), lng + random.uniform(-1e-4, 1e-4)
+            ping = {'type': 'location_ping', 'latitude': lat, 'longitude': lng}
+            if ride_id is not None:
+                ping['ride_id'] = str(ride_id)
+                pending_pings[str(ride_id)].append(time.perf_counter())
+                counters['ride_pings'] += 1
+            await socket.send(self.codec.encode(ping))
+            counters['pings'] += 1
+            await asyncio.sleep(interval)
+
+    async def drain(self, socket, stop):
+        while not stop.is_set():
+            if await socket.recv() is None:
+                return
+
+    async def watch_ride(self, socket, pending_pings, latencies, counters, stop):
+        while True:
+            message = await socket.recv()
+            if message is None:
+                return
+            if message.get('type') == 'location_update':
+                sent = pending_pings[str(message.get('ride_id'))]
+                if sent:
+                    latencies.append(time.perf_counter() - sent.popleft())
+
+    async def chat(self, socket, driver_id, latencies, counters, stop):
+        pending = deque()
+
+        async def read():
+            while True:
+                message = await socket.recv()
+                if message is None:
+                    return
+                if message.get('type') == 'chat_message' and pending:
+                    latencies.append(time.perf_counter() - pending.popleft())
+
+        reader = asyncio.ensure_future(read())
+        interval = 1 / self.options['chat_rate']
+        try:
+            await asyncio.sleep(random.random() * interval)
+            while not stop.is_set():
+                pending.append(time.perf_counter())
+                await socket.send(self.codec.encode({'message': 'On my way', 'recipient_id': driver_id}))
+                counters['chats'] += 1
+                await asyncio.sleep(interval)
+            await asyncio.sleep(0.5)
+        finally:
+            reader.cancel()
+
+    async def monitor_loop_lag(self, samples, stop, interval=0.01):
+        loop = asyncio.get_running_loop()
+        while not stop.is_set():
+            started = loop.time()
+            await asyncio.sleep(interval)
+            samples.append(loop.time() - started - interval)
+
+    def print_report(self, report):
+        if self.options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        self.stdout.write(f"mode: {report['mode']}, format: {report['format']}, "
+                          f"connections: {report['connections']} ({report['failed_connects']} failed)")
+        self.stdout.write(f"connect setup      p50 {report['connect_ms']['p50']} ms, "
+                          f"p99 {report['connect_ms']['p99']} ms")
+        self.stdout.write(f"location pings     {report['pings']} total")
+        rides = report['ride_create_ms']
+        self.stdout.write(f"ride creation      {rides['count']} rides, p50 {rides['p50']} ms, p99 {rides['p99']} ms")
+        for label, key in (('location delivery', 'location_delivery_ms'), ('chat delivery', 'chat_delivery_ms')):
+            stats = report[key]
+            self.stdout.write(f"{label:<19}{stats['delivered']}/{stats['sent']} delivered, "
+                              f"p50 {stats['p50']} ms, p99 {stats['p99']} ms")
+        if report['chat_delivery_ms']['stored'] is not None:
+            self.stdout.write(f"chat persistence   {report['chat_delivery_ms']['stored']} messages stored")
+        lag = report['loop_lag_ms']
+        self.stdout.write(f"event loop lag     p50 {lag['p50']} ms, p99 {lag['p99']} ms, max {lag['max']} ms")
+        if report['memory_per_connection_kib'] is not None:
+            self.stdout.write(f"memory/connection  {report['memory_per_connection_kib']} KiB")
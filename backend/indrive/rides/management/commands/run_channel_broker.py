@@ -0,0 +1,27 @@
+import asyncio
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from indrive.layers import ChannelBroker
+
+
+class Command(BaseCommand):
+    help = 'Run the local broker the worker processes share through indrive.layers.UnixSocketChannelLayer'
+
+    def add_arguments(self, parser):
+        config = settings.CHANNEL_LAYERS['default'].get('CONFIG', {})
+        parser.add_argument('--socket', default=config.get('path', '/tmp/indrive-channels.sock'))
+        parser.add_argument('--capacity', type=int, default=config.get('capacity', 100))
+        parser.add_argument('--expiry', type=int, default=config.get('expiry', 60))
+        parser.add_argument('--group-expiry', type=int, default=config.get('group_expiry', 86400))
+        parser.add_argument('--max-buffer', type=int, default=4 * 1024 * 1024,
+                            help='Bytes waiting for a worker before messages to it are dropped')
+
+    def handle(self, *args, **options):
+        broker = ChannelBroker(options['socket'], capacity=options['capacity'],
+                               expiry=options['expiry'], group_expiry=options['group_expiry'],
+                               max_buffer=options['max_buffer'])
+        self.stdout.write(f"Channel broker listening on {options['socket']}")
+        try:
+            asyncio.run(broker.serve_forever())
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 14:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0002_rename_fare_ride_final_fare_ride_accepted_proposal_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ride',
+            name='driver_rating',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+    ]
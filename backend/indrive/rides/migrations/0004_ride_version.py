@@ -0,0 +1,32 @@
+# Generated by Django 4.2.30 on 2026-10-19 15:10
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def add_archive_columns(apps, schema_editor):
+    # Archive tables created before this lack the new Ride columns
+    from rides.archive import add_missing_columns
+    add_missing_columns(schema_editor.connection, apps.get_model('rides', 'Ride'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0003_ride_driver_rating'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ride',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='ride',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.RunPython(add_archive_columns, migrations.RunPython.noop),
+    ]
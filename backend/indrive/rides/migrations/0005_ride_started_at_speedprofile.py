@@ -0,0 +1,34 @@
+# Generated by Django 4.2.30 on 2026-10-19 15:19
+
+from django.db import migrations, models
+
+
+def add_archive_columns(apps, schema_editor):
+    # Archive tables created before this lack started_at
+    from rides.archive import add_missing_columns
+    add_missing_columns(schema_editor.connection, apps.get_model('rides', 'Ride'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0004_ride_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpeedProfile',
+            fields=[
+                ('hour', models.PositiveSmallIntegerField(primary_key=True, serialize=False)),
+                ('speed_kmh', models.FloatField()),
+                ('trips', models.PositiveIntegerField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='ride',
+            name='started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(add_archive_columns, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.30 on 2026-10-19 15:32
+
+from django.db import migrations, models
+
+
+def add_archive_columns(apps, schema_editor):
+    # Archive tables created before this lack the zone columns
+    from rides.archive import add_missing_columns
+    add_missing_columns(schema_editor.connection, apps.get_model('rides', 'Ride'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0005_ride_started_at_speedprofile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ride',
+            name='destination_zone',
+            field=models.CharField(blank=True, max_length=50, null=True),
+        ),
+        migrations.AddField(
+            model_name='ride',
+            name='pickup_zone',
+            field=models.CharField(blank=True, max_length=50, null=True),
+        ),
+        migrations.RunPython(add_archive_columns, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-19 15:46
+
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0006_ride_zones'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RideEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.PositiveIntegerField()),
+                ('group', models.CharField(max_length=100)),
+                ('event', models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('ride', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='rides.ride')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['ride', 'seq'], name='rides_ridee_ride_id_3a6eeb_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-19 15:50
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('rides', '0007_ride_event'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedDriverResponse',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('notified_at', models.DateTimeField()),
+                ('response_time', models.FloatField()),
+                ('driver', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['notified_at'], name='rides_archi_notifie_6d8972_idx')],
+            },
+        ),
+    ]
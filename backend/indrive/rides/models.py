@@ -1,5 +1,9 @@
-from django.db import models
+from django.db import models, router, transaction
+from django.db.models.signals import post_save
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from .heatmap import heatmap
+from .pooling import pool
 
 class Ride(models.Model):
     RIDE_STATUS_CHOICES = (
@@ -25,12 +29,16 @@ class Ride(models.Model):
     pickup_longitude = models.FloatField(null=True, blank=True)
     destination_latitude = models.FloatField(null=True, blank=True)
     destination_longitude = models.FloatField(null=True, blank=True)
+    # Zones of the pickup and destination (rides.geofence), for matching and pricing
+    pickup_zone = models.CharField(max_length=50, null=True, blank=True)
+    destination_zone = models.CharField(max_length=50, null=True, blank=True)
     
     status = models.CharField(max_length=20, choices=RIDE_STATUS_CHOICES, default='requested')
     proposal_type = models.CharField(max_length=10, choices=PROPOSAL_TYPES, default='passenger')
     
     created_at = models.DateTimeField(auto_now_add=True)
     accepted_at = models.DateTimeField(null=True, blank=True)
+    started_at = models.DateTimeField(null=True, blank=True)
     completed_at = models.DateTimeField(null=True, blank=True)
     
     proposed_fare = models.DecimalField(max_digits=8, decimal_places=2, default=0.00)
@@ -50,9 +58,40 @@ class Ride(models.Model):
     # Encoded polyline for the route
     route_polyline = models.TextField(null=True, blank=True)
 
+    # 1-5 stars the rider gave the driver after the ride
+    driver_rating = models.PositiveSmallIntegerField(null=True, blank=True)
+
+    # Bumped by every change, for ETags (rides.conditional)
+    version = models.PositiveIntegerField(default=1)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, 'version', 'updated_at'}
+        if self._state.adding:
+            return super().save(*args, **kwargs)
+        # Bumped in SQL and read back in the same transaction: the UPDATE holds the row
+        # until commit, so a concurrent save can't write or read the same version
+        self.version = models.F('version') + 1
+        using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+        with transaction.atomic(using=using):
+            super().save(*args, **kwargs)
+            self.refresh_from_db(using=using, fields=['version'])
+
     def __str__(self):
         return f"Ride from {self.pickup_location} to {self.destination_location} (Status: {self.status})"
 
+class SpeedProfile(models.Model):
+    """Average speed of the trips started in an hour of the day, for rides.estimates"""
+    hour = models.PositiveSmallIntegerField(primary_key=True)  # 0-23, TIME_ZONE
+    speed_kmh = models.FloatField()  # Estimated road km per hour driven
+    trips = models.PositiveIntegerField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.hour:02d}:00 {self.speed_kmh:.1f} km/h ({self.trips} trips)"
+
 class DriverNotification(models.Model):
     driver = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     ride = models.ForeignKey('Ride', on_delete=models.CASCADE)
@@ -67,3 +106,32 @@ class DriverNotification(models.Model):
             models.Index(fields=['driver', 'responded']),
             models.Index(fields=['score'])
         ]
+
+class ArchivedDriverResponse(models.Model):
+    """A responded ``DriverNotification`` of an archived ride, kept for backfill_driver_stats"""
+    driver = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    notified_at = models.DateTimeField()  # The notification's created_at
+    response_time = models.FloatField()  # Seconds to respond
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['notified_at'])
+        ]
+
+class RideEvent(models.Model):
+    """A ride_update/bid_update as published, for clients resuming the stream (rides.streams)"""
+    ride = models.ForeignKey('Ride', on_delete=models.CASCADE, related_name='events')
+    seq = models.PositiveIntegerField()  # Ride.version after the save the event reports
+    group = models.CharField(max_length=100)  # Channel layer group it was sent to
+    event = models.JSONField(encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['ride', 'seq'])
+        ]
+
+# Open rides and busy drivers, for the supply/demand heatmap
+post_save.connect(heatmap.ride_saved, sender=Ride, dispatch_uid='rides.heatmap')
+# Open rides' routes, for pooling candidates
+post_save.connect(pool.ride_saved, sender=Ride, dispatch_uid='rides.pooling')
@@ -0,0 +1,202 @@
+"""
+Shared-ride pooling: finding open ride requests that one driver could take
+together.
+
+Each ``requested`` ride's ``route_polyline`` is reduced to the set of
+``POOL_CELL_DEGREES`` grid cells it passes through, and the ride is indexed
+by the coarse buckets (as large as the smaller proximity limit) its pickup
+and destination fall in. Two rides are a pooling candidate when
+
+* their pickups are within ``POOL_PICKUP_KM`` of each other,
+* their destinations are within ``POOL_DESTINATION_KM``,
+* ``POOL_MIN_OVERLAP`` of the shorter route's cells are on the other route,
+* and they were requested within ``POOL_WINDOW_SECONDS`` of each other.
+
+A lookup only compares a ride with the rides in the buckets around both its
+pickup and its destination, so finding the candidates of every open ride
+stays near-linear in their number. ``pool`` is kept up to date from
+``Ride`` saves, like ``rides.heatmap`` (and, like it, per process); dispatch
+offers a new ride's candidates along with it. ``manage.py bench_pooling``
+measures it.
+"""
+import math
+import threading
+import time
+from collections import deque
+from django.conf import settings
+from .geo import decode_polyline
+
+KM_PER_DEGREE = 111.32
+
+
+def flat_km(a, b):
+    """Distance between two ``(lat, lng)`` points, on a flat earth: within
+    metres of haversine over the few kilometres pooling compares"""
+    dlat = a[0] - b[0]
+    dlng = (a[1] - b[1]) * math.cos(math.radians((a[0] + b[0]) / 2))
+    return math.hypot(dlat, dlng) * KM_PER_DEGREE
+
+
+def route_cells(points, cell_degrees):
+    """The cells a route through ``points`` passes, as a frozenset"""
+    cells = set()
+    for (lat1, lng1), (lat2, lng2) in zip(points, points[1:]):
+        # Sample each segment at least twice per cell so no crossed cell is skipped
+        steps = max(1, math.ceil(max(abs(lat2 - lat1), abs(lng2 - lng1)) / cell_degrees * 2))
+        for step in range(steps + 1):
+            fraction = step / steps
+            cells.add((math.floor((lat1 + (lat2 - lat1) * fraction) / cell_degrees),
+                       math.floor((lng1 + (lng2 - lng1) * fraction) / cell_degrees)))
+    if len(points) == 1:
+        cells.add((math.floor(points[0][0] / cell_degrees), math.floor(points[0][1] / cell_degrees)))
+    return frozenset(cells)
+
+
+class Route:
+    __slots__ = ('ride_id', 'pickup', 'destination', 'cells', 'key', 'opened_at')
+
+    def __init__(self, ride_id, pickup, destination, cells, key, opened_at):
+        self.ride_id = ride_id
+        self.pickup = pickup
+        self.destination = destination
+        self.cells = cells
+        self.key = key  # (pickup bucket, destination bucket)
+        self.opened_at = opened_at
+
+
+class PoolingIndex:
+    def __init__(self, cell_degrees=None, pickup_km=None, destination_km=None, min_overlap=None, window=None):
+        self.cell_degrees = cell_degrees or settings.POOL_CELL_DEGREES
+        self.pickup_km = pickup_km or settings.POOL_PICKUP_KM
+        self.destination_km = destination_km or settings.POOL_DESTINATION_KM
+        self.min_overlap = min_overlap or settings.POOL_MIN_OVERLAP
+        self.window = window or settings.POOL_WINDOW_SECONDS
+        self.bucket_degrees = min(self.pickup_km, self.destination_km) / KM_PER_DEGREE
+        self._routes = {}  # ride_id -> Route
+        self._buckets = {}  # pickup bucket -> destination bucket -> {ride_id}
+        self._log = deque()  # (opened at, ride_id), oldest first
+        self._lock = threading.Lock()
+
+    def bucket(self, point):
+        return math.floor(point[0] / self.bucket_degrees), math.floor(point[1] / self.bucket_degrees)
+
+    def around(self, point, km):
+        """The buckets within ``km`` of ``point``"""
+        row, column = self.bucket(point)
+        rows = math.ceil(km / (self.bucket_degrees * KM_PER_DEGREE))
+        # A degree of longitude is shorter away from the equator
+        columns = math.ceil(km / (self.bucket_degrees * KM_PER_DEGREE * max(math.cos(math.radians(point[0])), 0.01)))
+        return [(r, c) for r in range(row - rows, row + rows + 1) for c in range(column - columns, column + columns + 1)]
+
+    def add(self, ride_id, pickup, destination, polyline, opened_at=None):
+        """Index an open ride; ``pickup`` and ``destination`` are ``(lat, lng)``"""
+        opened_at = time.monotonic() if opened_at is None else opened_at
+        pickup, destination = tuple(map(float, pickup)), tuple(map(float, destination))
+        route = Route(ride_id, pickup, destination, route_cells(decode_polyline(polyline), self.cell_degrees),
+                      (self.bucket(pickup), self.bucket(destination)), opened_at)
+        with self._lock:
+            self._expire(opened_at)
+            self._remove(ride_id)
+            self._routes[ride_id] = route
+            self._buckets.setdefault(route.key[0], {}).setdefault(route.key[1], set()).add(ride_id)
+            self._log.append((opened_at, ride_id))
+
+    def remove(self, ride_id):
+        with self._lock:
+            self._remove(ride_id)
+
+    def __len__(self):
+        return len(self._routes)
+
+    def candidates(self, ride_id, limit=None):
+        """The rides ``ride_id`` could be pooled with, best first:
+        ``[{'ride_id', 'overlap', 'pickup_km', 'destination_km'}]``"""
+        with self._lock:
+            self._expire(time.monotonic())
+            route = self._routes.get(ride_id)
+            if route is None:
+                return []
+            others = [self._routes[other_id] for other_id in self._nearby(route) if other_id != ride_id]
+        matches = []
+        for other in others:
+            match = self._match(route, other)
+            if match is not None:
+                matches.append(match)
+        matches.sort(key=lambda match: (-match['overlap'], match['pickup_km'] + match['destination_km']))
+        return matches[:limit]
+
+    def pairs(self, per_ride=5):
+        """Disjoint pooling pairs among all open rides, best first (greedy over
+        each ride's ``per_ride`` best candidates)"""
+        scored = []
+        for ride_id in list(self._routes):
+            for match in self.candidates(ride_id, limit=per_ride):
+                if ride_id < match['ride_id']:
+                    scored.append((match['overlap'], -(match['pickup_km'] + match['destination_km']),
+                                   ride_id, match['ride_id']))
+        scored.sort(reverse=True)
+        paired, pairs = set(), []
+        for _, _, first, second in scored:
+            if first not in paired and second not in paired:
+                paired.update((first, second))
+                pairs.append((first, second))
+        return pairs
+
+    def ride_saved(self, sender, instance, **kwargs):
+        """``post_save`` receiver for ``Ride``"""
+        if instance.status != 'requested':
+            self.remove(instance.id)
+        elif instance.id not in self._routes and instance.route_polyline and None not in (
+                instance.pickup_latitude, instance.pickup_longitude,
+                instance.destination_latitude, instance.destination_longitude):
+            self.add(instance.id, (instance.pickup_latitude, instance.pickup_longitude),
+                     (instance.destination_latitude, instance.destination_longitude), instance.route_polyline)
+
+    def _nearby(self, route):
+        destinations = None
+        for pickup_bucket in self.around(route.pickup, self.pickup_km):
+            by_destination = self._buckets.get(pickup_bucket)
+            if by_destination is None:
+                continue
+            if destinations is None:
+                destinations = self.around(route.destination, self.destination_km)
+            for destination_bucket in destinations:
+                yield from by_destination.get(destination_bucket, ())
+
+    def _match(self, route, other):
+        if abs(route.opened_at - other.opened_at) > self.window:
+            return None
+        pickup_km = flat_km(route.pickup, other.pickup)
+        if pickup_km > self.pickup_km:
+            return None
+        destination_km = flat_km(route.destination, other.destination)
+        if destination_km > self.destination_km:
+            return None
+        shorter, longer = sorted((route.cells, other.cells), key=len)
+        overlap = len(shorter & longer) / len(shorter)
+        if overlap < self.min_overlap:
+            return None
+        return {'ride_id': other.ride_id, 'overlap': round(overlap, 3),
+                'pickup_km': round(pickup_km, 3), 'destination_km': round(destination_km, 3)}
+
+    def _remove(self, ride_id):
+        route = self._routes.pop(ride_id, None)
+        if route is not None:
+            by_destination = self._buckets[route.key[0]]
+            rides = by_destination[route.key[1]]
+            rides.discard(ride_id)
+            if not rides:
+                del by_destination[route.key[1]]
+                if not by_destination:
+                    del self._buckets[route.key[0]]
+
+    def _expire(self, now):
+        cutoff = now - self.window
+        while self._log and self._log[0][0] < cutoff:
+            opened_at, ride_id = self._log.popleft()
+            route = self._routes.get(ride_id)
+            if route is not None and route.opened_at == opened_at:
+                self._remove(ride_id)
+
+
+pool = PoolingIndex()
@@ -0,0 +1,115 @@
+"""
+Driver presence.
+
+A driver is online while their app shows signs of life over the ride
+WebSocket: connecting, any message (``ping`` heartbeats, location pings) and
+disconnecting all refresh their entry in the in-memory ``presence`` table.
+Drivers silent for longer than ``PRESENCE_GRACE_SECONDS`` drop out of it.
+
+The table is written back to ``User.is_online`` / ``last_seen_at`` /
+``current_location`` every ``PRESENCE_FLUSH_SECONDS`` by a sweeper task, in a
+handful of bulk UPDATEs whatever the number of drivers. Going offline is
+decided from ``last_seen_at`` in the database, so a driver who reconnects to
+another worker process (or whose worker died) is handled correctly.
+"""
+import asyncio
+import logging
+import threading
+import time
+from datetime import timedelta
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.utils import timezone
+from users.models import User
+from .utils import parse_coordinates
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceTable:
+    def __init__(self, grace=None, flush_interval=None):
+        self.grace = grace or settings.PRESENCE_GRACE_SECONDS
+        self.flush_interval = flush_interval or settings.PRESENCE_FLUSH_SECONDS
+        self._seen = {}  # user_id -> monotonic time of the last sign of life
+        self._touched = set()  # Seen since the last flush
+        self._locations = {}  # user_id -> "lat,lng" reported since the last flush
+        self._lock = threading.Lock()
+        self._sweeper = None
+
+    def connect(self, user_id):
+        with self._lock:
+            self._touch(user_id)
+
+    def disconnect(self, user_id):
+        """The driver stays online for the grace period, in case they reconnect"""
+        with self._lock:
+            self._touch(user_id)
+
+    def heartbeat(self, user_id, latitude=None, longitude=None):
+        """A sign of life; a valid location also becomes the driver's current_location"""
+        location = parse_coordinates(latitude, longitude)
+        with self._lock:
+            self._touch(user_id)
+            if location is not None:
+                self._locations[user_id] = f"{location[0]},{location[1]}"
+
+    def _touch(self, user_id):
+        self._seen[user_id] = time.monotonic()
+        self._touched.add(user_id)
+
+    def is_online(self, user_id):
+        with self._lock:
+            seen = self._seen.get(user_id)
+            return seen is not None and time.monotonic() - seen <= self.grace
+
+    def expire(self):
+        """Forget drivers silent for longer than the grace period; returns their ids"""
+        cutoff = time.monotonic() - self.grace
+        with self._lock:
+            expired = [user_id for user_id, seen in self._seen.items() if seen < cutoff]
+            for user_id in expired:
+                del self._seen[user_id]
+        return expired
+
+    def flush(self):
+        """Write the changes since the last flush to the database (blocking)"""
+        self.expire()
+        with self._lock:
+            touched, self._touched = self._touched, set()
+            locations, self._locations = self._locations, {}
+        now = timezone.now()
+        try:
+            if touched:
+                User.objects.filter(id__in=touched).update(is_online=True, last_seen_at=now)
+            if locations:
+                User.objects.bulk_update(
+                    [User(id=user_id, current_location=location) for user_id, location in locations.items()],
+                    ['current_location'], batch_size=500
+                )
+        except Exception:
+            # Retried on the next flush; locations reported since then are newer
+            with self._lock:
+                self._touched |= touched
+                self._locations = {**locations, **self._locations}
+            raise
+        # Also catches drivers whose worker process died without a disconnect
+        return User.objects.filter(
+            is_online=True, last_seen_at__lt=now - timedelta(seconds=self.grace)
+        ).update(is_online=False)
+
+    def ensure_sweeper(self):
+        """Start the flush loop on the running event loop if it is not running yet"""
+        loop = asyncio.get_running_loop()
+        if self._sweeper is None or self._sweeper.done() or self._sweeper.get_loop() is not loop:
+            self._sweeper = loop.create_task(self.sweep())
+
+    async def sweep(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await database_sync_to_async(self.flush)()
+            except Exception:
+                logger.exception("Presence flush failed")
+
+
+presence = PresenceTable()
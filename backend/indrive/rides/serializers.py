@@ -1,10 +1,71 @@
+import logging
+import asyncio
+from asgiref.sync import sync_to_async
 from rest_framework import serializers
 from .models import Ride
 from users.serializers import UserSerializer
 from .utils import get_human_readable_address
+from .geo import get_geo_provider
+from .estimates import trip_fields
+from .geofence import geofence
+from indrive.metrics import geofence_rejections
+from indrive.tracing import span
+
+logger = logging.getLogger(__name__)
+
+
+def _route_polyline(pickup, destination):
+    try:
+        route = get_geo_provider().directions(pickup, destination)
+    except Exception:
+        logger.warning("Route polyline failed", exc_info=True)
+        return None
+    return route['polyline'] if route else None
+
+
+def _geo_calls(data):
+    """``{field: (function, args)}`` for the addresses and route of a new ride"""
+    pickup = (data.get('pickup_latitude'), data.get('pickup_longitude'))
+    destination = (data.get('destination_latitude'), data.get('destination_longitude'))
+    calls = {}
+    if None not in pickup:
+        calls['pickup_location'] = (get_human_readable_address, pickup)
+    if None not in destination:
+        calls['destination_location'] = (get_human_readable_address, destination)
+    if None not in pickup + destination:
+        calls['route_polyline'] = (_route_polyline, (pickup, destination))
+    return calls
+
+
+def geo_fields(data):
+    """Human-readable addresses and the route polyline for a new ride's coordinates"""
+    return {field: function(*args) for field, (function, args) in _geo_calls(data).items()}
+
+
+async def ageo_fields(data):
+    """``geo_fields`` with the provider calls made concurrently, each in its own thread"""
+    calls = _geo_calls(data)
+    results = await asyncio.gather(*(
+        sync_to_async(function, thread_sensitive=False)(*args) for function, args in calls.values()
+    ))
+    return dict(zip(calls, results))
+
+
+def places(attrs):
+    """``{'pickup': Place, 'destination': Place}`` of the ends with both
+    coordinates; raises a ValidationError for an end outside the service area"""
+    found = {}
+    for end in ('pickup', 'destination'):
+        latitude, longitude = attrs.get(f'{end}_latitude'), attrs.get(f'{end}_longitude')
+        if latitude is None or longitude is None:
+            continue
+        place = geofence.classify(latitude, longitude)
+        if not place.in_service:
+            geofence_rejections.inc((end,))
+            raise serializers.ValidationError({f'{end}_latitude': f"The {end} is outside our service area"})
+        found[end] = place
+    return found
 
-import googlemaps # Import googlemaps for Directions API
-from django.conf import settings # Import settings to access API key
 
 class RideSerializer(serializers.ModelSerializer):
     rider = UserSerializer(read_only=True)
@@ -18,7 +79,30 @@ class RideSerializer(serializers.ModelSerializer):
         fields = '__all__'
         read_only_fields = ['id', 'rider', 'driver', 'status', 'created_at',
                           'accepted_at', 'completed_at', 'fare', 'route_polyline',
-                          'driver_proposals', 'passenger_counter_offers', 'accepted_proposal']
+                          'driver_proposals', 'passenger_counter_offers', 'accepted_proposal',
+                          'driver_rating', 'version', 'updated_at', 'pickup_zone', 'destination_zone']
+
+    def validate(self, attrs):
+        # Before any geo provider call: out-of-area rides go no further
+        for end, place in places(attrs).items():
+            attrs[f'{end}_zone'] = place.zone
+        return attrs
+
+    def create(self, validated_data):
+        with span('RideSerializer.create'):
+            return self._create(validated_data)
+
+    def _create(self, validated_data):
+        validated_data.update(geo_fields(validated_data))
+        validated_data.update(trip_fields(validated_data))
+        return super().create(validated_data)
+
+    def to_representation(self, instance):
+        # Convert model instance to representation (for GET requests)
+        with span('RideSerializer.to_representation'):
+            representation = super().to_representation(instance)
+        # Ensure coordinates are included in representation if needed by frontend
+        return representation
 
 class BidSerializer(serializers.Serializer):
     amount = serializers.DecimalField(max_digits=8, decimal_places=2, min_value=1)
@@ -29,43 +113,16 @@ class BidSerializer(serializers.Serializer):
             raise serializers.ValidationError("Bid amount must be positive")
         return value
 
-    def create(self, validated_data):
-        # Extract LatLngs and convert to human-readable addresses
-        pickup_lat = validated_data.get('pickup_latitude')
-        pickup_lon = validated_data.get('pickup_longitude')
-        destination_lat = validated_data.get('destination_latitude')
-        destination_lon = validated_data.get('destination_longitude')
-
-        if pickup_lat is not None and pickup_lon is not None:
-            validated_data['pickup_location'] = get_human_readable_address(pickup_lat, pickup_lon)
-            validated_data['pickup_latitude'] = pickup_lat
-            validated_data['pickup_longitude'] = pickup_lon
-        
-        if destination_lat is not None and destination_lon is not None:
-            validated_data['destination_location'] = get_human_readable_address(destination_lat, destination_lon)
-            validated_data['destination_latitude'] = destination_lat
-            validated_data['destination_longitude'] = destination_lon
-
-        # Generate route polyline using Google Directions API
-        gmaps = googlemaps.Client(key=settings.GOOGLE_MAPS_API_KEY)
-        try:
-            directions_result = gmaps.directions(
-                (pickup_lat, pickup_lon),
-                (destination_lat, destination_lon),
-                mode="driving"
-            )
-            if directions_result:
-                # The encoded polyline is usually in the first leg of the first route
-                encoded_polyline = directions_result[0]['overview_polyline']['points']
-                validated_data['route_polyline'] = encoded_polyline
-        except Exception as e:
-            print(f"Error generating route polyline: {e}")
-            validated_data['route_polyline'] = None # Or handle more robustly
 
-        return super().create(validated_data)
+class FareEstimateSerializer(serializers.Serializer):
+    pickup_latitude = serializers.FloatField(min_value=-90, max_value=90)
+    pickup_longitude = serializers.FloatField(min_value=-180, max_value=180)
+    destination_latitude = serializers.FloatField(min_value=-90, max_value=90)
+    destination_longitude = serializers.FloatField(min_value=-180, max_value=180)
 
-    def to_representation(self, instance):
-        # Convert model instance to representation (for GET requests)
-        representation = super().to_representation(instance)
-        # Ensure coordinates are included in representation if needed by frontend
-        return representation
+    def validate(self, attrs):
+        attrs['places'] = places(attrs)
+        return attrs
+
+class RatingSerializer(serializers.Serializer):
+    rating = serializers.IntegerField(min_value=1, max_value=5)
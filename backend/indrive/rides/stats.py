@@ -0,0 +1,136 @@
+"""
+Driver statistics used by ``find_best_drivers``, maintained online.
+
+Each event updates the driver's row with a single UPDATE built from
+F-expressions, so concurrent events never overwrite each other:
+
+* a bid moves ``average_fare`` (EWMA of the fares the driver asks and
+  completes rides at),
+* answering a ``DriverNotification`` (bid or accept) moves
+  ``avg_response_time`` (EWMA), in the transaction that flags it responded,
+* a completed ride counts in ``completed_rides`` and ``average_fare``,
+* a rider's rating updates the running mean ``rating``.
+
+``DRIVER_STATS_EWMA_ALPHA`` is the weight of the newest sample. The
+``backfill_driver_stats`` command recomputes the same values from history
+with ``DriverStats``. The ``a``-prefixed functions are for async views.
+"""
+from decimal import Decimal
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, DecimalField, F, FloatField, Value, When
+from django.db.models.functions import Cast, Coalesce
+from django.utils import timezone
+from users.models import User
+from .models import DriverNotification
+
+
+def _alpha():
+    return settings.DRIVER_STATS_EWMA_ALPHA
+
+
+def _fare_ewma(fare):
+    fare = Value(Decimal(fare), output_field=DecimalField(max_digits=10, decimal_places=2))
+    alpha = Value(Decimal(str(_alpha())), output_field=DecimalField(max_digits=4, decimal_places=3))
+    # The first sample becomes the average
+    current = Coalesce(F('average_fare'), fare)
+    return Cast(current + alpha * (fare - current), DecimalField(max_digits=10, decimal_places=2))
+
+
+def record_bid(driver_id, amount):
+    User.objects.filter(id=driver_id).update(average_fare=_fare_ewma(amount))
+
+
+async def arecord_bid(driver_id, amount):
+    await User.objects.filter(id=driver_id).aupdate(average_fare=_fare_ewma(amount))
+
+
+def _completion_updates(ride):
+    updates = {'completed_rides': F('completed_rides') + 1}
+    if ride.final_fare is not None:
+        updates['average_fare'] = _fare_ewma(ride.final_fare)
+    return updates
+
+
+def record_ride_completed(ride):
+    User.objects.filter(id=ride.driver_id).update(**_completion_updates(ride))
+
+
+async def arecord_ride_completed(ride):
+    await User.objects.filter(id=ride.driver_id).aupdate(**_completion_updates(ride))
+
+
+def record_response_time(driver_id, seconds):
+    sample = Value(float(seconds), output_field=FloatField())
+    User.objects.filter(id=driver_id).update(
+        avg_response_time=Case(
+            When(response_count=0, then=sample),
+            default=F('avg_response_time') + _alpha() * (sample - F('avg_response_time')),
+            output_field=FloatField()
+        ),
+        response_count=F('response_count') + 1
+    )
+
+
+def record_notification_response(driver_id, ride_id):
+    """The driver bid on or accepted a ride they were offered: store and count their response time"""
+    with transaction.atomic():
+        notification = DriverNotification.objects.select_for_update().filter(
+            driver_id=driver_id, ride_id=ride_id, responded=False
+        ).only('created_at').first()
+        if notification is None:
+            return None
+        seconds = (timezone.now() - notification.created_at).total_seconds()
+        DriverNotification.objects.filter(id=notification.id).update(responded=True, response_time=seconds)
+        record_response_time(driver_id, seconds)
+    return seconds
+
+
+# A transaction with a row lock: the async ORM has no transactions yet
+arecord_notification_response = sync_to_async(record_notification_response)
+
+
+def record_rating(driver_id, stars):
+    # Every SET expression sees the row's old values, so this is the running mean
+    User.objects.filter(id=driver_id).update(
+        rating=(F('rating') * F('rating_count') + stars) / (F('rating_count') + 1.0),
+        rating_count=F('rating_count') + 1
+    )
+
+
+class DriverStats:
+    """The same statistics accumulated in memory, for the backfill"""
+    fields = ['average_fare', 'avg_response_time', 'response_count', 'rating', 'rating_count', 'completed_rides']
+
+    def __init__(self):
+        self.average_fare = None
+        self.avg_response_time = 0.0
+        self.response_count = 0
+        self.rating = 5.0
+        self.rating_count = 0
+        self.completed_rides = 0
+
+    def add_fare(self, fare):
+        fare = Decimal(fare)
+        if self.average_fare is None:
+            self.average_fare = fare
+        else:
+            self.average_fare += Decimal(str(_alpha())) * (fare - self.average_fare)
+        self.average_fare = self.average_fare.quantize(Decimal('0.01'))
+
+    def add_response_time(self, seconds):
+        if self.response_count == 0:
+            self.avg_response_time = seconds
+        else:
+            self.avg_response_time += _alpha() * (seconds - self.avg_response_time)
+        self.response_count += 1
+
+    def add_rating(self, stars):
+        self.rating = (self.rating * self.rating_count + stars) / (self.rating_count + 1)
+        self.rating_count += 1
+
+    def add_completed_ride(self, final_fare):
+        self.completed_rides += 1
+        if final_fare is not None:
+            self.add_fare(final_fare)
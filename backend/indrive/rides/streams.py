@@ -0,0 +1,46 @@
+"""
+Ride event streams.
+
+Every event published on a ride stream carries a ``seq``: the ride's
+``version`` after the save it reports, so it is the same in every process
+and keeps increasing for the life of the ride (saves that publish nothing
+leave gaps). The last ``RIDE_EVENT_REPLAY_LIMIT`` events of each ride are
+kept in ``RideEvent`` (older ones are deleted as new ones are published), so
+a reconnecting client, whatever worker it lands on, sends the last ``seq``
+it saw and gets back the events it missed, or is told to refetch the ride
+over REST when some of them are gone.
+"""
+from django.conf import settings
+from django.db.models import Max, Subquery
+from indrive.tracing import traced
+from .models import RideEvent
+
+
+def events_since(ride_id, last_seq):
+    """Return the logged ``(group, event)`` pairs after ``last_seq``, oldest first.
+
+    Returns ``None`` if events after ``last_seq`` may have been deleted.
+    """
+    events = list(RideEvent.objects.filter(ride_id=ride_id).order_by('seq', 'id')
+                  .values_list('seq', 'group', 'event'))
+    # A full log may have lost older events; seqs have gaps, so anything before it is unknown
+    if len(events) >= settings.RIDE_EVENT_REPLAY_LIMIT and last_seq < events[0][0]:
+        return None
+    return [(group, event) for seq, group, event in events if seq > last_seq]
+
+
+def latest_seq(ride_id):
+    return RideEvent.objects.filter(ride_id=ride_id).aggregate(seq=Max('seq'))['seq'] or 0
+
+
+@traced('publish_ride_event')
+async def publish_ride_event(channel_layer, group, ride, event):
+    """Sequence an event about ``ride``, just saved, log it and send it to ``group``"""
+    event = dict(event, ride_id=str(ride.id), seq=ride.version)
+    await RideEvent.objects.acreate(ride_id=ride.id, seq=ride.version, group=group, event=event)
+    # Keep the newest RIDE_EVENT_REPLAY_LIMIT: delete from the first one past them
+    oldest_dropped = (RideEvent.objects.filter(ride_id=ride.id).order_by('-seq')
+                      .values('seq')[settings.RIDE_EVENT_REPLAY_LIMIT:settings.RIDE_EVENT_REPLAY_LIMIT + 1])
+    await RideEvent.objects.filter(ride_id=ride.id, seq__lte=Subquery(oldest_dropped)).adelete()
+    await channel_layer.group_send(group, event)
+    return event
@@ -0,0 +1,737 @@
+import os
+import random
+import subprocess
+import sys
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from chat.models import ChatMessage
+from indrive.metrics import geo_breaker_state, geo_breaker_transitions
+from rides import estimates, geo, stats
+from rides.archive import archive_tables, archived_rides
+from rides.dispatch import adispatch_ride, dispatch_ride
+from rides.geo import ESTIMATE_SPEED_KMH, CircuitBreaker, FakeGeoProvider, encode_polyline, set_geo_provider
+from rides.geofence import Geofence, Place
+from rides.heatmap import Heatmap, surge_multipliers
+from rides.management.commands.backfill_driver_stats import in_event_order
+from rides.management.commands.bench_geofence import ray_cast
+from rides.management.commands.bench_imports import LAZY_MODULES, TARGETS, parse_importtime
+from rides.models import ArchivedDriverResponse, DriverNotification, Ride, SpeedProfile
+from rides.pooling import PoolingIndex, route_cells
+from rides.presence import PresenceTable
+from rides.utils import parse_coordinates
+from users.models import User
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('rides.geo.time.monotonic', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker('test', window=4, min_calls=4, failure_rate=0.5,
+                                      slow_seconds=1.0, open_seconds=30)
+
+    def call(self, seconds=0.1, failed=False):
+        allowed = self.breaker.allow()
+        if allowed:
+            self.breaker.record(seconds, failed)
+        return allowed
+
+    def trip(self):
+        for failed in (False, True, False, True):
+            self.call(failed=failed)
+
+    def test_stays_closed_below_the_failure_rate(self):
+        for failed in (True, False, False, False, True, False, False):
+            self.assertTrue(self.call(failed=failed))
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_waits_for_min_calls(self):
+        for _ in range(3):
+            self.call(failed=True)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.call(failed=True)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_slow_calls_count_as_failures(self):
+        for seconds in (0.1, 2.0, 0.1, 2.0):
+            self.call(seconds)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_open_refuses_calls_until_open_seconds_passed(self):
+        self.trip()
+        self.assertFalse(self.call())
+        self.now += 29
+        self.assertFalse(self.call())
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_half_open_lets_one_probe_through(self):
+        self.trip()
+        self.now += 31
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_successful_probe_closes(self):
+        self.trip()
+        self.now += 31
+        self.assertTrue(self.call())
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        # The outcomes before opening are forgotten
+        for _ in range(3):
+            self.call(failed=True)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_failed_probe_opens_again(self):
+        self.trip()
+        self.now += 31
+        self.assertTrue(self.call(failed=True))
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.now += 29
+        self.assertFalse(self.call())
+
+    def test_transitions_are_exported(self):
+        before = geo_breaker_transitions.collect().get(('test', CircuitBreaker.OPEN), 0)
+        self.trip()
+        self.assertEqual(geo_breaker_transitions.collect()[('test', CircuitBreaker.OPEN)], before + 1)
+        self.assertEqual(geo_breaker_state.collect()[('test',)], 2)
+
+
+def polygon_feature(id, kind, *rings, **properties):
+    # Rings as (lat, lng) points; GeoJSON wants them as closed [lng, lat] lists
+    coordinates = [[[lng, lat] for lat, lng in ring + ring[:1]] for ring in rings]
+    return {'type': 'Feature', 'properties': dict(properties, id=id, kind=kind),
+            'geometry': {'type': 'Polygon', 'coordinates': coordinates}}
+
+
+def square(south, west, north, east):
+    return [(south, west), (south, east), (north, east), (north, west)]
+
+
+class GeofenceTests(SimpleTestCase):
+    def setUp(self):
+        # A 1x1 degree service area with a hole, an airport zone and a diamond-shaped district
+        self.fence = Geofence([
+            polygon_feature('airport', 'zone', square(0.2, 0.2, 0.3, 0.3), fare_multiplier=1.5),
+            polygon_feature('district', 'zone', [(0.0, 0.5), (0.5, 1.0), (1.0, 0.5), (0.5, 0.0)]),
+            polygon_feature('city', 'service_area', square(0, 0, 1, 1), square(0.6, 0.6, 0.8, 0.8)),
+        ], cell_degrees=0.1)
+
+    def test_classifies_areas_and_zones(self):
+        self.assertEqual(self.fence.classify(0.25, 0.25), Place(True, 'city', ('airport', 'district'), 1.5))
+        self.assertEqual(self.fence.classify(0.5, 0.5), Place(True, 'city', ('district',), 1.0))
+        self.assertEqual(self.fence.classify(0.05, 0.05), Place(True, 'city', (), 1.0))
+        self.assertEqual(self.fence.classify(0.25, 0.25).zone, 'airport')
+
+    def test_outside_and_in_holes(self):
+        self.assertFalse(self.fence.classify(1.5, 0.5).in_service)
+        self.assertFalse(self.fence.classify(-0.01, 0.5).in_service)
+        hole = self.fence.classify(0.7, 0.7)
+        self.assertFalse(hole.in_service)
+        self.assertIsNone(hole.service_area)
+
+    def test_boundary_cells_need_the_geometry(self):
+        # Same cell, either side of the district's edge
+        self.assertEqual(self.fence.classify(0.25, 0.71).zones, ('district',))
+        self.assertEqual(self.fence.classify(0.25, 0.79).zones, ())
+
+    def test_matches_a_ray_cast_over_every_edge(self):
+        rng = random.Random(1)
+        for _ in range(2000):
+            latitude, longitude = rng.uniform(-0.2, 1.2), rng.uniform(-0.2, 1.2)
+            holding = [area for area in self.fence.areas if ray_cast(area.rings, latitude, longitude)]
+            service_area = next((area.id for area in holding if area.kind == 'service_area'), None)
+            zones = tuple(area.id for area in holding if area.kind == 'zone')
+            place = self.fence.classify(latitude, longitude)
+            self.assertEqual((place.service_area, place.zones), (service_area, zones), (latitude, longitude))
+
+    def test_multipolygon_parts(self):
+        feature = polygon_feature('islands', 'service_area', square(0, 0, 1, 1))
+        feature['geometry'] = {'type': 'MultiPolygon', 'coordinates': [
+            feature['geometry']['coordinates'],
+            polygon_feature('-', 'zone', square(5, 5, 6, 6))['geometry']['coordinates'],
+        ]}
+        fence = Geofence([feature], cell_degrees=0.5)
+        self.assertTrue(fence.classify(0.5, 0.5).in_service)
+        self.assertTrue(fence.classify(5.5, 5.5).in_service)
+        self.assertFalse(fence.classify(3, 3).in_service)
+
+    def test_without_service_areas_everything_is_in_service(self):
+        self.assertTrue(Geofence([], cell_degrees=0.1).classify(10, 10).in_service)
+        zones_only = Geofence([polygon_feature('airport', 'zone', square(0, 0, 1, 1))], cell_degrees=0.1)
+        self.assertEqual(zones_only.classify(10, 10), Place(True, None, (), 1.0))
+
+    def test_rejects_bad_features(self):
+        with self.assertRaises(ImproperlyConfigured):
+            Geofence([polygon_feature('a', 'city', square(0, 0, 1, 1))], cell_degrees=0.1)
+        with self.assertRaises(ImproperlyConfigured):
+            Geofence([polygon_feature('a', 'zone', [(0, 0), (1, 1)])], cell_degrees=0.1)
+        with self.assertRaises(ImproperlyConfigured):
+            Geofence([polygon_feature('a', 'zone', square(0, 0, 1, 1))] * 2, cell_degrees=0.1)
+
+
+class PresenceTests(TestCase):
+    def setUp(self):
+        self.driver = User.objects.create_user('+9771000001', role='driver')
+        self.presence = PresenceTable(grace=60, flush_interval=5)
+
+    def test_flush_writes_heartbeats_in_bulk(self):
+        self.presence.connect(self.driver.id)
+        self.presence.heartbeat(self.driver.id, '27.7', 85.3)
+        self.presence.flush()
+        self.driver.refresh_from_db()
+        self.assertTrue(self.driver.is_online)
+        self.assertIsNotNone(self.driver.last_seen_at)
+        self.assertEqual(self.driver.current_location, '27.7,85.3')
+        self.assertTrue(self.presence.is_online(self.driver.id))
+
+    def test_invalid_locations_are_ignored(self):
+        for latitude, longitude in (('nan', 1), (91, 0), ('x', 'y'), (None, None)):
+            self.presence.heartbeat(self.driver.id, latitude, longitude)
+        self.presence.flush()
+        self.driver.refresh_from_db()
+        self.assertTrue(self.driver.is_online)
+        self.assertIsNone(self.driver.current_location)
+
+    def test_silent_drivers_go_offline(self):
+        User.objects.filter(id=self.driver.id).update(
+            is_online=True, last_seen_at=timezone.now() - timedelta(seconds=61))
+        self.assertEqual(self.presence.flush(), 1)
+        self.driver.refresh_from_db()
+        self.assertFalse(self.driver.is_online)
+
+    def test_failed_flush_is_retried(self):
+        self.presence.heartbeat(self.driver.id, 27.7, 85.3)
+        with mock.patch.object(User.objects, 'bulk_update', side_effect=RuntimeError('down')):
+            with self.assertRaises(RuntimeError):
+                self.presence.flush()
+        self.presence.flush()
+        self.driver.refresh_from_db()
+        self.assertEqual(self.driver.current_location, '27.7,85.3')
+
+
+class DriverStatsTests(TestCase):
+    def setUp(self):
+        self.rider = User.objects.create_user('+9771000002', role='rider')
+        self.driver = User.objects.create_user('+9771000001', role='driver')
+
+    def driver_stats(self):
+        return User.objects.values(*stats.DriverStats.fields).get(id=self.driver.id)
+
+    def test_fares_are_an_ewma_seeded_by_the_first_sample(self):
+        stats.record_bid(self.driver.id, Decimal('200'))
+        self.assertEqual(self.driver_stats()['average_fare'], Decimal('200.00'))
+        stats.record_bid(self.driver.id, Decimal('300'))
+        self.assertEqual(self.driver_stats()['average_fare'], Decimal('220.00'))
+
+    def test_response_times_are_an_ewma(self):
+        for seconds in (30, 80):
+            stats.record_response_time(self.driver.id, seconds)
+        driver = self.driver_stats()
+        self.assertAlmostEqual(driver['avg_response_time'], 40.0)
+        self.assertEqual(driver['response_count'], 2)
+
+    def test_ratings_are_a_running_mean(self):
+        for stars in (4, 5, 3):
+            stats.record_rating(self.driver.id, stars)
+        driver = self.driver_stats()
+        self.assertAlmostEqual(driver['rating'], 4.0)
+        self.assertEqual(driver['rating_count'], 3)
+
+    def test_notification_responses_are_timed_once(self):
+        ride = Ride.objects.create(rider=self.rider, pickup_location='a', destination_location='b')
+        notification = DriverNotification.objects.create(driver=self.driver, ride=ride, score=1, details={})
+        DriverNotification.objects.filter(id=notification.id).update(
+            created_at=timezone.now() - timedelta(seconds=45))
+        self.assertAlmostEqual(stats.record_notification_response(self.driver.id, ride.id), 45, delta=5)
+        self.assertIsNone(stats.record_notification_response(self.driver.id, ride.id))
+        self.assertEqual(self.driver_stats()['response_count'], 1)
+
+    def test_in_event_order_releases_events_up_to_each_watermark(self):
+        batches = [(1, [(5, 'a'), (2, 'b')]), (3, [(4, 'c')]), (6, [(7, 'd')]), (8, [])]
+        self.assertEqual([event[1] for event in in_event_order(batches)], ['b', 'c', 'a', 'd'])
+
+    def test_backfill_matches_the_online_statistics(self):
+        start = timezone.now()
+
+        def at(minutes):
+            return start + timedelta(minutes=minutes)
+
+        bidding = Ride.objects.create(rider=self.rider, pickup_location='a', destination_location='b', driver_proposals=[
+            {'driver': self.driver.id, 'amount': '200.00', 'timestamp': at(1).isoformat()},
+            {'driver': self.driver.id, 'amount': '300.00', 'timestamp': at(3).isoformat()},
+        ])
+        completed = Ride.objects.create(rider=self.rider, driver=self.driver, pickup_location='a',
+                                        destination_location='b', status='completed', completed_at=at(2),
+                                        final_fare=Decimal('250.00'), driver_rating=4)
+        DriverNotification.objects.create(driver=self.driver, ride=bidding, score=1, details={},
+                                          responded=True, response_time=30)
+        DriverNotification.objects.update(created_at=start)
+
+        # The same events, online, in the order they happened
+        stats.record_response_time(self.driver.id, 30)
+        stats.record_bid(self.driver.id, Decimal('200.00'))
+        stats.record_ride_completed(completed)
+        stats.record_rating(self.driver.id, 4)
+        stats.record_bid(self.driver.id, Decimal('300.00'))
+        online = self.driver_stats()
+
+        User.objects.filter(id=self.driver.id).update(average_fare=None, avg_response_time=0, response_count=0,
+                                                      rating=5, rating_count=0, completed_rides=0)
+        call_command('backfill_driver_stats', stdout=StringIO())
+        backfilled = self.driver_stats()
+        self.assertEqual(backfilled.pop('average_fare'), online.pop('average_fare'))
+        for field, value in online.items():
+            self.assertAlmostEqual(backfilled[field], value, msg=field)
+
+
+class DispatchTests(TestCase):
+    def setUp(self):
+        self.rider = User.objects.create_user('+9772000000', role='rider')
+        # Three drivers at increasing distances from the pickup, one 50 km away, one offline
+        self.drivers = [
+            User.objects.create_user(f'+977200000{index}', role='driver', is_available=True, is_online=online,
+                                     current_location=f'{27.70 + offset},85.30')
+            for index, (offset, online) in enumerate([(0.01, True), (0.05, True), (0.1, True),
+                                                      (0.45, True), (0.0, False)], 1)
+        ]
+        self.ride = Ride.objects.create(rider=self.rider, pickup_location='a', destination_location='b',
+                                        pickup_latitude=27.70, pickup_longitude=85.30, proposed_fare=Decimal('200.00'))
+
+    def test_nearby_online_drivers_are_notified_in_two_queries(self):
+        layer = get_channel_layer()
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(f'user_{self.drivers[0].id}', channel)
+        with self.assertNumQueries(2):
+            notifications = dispatch_ride(self.ride)
+        self.assertEqual([notification.driver_id for notification in notifications],
+                         [driver.id for driver in self.drivers[:3]])
+        self.assertTrue(all(notification.pk for notification in notifications))
+        self.assertEqual(DriverNotification.objects.filter(ride=self.ride).count(), 3)
+        offer = async_to_sync(layer.receive)(channel)
+        self.assertEqual((offer['type'], offer['ride_id'], offer['proposed_fare']),
+                         ('ride.offer', str(self.ride.id), '200.00'))
+        self.assertAlmostEqual(offer['distance_km'], 1.11, places=2)
+
+    async def test_async_dispatch_matches(self):
+        notifications = await adispatch_ride(self.ride)
+        self.assertEqual([notification.driver_id for notification in notifications],
+                         [driver.id for driver in self.drivers[:3]])
+
+    def test_no_candidates_no_notifications(self):
+        User.objects.filter(role='driver').update(is_available=False)
+        self.assertEqual(dispatch_ride(self.ride), [])
+        self.assertFalse(DriverNotification.objects.exists())
+
+
+class RideArchiveTests(TestCase):
+    def setUp(self):
+        self.rider = User.objects.create_user('+9773000001', role='rider')
+        self.driver = User.objects.create_user('+9773000002', role='driver')
+        now = timezone.now()
+        self.old = self.ride(status='completed', completed_at=now - timedelta(days=120), final_fare=Decimal('300.00'))
+        self.cancelled = self.ride(status='cancelled', created_at=now - timedelta(days=200))
+        self.recent = self.ride(status='completed', completed_at=now - timedelta(days=10))
+        self.active = self.ride(status='started')
+
+    def ride(self, created_at=None, **fields):
+        ride = Ride.objects.create(rider=self.rider, driver=self.driver, pickup_location='a',
+                                   destination_location='b', **fields)
+        if created_at is not None:
+            Ride.objects.filter(id=ride.id).update(created_at=created_at)
+        return ride
+
+    def archive(self, **options):
+        call_command('archive_rides', days=90, stdout=StringIO(), **options)
+
+    def test_rides_that_ended_long_ago_move_to_monthly_tables(self):
+        notification = DriverNotification.objects.create(driver=self.driver, ride=self.old, score=1, details={},
+                                                          responded=True, response_time=12)
+        self.archive(batch_size=1)
+        self.assertEqual(set(Ride.objects.values_list('id', flat=True)), {self.recent.id, self.active.id})
+        self.assertEqual(len(archive_tables(connection)), 2)
+        self.assertFalse(DriverNotification.objects.filter(id=notification.id).exists())
+        self.assertEqual(list(ArchivedDriverResponse.objects.values_list('driver_id', 'response_time')),
+                         [(self.driver.id, 12.0)])
+        archived = archived_rides(rider_id=self.rider.id)
+        self.assertEqual([ride.id for ride in archived], [self.old.id, self.cancelled.id])
+        self.assertEqual(archived[0].final_fare, Decimal('300.00'))
+
+    def test_rides_with_a_hot_chat_wait_for_archive_chats(self):
+        ChatMessage.objects.create(ride=self.old, sender=self.rider, recipient=self.driver, message='Thanks')
+        self.archive()
+        self.assertTrue(Ride.objects.filter(id=self.old.id).exists())
+        self.assertFalse(Ride.objects.filter(id=self.cancelled.id).exists())
+
+    def test_limit(self):
+        self.archive(limit=1)
+        self.assertEqual(Ride.objects.count(), 3)
+
+    def test_history_merges_hot_and_archived_rides(self):
+        self.archive()
+        client = APIClient()
+        client.force_authenticate(self.rider)
+        response = client.get('/api/rides/history/')
+        self.assertEqual([ride['id'] for ride in response.json()],
+                         [self.active.id, self.recent.id, self.old.id, self.cancelled.id])
+
+    def test_backfill_reads_archived_rides(self):
+        self.archive()
+        call_command('backfill_driver_stats', stdout=StringIO())
+        driver = User.objects.get(id=self.driver.id)
+        self.assertEqual((driver.completed_rides, driver.average_fare), (2, Decimal('300.00')))
+
+
+class LazyImportTests(SimpleTestCase):
+    def test_entry_points_leave_heavy_modules_unimported(self):
+        for target, statement in TARGETS.items():
+            script = f"{statement}; import sys; print(' '.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+            result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True,
+                                    cwd=settings.BASE_DIR, env=dict(os.environ, DJANGO_SETTINGS_MODULE='indrive.settings'))
+            self.assertEqual(result.stdout.strip(), '', target)
+
+    def test_parse_importtime(self):
+        output = ("import time: self [us] | cumulative | imported package\n"
+                  "import time:       120 |        120 |   json.decoder\n"
+                  "import time:       300 |        420 | json\n")
+        self.assertEqual(parse_importtime(output), [('json.decoder', 120, 120, 1), ('json', 300, 420, 0)])
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.rider = User.objects.create_user('+9774000001', role='rider')
+        self.ride = Ride.objects.create(rider=self.rider, pickup_location='a', destination_location='b')
+        self.client = APIClient()
+        self.client.force_authenticate(self.rider)
+
+    def test_unchanged_ride_is_not_modified(self):
+        url = f'/api/rides/{self.ride.id}/'
+        response = self.client.get(url)
+        self.assertEqual(response['ETag'], f'"{self.ride.id}.1"')
+        with self.assertNumQueries(1):  # The ride's version only
+            poll = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual((poll.status_code, poll['ETag']), (304, response['ETag']))
+        self.ride.status = 'cancelled'
+        self.ride.save()
+        changed = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual((changed.status_code, changed['ETag']), (200, f'"{self.ride.id}.2"'))
+
+    def test_missing_rides_are_404(self):
+        self.assertEqual(self.client.get('/api/rides/999999/').status_code, 404)
+
+    def test_list_etag_follows_its_rides(self):
+        url = '/api/rides/history/'
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.ride.status = 'cancelled'
+        self.ride.save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        etag = self.client.get(url)['ETag']
+        Ride.objects.create(rider=self.rider, pickup_location='c', destination_location='d')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_if_modified_since(self):
+        response = self.client.get('/api/rides/history/')
+        poll = self.client.get('/api/rides/history/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(poll.status_code, 304)
+
+
+class AsyncRideViewTests(TestCase):
+    ride = {
+        'pickup_location': 'Thamel', 'destination_location': 'Patan',
+        'pickup_latitude': 27.7154, 'pickup_longitude': 85.3123,
+        'destination_latitude': 27.6766, 'destination_longitude': 85.3149,
+        'proposed_fare': '250.00',
+    }
+
+    def setUp(self):
+        cache.clear()
+        provider = geo._provider
+        self.addCleanup(setattr, geo, '_provider', provider)
+        set_geo_provider(FakeGeoProvider(latency=0))
+        self.rider = User.objects.create_user('+9775000001', role='rider')
+        self.driver = User.objects.create_user('+9775000002', role='driver')
+        self.other_rider = User.objects.create_user('+9775000003', role='rider')
+
+    def call(self, method, path, user=None, data=None, **extra):
+        if user is not None:
+            extra['HTTP_AUTHORIZATION'] = f'Bearer {AccessToken.for_user(user)}'
+        return getattr(self.client, method)(f'/api/rides/async/{path}', data or {},
+                                            content_type='application/json', **extra)
+
+    def create(self, **extra):
+        return self.call('post', '', self.rider, self.ride, **extra)
+
+    def bid_and_accept(self):
+        ride_id = self.create().json()['id']
+        self.call('post', f'{ride_id}/driver-bid/', self.driver, {'amount': '240.00'})
+        return ride_id, self.call('post', f'{ride_id}/accept-bid/0/', self.rider)
+
+    def test_only_riders_with_a_token_create_rides(self):
+        response = self.create()
+        self.assertEqual(response.status_code, 201)
+        ride = Ride.objects.get(id=response.json()['id'])
+        self.assertEqual((ride.rider, ride.status), (self.rider, 'requested'))
+        self.assertEqual(self.call('post', '', self.driver, self.ride).status_code, 403)
+        self.assertEqual(self.call('post', '', data=self.ride).status_code, 401)
+        self.assertEqual(self.call('get', '', self.rider).status_code, 405)
+
+    def test_retried_creates_make_one_ride(self):
+        first = self.create(HTTP_IDEMPOTENCY_KEY='create-1')
+        retry = self.create(HTTP_IDEMPOTENCY_KEY='create-1')
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.json()['id'], first.json()['id'])
+        self.assertEqual(Ride.objects.count(), 1)
+
+    def test_rider_accepts_a_bid_once(self):
+        ride_id = self.create().json()['id']
+        self.assertEqual(self.call('post', f'{ride_id}/driver-bid/', self.rider, {'amount': '1'}).status_code, 403)
+        bid = self.call('post', f'{ride_id}/driver-bid/', self.driver, {'amount': '240.00'})
+        self.assertEqual(bid.json()['driver_proposals'][0]['driver'], self.driver.id)
+        self.assertEqual(self.call('post', f'{ride_id}/accept-bid/0/', self.other_rider).status_code, 403)
+        self.assertEqual(self.call('post', f'{ride_id}/accept-bid/1/', self.rider).status_code, 400)
+        accepted = self.call('post', f'{ride_id}/accept-bid/0/', self.rider)
+        self.assertEqual(accepted.status_code, 200)
+        ride = Ride.objects.get(id=ride_id)
+        self.assertEqual((ride.status, ride.driver, ride.final_fare), ('accepted', self.driver, Decimal('240.00')))
+        self.assertEqual(self.call('post', f'{ride_id}/accept-bid/0/', self.rider).status_code, 400)
+
+    def test_status_transitions(self):
+        ride_id, _ = self.bid_and_accept()
+        path = f'{ride_id}/status/'
+        self.assertEqual(self.call('patch', path, self.driver, {'status': 'completed'}).status_code, 400)
+        self.assertEqual(self.call('patch', path, self.rider, {'status': 'cancelled'}).status_code, 400)
+        self.assertEqual(self.call('patch', path, self.driver, {'status': 'started'}).json()['status'], 'started')
+        self.assertEqual(self.call('patch', path, self.driver, {'status': 'completed'}).json()['status'], 'completed')
+        self.assertEqual(self.call('patch', path, self.driver, {'status': 'unknown'}).status_code, 400)
+        self.assertEqual(self.call('patch', '999999/status/', self.driver, {'status': 'started'}).status_code, 404)
+
+    def test_riders_cancel_requested_rides(self):
+        ride_id = self.create().json()['id']
+        path = f'{ride_id}/status/'
+        self.assertEqual(self.call('patch', path, self.other_rider, {'status': 'cancelled'}).status_code, 400)
+        self.assertEqual(self.call('patch', path, self.rider, {'status': 'cancelled'}).json()['status'], 'cancelled')
+
+
+class EstimateTests(TestCase):
+    pickup, destination = (27.7154, 85.3123), (27.6766, 85.3149)
+
+    def setUp(self):
+        estimates._loaded_at = None
+        self.addCleanup(setattr, estimates, '_loaded_at', None)
+        self.rider = User.objects.create_user('+9776000001', role='rider')
+        self.morning = timezone.make_aware(timezone.datetime(2026, 3, 2, 8, 0))
+
+    def coordinates(self):
+        return dict(zip(['pickup_latitude', 'pickup_longitude', 'destination_latitude', 'destination_longitude'],
+                        self.pickup + self.destination))
+
+    def trip(self, started_at, minutes):
+        Ride.objects.create(rider=self.rider, pickup_location='a', destination_location='b', status='completed',
+                            started_at=started_at, completed_at=started_at + timedelta(minutes=minutes),
+                            **self.coordinates())
+
+    def test_trip_fields(self):
+        distance = estimates.road_distance(self.pickup, self.destination)
+        self.assertAlmostEqual(distance, 4.32 * 1.3, places=1)
+        fields = estimates.trip_fields(self.coordinates(), speeds={}, when=self.morning)
+        self.assertEqual(fields, {'distance_km': round(distance, 3),
+                                  'estimated_duration': round(distance / ESTIMATE_SPEED_KMH * 60)})
+        slow = estimates.trip_fields(self.coordinates(), speeds={8: 10.0}, when=self.morning)
+        self.assertEqual(slow['estimated_duration'], round(distance / 10 * 60))
+        self.assertEqual(estimates.trip_fields(dict(self.coordinates(), distance_km=9), speeds={}).keys(),
+                         {'estimated_duration'})
+        self.assertEqual(estimates.trip_fields(dict(self.coordinates(), pickup_latitude=None)), {})
+
+    def test_calibrate_weighs_trips_by_distance(self):
+        trips = [(self.morning, self.morning + timedelta(hours=1), 20),
+                 (self.morning, self.morning + timedelta(hours=1), 40),
+                 (self.morning, self.morning + timedelta(seconds=1), 5),  # 18000 km/h
+                 (self.morning, self.morning, 1),
+                 (self.morning + timedelta(hours=1), self.morning + timedelta(hours=2), 30)]
+        self.assertEqual(estimates.calibrate(trips, min_samples=2), {8: (30.0, 2)})
+        self.assertEqual(estimates.calibrate(trips, min_samples=1), {8: (30.0, 2), 9: (30.0, 1)})
+
+    def test_command_learns_speeds_and_fills_in_rides(self):
+        for _ in range(2):
+            self.trip(self.morning, minutes=30)
+        ride = Ride.objects.create(rider=self.rider, pickup_location='a', destination_location='b',
+                                   **self.coordinates())
+        Ride.objects.filter(id=ride.id).update(created_at=self.morning)  # Estimated for the hour it was requested
+        call_command('estimate_rides', min_samples=2, stdout=StringIO())
+        distance = estimates.road_distance(self.pickup, self.destination)
+        profile = SpeedProfile.objects.get()
+        self.assertEqual(profile.hour, 8)
+        self.assertAlmostEqual(profile.speed_kmh, distance * 2)
+        ride.refresh_from_db()
+        self.assertEqual((ride.distance_km, ride.estimated_duration, ride.version), (round(distance, 3), 30, 2))
+        self.assertEqual(estimates.hourly_speeds(), {8: profile.speed_kmh})
+
+    def test_dry_run_saves_nothing(self):
+        self.trip(self.morning, minutes=30)
+        call_command('estimate_rides', min_samples=1, dry_run=True, stdout=StringIO())
+        self.assertFalse(SpeedProfile.objects.exists())
+        self.assertFalse(Ride.objects.filter(distance_km__isnull=False).exists())
+
+
+class HeatmapTests(TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('rides.heatmap.time.monotonic', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.heatmap = Heatmap(cell_degrees=0.01, demand_window=900, supply_window=120)
+
+    def test_rides_and_drivers_are_counted_in_their_cell(self):
+        for ride_id in (1, 2, 2):
+            self.heatmap.ride_opened(ride_id, 27.715, 85.312)
+        self.heatmap.driver_seen(10, 27.715, 85.312)
+        self.heatmap.driver_seen(11, 27.715, 85.312)
+        self.assertEqual(self.heatmap.counts(27.719, 85.311), (2, 2))
+        self.heatmap.driver_seen(11, 27.705, 85.312)  # Moved to the next cell south
+        self.heatmap.driver_busy(10)
+        self.heatmap.ride_closed(1)
+        self.assertEqual(self.heatmap.counts(27.715, 85.312), (1, 0))
+        self.assertEqual(self.heatmap.counts(27.705, 85.312), (0, 1))
+
+    def test_entries_leave_their_window(self):
+        self.heatmap.ride_opened(1, 27.715, 85.312)
+        self.heatmap.driver_seen(10, 27.715, 85.312)
+        self.now += 100
+        self.heatmap.driver_seen(10, 27.715, 85.312)  # Seen again: counted from now
+        self.now += 100
+        self.assertEqual(self.heatmap.counts(27.715, 85.312), (1, 1))
+        self.now += 30
+        self.assertEqual(self.heatmap.counts(27.715, 85.312), (1, 0))
+        self.now += 700
+        self.assertEqual(self.heatmap.counts(27.715, 85.312), (0, 0))
+
+    def test_ride_saves_update_the_map(self):
+        rider = User.objects.create_user('+9777000001', role='rider')
+        driver = User.objects.create_user('+9777000002', role='driver')
+        ride = Ride(id=1, rider=rider, status='requested', pickup_latitude=27.715, pickup_longitude=85.312)
+        self.heatmap.ride_saved(Ride, ride)
+        self.heatmap.driver_seen(driver.id, 27.715, 85.312)
+        self.assertEqual(self.heatmap.counts(27.715, 85.312), (1, 1))
+        ride.status, ride.driver = 'accepted', driver
+        self.heatmap.ride_saved(Ride, ride)
+        self.assertEqual(self.heatmap.counts(27.715, 85.312), (0, 0))
+
+    def test_surge_follows_the_neighbourhood(self):
+        far = 10 ** 6
+        multipliers = surge_multipliers({(0, 0): 6, (far, far): 2}, {(1, 1): 1})
+        # 6 rides over 1 driver around (0, 0) and (1, 1): (6 + 2) / (1 + 2)
+        self.assertEqual(multipliers, {(0, 0): 1.4, (1, 1): 1.4, (far, far): 1.25})
+        self.assertEqual(surge_multipliers({(0, 0): 20}, {}), {(0, 0): 2.0})
+        self.assertEqual(surge_multipliers({(0, 0): 1}, {(0, 0): 1}), {})
+        self.assertEqual(surge_multipliers({}, {}), {})
+
+    def test_surge_matches_a_brute_force_neighbourhood_sum(self):
+        rng = random.Random(48)
+        cells = [(rng.randrange(-20, 20), rng.randrange(-20, 20)) for _ in range(300)]
+        demand = {cell: rng.randrange(0, 8) for cell in cells[:200]}
+        supply = {cell: rng.randrange(0, 3) for cell in cells[100:]}
+        multipliers = surge_multipliers(demand, supply)
+        for cell in set(cells):
+            area = [(cell[0] + row, cell[1] + column) for row in (-1, 0, 1) for column in (-1, 0, 1)]
+            ratio = ((sum(demand.get(c, 0) for c in area) + settings.HEATMAP_PRIOR)
+                     / (sum(supply.get(c, 0) for c in area) + settings.HEATMAP_PRIOR))
+            expected = round(min(max(1 + settings.SURGE_SENSITIVITY * (ratio - 1), 1.0), settings.SURGE_MAX) * 20) / 20
+            self.assertAlmostEqual(multipliers.get(cell, 1.0), expected, msg=cell)
+
+    def test_fare_estimate_applies_the_pickup_surge(self):
+        for ride_id in range(6):
+            self.heatmap.ride_opened(ride_id, 27.7154, 85.3123)
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('+9777000003', role='rider'))
+        query = {'pickup_latitude': 27.7154, 'pickup_longitude': 85.3123,
+                 'destination_latitude': 27.6766, 'destination_longitude': 85.3149}
+        with mock.patch('rides.views.heatmap', self.heatmap):
+            client.get('/api/rides/fare-estimate/', query)  # Loads the speed profiles
+            with self.assertNumQueries(0):
+                response = client.get('/api/rides/fare-estimate/', query)
+            invalid = client.get('/api/rides/fare-estimate/', dict(query, pickup_latitude=400))
+        body = response.json()
+        self.assertEqual((body['surge'], body['open_rides'], body['idle_drivers']), (1.75, 6, 0))
+        low, high = estimates.fare_range(body['distance_km'], body['estimated_duration'], 1.75)
+        self.assertEqual(body['suggested_fare'], {'min': str(low), 'max': str(high)})
+        self.assertEqual(invalid.status_code, 400)
+
+    def test_parse_coordinates(self):
+        self.assertEqual(parse_coordinates('27.7', 85), (27.7, 85.0))
+        for latitude, longitude in (('abc', 85), (None, 85), (float('nan'), 85), (1e15, 85), ({}, 85), (27, 181)):
+            self.assertIsNone(parse_coordinates(latitude, longitude), (latitude, longitude))
+
+
+class PoolingTests(TestCase):
+    def setUp(self):
+        self.pool = PoolingIndex(cell_degrees=0.005, pickup_km=1.0, destination_km=1.5, min_overlap=0.6, window=600)
+
+    def add(self, ride_id, pickup, destination, opened_at=1000, via=()):
+        points = [pickup, *via, destination]
+        self.pool.add(ride_id, pickup, destination, encode_polyline(points), opened_at=opened_at)
+
+    def test_route_cells_cover_every_crossed_cell(self):
+        self.assertEqual(route_cells([(0.001, 0.001), (0.001, 0.021)], 0.005), {(0, column) for column in range(5)})
+        self.assertEqual(route_cells([(0.001, 0.001)], 0.005), {(0, 0)})
+
+    def test_candidates_share_ends_and_route(self):
+        self.add(1, (27.700, 85.300), (27.750, 85.300))
+        self.add(2, (27.703, 85.301), (27.752, 85.301))  # Same road north
+        self.add(3, (27.720, 85.300), (27.750, 85.300))  # Picked up 2 km away
+        self.add(4, (27.700, 85.300), (27.750, 85.305), via=[(27.725, 85.330)])  # A detour east
+        self.add(5, (27.700, 85.300), (27.770, 85.300))  # Dropped off 2 km further
+        self.add(6, (27.702, 85.300), (27.749, 85.300), opened_at=1300)
+        with mock.patch('rides.pooling.time.monotonic', return_value=1300):
+            self.assertEqual([match['ride_id'] for match in self.pool.candidates(1)], [6, 2])
+            match = self.pool.candidates(1, limit=1)[0]
+            self.assertEqual(match['overlap'], 1.0)
+            self.assertAlmostEqual(match['pickup_km'], 0.223, places=2)
+            self.assertEqual(self.pool.candidates(3), [])
+            self.assertEqual(self.pool.candidates(99), [])
+            self.assertEqual(self.pool.pairs(), [(1, 6)])
+
+    def test_rides_leave_when_taken_or_stale(self):
+        self.add(1, (27.700, 85.300), (27.750, 85.300))
+        self.add(2, (27.701, 85.300), (27.751, 85.300))
+        self.pool.ride_saved(Ride, Ride(id=2, status='accepted'))
+        with mock.patch('rides.pooling.time.monotonic', return_value=1000):
+            self.assertEqual((len(self.pool), self.pool.candidates(1)), (1, []))
+        self.add(3, (27.701, 85.300), (27.751, 85.300), opened_at=1550)
+        with mock.patch('rides.pooling.time.monotonic', return_value=1550):
+            self.assertEqual([match['ride_id'] for match in self.pool.candidates(1)], [3])
+        with mock.patch('rides.pooling.time.monotonic', return_value=1601):
+            self.assertEqual(self.pool.candidates(1), [])
+            self.assertEqual(len(self.pool), 1)
+
+    def test_ride_offers_carry_pool_candidates(self):
+        rider = User.objects.create_user('+9778000001', role='rider')
+        driver = User.objects.create_user('+9778000002', role='driver', is_available=True, is_online=True,
+                                          current_location='27.70,85.30')
+        route = encode_polyline([(27.700, 85.300), (27.750, 85.300)])
+        rides = [Ride(rider=rider, pickup_location='a', destination_location='b', status='requested',
+                      pickup_latitude=27.700 + offset, pickup_longitude=85.300, destination_latitude=27.750,
+                      destination_longitude=85.300, route_polyline=route) for offset in (0, 0.001)]
+        layer = get_channel_layer()
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(f'user_{driver.id}', channel)
+        with mock.patch('rides.dispatch.pool', self.pool):
+            for ride in rides:
+                ride.save()
+                self.pool.ride_saved(Ride, ride)  # The post_save receiver is the module-level pool's
+            dispatch_ride(rides[1])
+        offer = async_to_sync(layer.receive)(channel)
+        self.assertEqual(offer['pool_with'], [str(rides[0].id)])
@@ -1,10 +1,21 @@
 from django.urls import path, include
 from rest_framework.routers import SimpleRouter
-from .views import RideViewSet
+from . import async_views
+from .views import DriverRideListView, FareEstimateView, RideDetailView, RiderRideListView, RideViewSet
 
 router = SimpleRouter()
 router.register(r'', RideViewSet, basename='ride')
 
 urlpatterns = [
+    # Before the router, whose detail route would take these as a pk
+    path('history/', RiderRideListView.as_view(), name='rider-ride-history'),
+    path('feed/', DriverRideListView.as_view(), name='driver-ride-feed'),
+    path('fare-estimate/', FareEstimateView.as_view(), name='fare-estimate'),
+    path('<int:pk>/status/', RideDetailView.as_view(), name='ride-status'),
+    # Async-native ride actions, see rides.async_views
+    path('async/', async_views.create_ride, name='async-ride-create'),
+    path('async/<int:pk>/driver-bid/', async_views.submit_driver_bid, name='async-ride-driver-bid'),
+    path('async/<int:pk>/accept-bid/<int:bid_index>/', async_views.accept_bid, name='async-ride-accept-bid'),
+    path('async/<int:pk>/status/', async_views.update_status, name='async-ride-status'),
     path('', include(router.urls)),
 ]
@@ -1,22 +1,55 @@
+import heapq
 from rest_framework import generics, status, viewsets
 from rest_framework.decorators import action
+from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from .models import Ride
-from .serializers import RideSerializer
+from .serializers import BidSerializer, FareEstimateSerializer, RatingSerializer, RideSerializer
 from users.models import User # Import User model
-from django.db.models import Q # For complex queries
+from django.db.models import F, Q # For complex queries
 from django.utils import timezone # Import timezone for accepted_at, completed_at
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
-import json
+from .streams import publish_ride_event
+from . import stats
+from .dispatch import dispatch_ride
+from .archive import archived_rides
+from indrive.idempotency import idempotent
+from .conditional import list_validators, not_modified, ride_validators, set_validators
+from .estimates import estimate_trip, fare_range
+from .heatmap import heatmap
 
-class RideViewSet(viewsets.ModelViewSet):
+class ConditionalRetrieveMixin:
+    """Answers a poll for an unchanged ride with 304, without loading or serializing it"""
+
+    def retrieve(self, request, *args, **kwargs):
+        validators = ride_validators(kwargs[self.lookup_url_kwarg or self.lookup_field])
+        if validators is None:
+            return super().retrieve(request, *args, **kwargs)  # The usual 404
+        return not_modified(request, validators) or set_validators(
+            super().retrieve(request, *args, **kwargs), validators)
+
+
+class ConditionalListMixin:
+    """Answers a poll for an unchanged list with 304 after one aggregate query"""
+
+    def list(self, request, *args, **kwargs):
+        validators = list_validators(self.get_queryset())
+        return not_modified(request, validators) or set_validators(
+            self.full_list(request, *args, **kwargs), validators)
+
+    def full_list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+
+class RideViewSet(ConditionalRetrieveMixin, viewsets.ModelViewSet):
     queryset = Ride.objects.all()
     queryset = Ride.objects.all()
     serializer_class = RideSerializer
     permission_classes = [IsAuthenticated]
 
+    @idempotent('ride-create')
     def create(self, request, *args, **kwargs):
         """Handle ride creation with WebSocket notifications"""
         if request.user.role != 'rider':
@@ -29,15 +62,18 @@ class RideViewSet(viewsets.ModelViewSet):
 
         # Send WebSocket notification
         channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            "rides", {
+        async_to_sync(publish_ride_event)(
+            channel_layer, "rides", ride, {
                 "type": "ride_update",
-                "message": json.dumps(RideSerializer(ride).data)
+                "message": RideSerializer(ride).data
             }
         )
-        async_to_sync(channel_layer.group_add)(
-            f"ride_{ride.id}", f"user_{ride.rider.id}"
+        # Subscribe the rider's open sockets to the ride's own stream
+        async_to_sync(channel_layer.group_send)(
+            f"user_{ride.rider.id}", {"type": "ride.subscribe", "ride_id": str(ride.id)}
         )
+        # Offer the ride to the best matching online drivers
+        dispatch_ride(ride)
 
         headers = self.get_success_headers(serializer.data)
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
@@ -69,7 +105,7 @@ class RideViewSet(viewsets.ModelViewSet):
         serializer.is_valid(raise_exception=True)
         
         ride.passenger_counter_offers.append({
-            'amount': serializer.validated_data['amount'],
+            'amount': str(serializer.validated_data['amount']),
             'timestamp': timezone.now().isoformat(),
             'message': serializer.validated_data.get('message', '')
         })
@@ -78,9 +114,10 @@ class RideViewSet(viewsets.ModelViewSet):
         return Response(RideSerializer(ride).data)
 
     @action(detail=True, methods=['post'], url_path='driver-bid')
+    @idempotent('driver-bid')
     def submit_driver_bid(self, request, pk=None):
         ride = self.get_object()
-        if not request.user.is_driver:
+        if request.user.role != 'driver':
             return Response({"error": "Only drivers can bid"},
                           status=status.HTTP_403_FORBIDDEN)
         
@@ -89,19 +126,22 @@ class RideViewSet(viewsets.ModelViewSet):
         
         ride.driver_proposals.append({
             'driver': request.user.id,
-            'amount': serializer.validated_data['amount'],
+            'amount': str(serializer.validated_data['amount']), # JSONField: no Decimals
             'timestamp': timezone.now().isoformat(),
             'message': serializer.validated_data.get('message', '')
         })
         ride.save()
 
+        # Matching statistics: the driver's fare level and how fast they answered
+        stats.record_bid(request.user.id, serializer.validated_data['amount'])
+        stats.record_notification_response(request.user.id, ride.id)
+
         # Notify rider about new bid
         channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            f"user_{ride.rider.id}", {
+        async_to_sync(publish_ride_event)(
+            channel_layer, f"user_{ride.rider.id}", ride, {
                 "type": "bid_update",
-                "ride_id": str(ride.id),
-                "bid": serializer.validated_data['amount']
+                "bid": str(serializer.validated_data['amount'])
             }
         )
         
@@ -110,6 +150,12 @@ class RideViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['post'], url_path='accept-bid/(?P<bid_index>\d+)')
     def accept_bid(self, request, pk=None, bid_index=None):
         ride = self.get_object()
+        if ride.rider_id != request.user.id:
+            return Response({"error": "Only the ride's rider can accept a bid"},
+                          status=status.HTTP_403_FORBIDDEN)
+        if ride.status != 'requested':
+            return Response({"error": "Only requested rides can accept a bid"},
+                          status=status.HTTP_400_BAD_REQUEST)
         try:
             bid = ride.driver_proposals[int(bid_index)]
         except (IndexError, TypeError):
@@ -125,15 +171,67 @@ class RideViewSet(viewsets.ModelViewSet):
         # Notify both parties
         channel_layer = get_channel_layer()
         async_to_sync(channel_layer.group_send)(
-            f"ride_{ride.id}", {
+            f"user_{ride.driver.id}", {"type": "ride.subscribe", "ride_id": str(ride.id)}
+        )
+        async_to_sync(publish_ride_event)(
+            channel_layer, f"ride_{ride.id}", ride, {
                 "type": "ride_update",
-                "message": json.dumps(RideSerializer(ride).data)
+                "message": RideSerializer(ride).data
             }
         )
         
         return Response(RideSerializer(ride).data)
+
+    @action(detail=True, methods=['post'], url_path='rate')
+    def rate_driver(self, request, pk=None):
+        ride = self.get_object()
+        if ride.rider != request.user or ride.status != 'completed' or ride.driver_id is None:
+            return Response({"error": "Only the rider of a completed ride can rate its driver"},
+                          status=status.HTTP_403_FORBIDDEN)
+
+        serializer = RatingSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        # Conditional UPDATE so a ride is rated at most once, even under concurrent requests
+        if not Ride.objects.filter(id=ride.id, driver_rating__isnull=True).update(
+                driver_rating=serializer.validated_data['rating'],
+                version=F('version') + 1, updated_at=timezone.now()):
+            return Response({"error": "Ride already rated"}, status=status.HTTP_400_BAD_REQUEST)
+        stats.record_rating(ride.driver_id, serializer.validated_data['rating'])
+        ride.refresh_from_db()
+
+        return Response(RideSerializer(ride).data)
         
-class RiderRideListView(generics.ListAPIView):
+class FareEstimateView(APIView):
+    """Suggested fare range for a trip, from the local trip estimate and the
+    pickup area's surge and the zones' fare multiplier: no geo provider call,
+    and no query but authentication"""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        serializer = FareEstimateSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        pickup = (data['pickup_latitude'], data['pickup_longitude'])
+        distance, minutes = estimate_trip(pickup, (data['destination_latitude'], data['destination_longitude']))
+        surge = heatmap.surge(*pickup)
+        places = data['places']
+        zone_multiplier = max(place.fare_multiplier for place in places.values())
+        low, high = fare_range(distance, minutes, surge * zone_multiplier)
+        open_rides, idle_drivers = heatmap.counts(*pickup)
+        return Response({
+            'distance_km': distance,
+            'estimated_duration': minutes,
+            'pickup_zone': places['pickup'].zone,
+            'destination_zone': places['destination'].zone,
+            'zone_multiplier': zone_multiplier,
+            'surge': surge,
+            'open_rides': open_rides,
+            'idle_drivers': idle_drivers,
+            'suggested_fare': {'min': str(low), 'max': str(high)},
+        })
+
+class RiderRideListView(ConditionalListMixin, generics.ListAPIView):
     serializer_class = RideSerializer
     permission_classes = [IsAuthenticated]
 
@@ -141,21 +239,28 @@ class RiderRideListView(generics.ListAPIView):
         # Return rides requested by the current rider
         return Ride.objects.filter(rider=self.request.user).order_by('-created_at')
 
-class DriverRideListView(generics.ListAPIView):
+    def full_list(self, request, *args, **kwargs):
+        # Older rides live in the archive; both are newest first, so a merge keeps the order
+        rides = heapq.merge(self.get_queryset(), archived_rides(rider_id=request.user.id),
+                            key=lambda ride: ride.created_at, reverse=True)
+        return Response(self.get_serializer(rides, many=True).data)
+
+class DriverRideListView(ConditionalListMixin, generics.ListAPIView):
     serializer_class = RideSerializer
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
         # Return rides that are 'requested' and 'accepted' by the current driver
-        # Only show requested rides to available drivers
-        if self.request.user.role == 'driver' and self.request.user.is_available:
+        # Only show requested rides to available drivers whose app is online
+        user = self.request.user
+        if user.role == 'driver' and user.is_available and user.is_online:
             return Ride.objects.filter(Q(status='requested') | Q(driver=self.request.user, status='accepted')).order_by('-created_at')
-        elif self.request.user.role == 'driver' and not self.request.user.is_available:
-            # If driver is not available, only show their accepted/started rides
+        elif user.role == 'driver':
+            # If driver is not available or offline, only show their own rides
             return Ride.objects.filter(driver=self.request.user, status__in=['accepted', 'started', 'completed', 'cancelled']).order_by('-created_at')
         return Ride.objects.none() # Should not happen for non-drivers
 
-class RideDetailView(generics.RetrieveUpdateAPIView):
+class RideDetailView(ConditionalRetrieveMixin, generics.RetrieveUpdateAPIView):
     queryset = Ride.objects.all()
     serializer_class = RideSerializer
     permission_classes = [IsAuthenticated]
@@ -172,20 +277,23 @@ class RideDetailView(generics.RetrieveUpdateAPIView):
                 ride.status = 'accepted'
                 ride.accepted_at = timezone.now()
                 ride.save()
+                stats.record_notification_response(user.id, ride.id)
                 
                 # Notify the rider that their ride has been accepted
                 channel_layer = get_channel_layer()
-                async_to_sync(channel_layer.group_send)(
+                async_to_sync(publish_ride_event)(
+                    channel_layer,
                     f"user_{ride.rider.id}",
+                    ride,
                     {
                         "type": "ride_update",
-                        "message": json.dumps(RideSerializer(ride).data)
+                        "message": RideSerializer(ride).data
                     }
                 )
-                # Add driver to the ride's specific group
-                async_to_sync(channel_layer.group_add)(
-                    f"ride_{ride.id}",
-                    f"user_{ride.driver.id}"
+                # Add driver's sockets to the ride's specific group
+                async_to_sync(channel_layer.group_send)(
+                    f"user_{ride.driver.id}",
+                    {"type": "ride.subscribe", "ride_id": str(ride.id)}
                 )
                 return Response(RideSerializer(ride).data)
             else:
@@ -195,14 +303,17 @@ class RideDetailView(generics.RetrieveUpdateAPIView):
         if 'status' in request.data and request.data['status'] == 'started':
             if user.role == 'driver' and ride.driver == user and ride.status == 'accepted':
                 ride.status = 'started'
+                ride.started_at = timezone.now()
                 ride.save()
                 # Notify both rider and driver of status change
                 channel_layer = get_channel_layer()
-                async_to_sync(channel_layer.group_send)(
+                async_to_sync(publish_ride_event)(
+                    channel_layer,
                     f"ride_{ride.id}", # Send to ride-specific group
+                    ride,
                     {
                         "type": "ride_update",
-                        "message": json.dumps(RideSerializer(ride).data)
+                        "message": RideSerializer(ride).data
                     }
                 )
                 return Response(RideSerializer(ride).data)
@@ -215,13 +326,16 @@ class RideDetailView(generics.RetrieveUpdateAPIView):
                 ride.completed_at = timezone.now()
                 # For MVP, just complete. Later, calculate fare.
                 ride.save()
+                stats.record_ride_completed(ride)
                 # Notify both rider and driver of status change
                 channel_layer = get_channel_layer()
-                async_to_sync(channel_layer.group_send)(
+                async_to_sync(publish_ride_event)(
+                    channel_layer,
                     f"ride_{ride.id}", # Send to ride-specific group
+                    ride,
                     {
                         "type": "ride_update",
-                        "message": json.dumps(RideSerializer(ride).data)
+                        "message": RideSerializer(ride).data
                     }
                 )
                 return Response(RideSerializer(ride).data)
@@ -235,11 +349,13 @@ class RideDetailView(generics.RetrieveUpdateAPIView):
                 ride.save()
                 # Notify both rider and driver of cancellation
                 channel_layer = get_channel_layer()
-                async_to_sync(channel_layer.group_send)(
+                async_to_sync(publish_ride_event)(
+                    channel_layer,
                     f"ride_{ride.id}", # Send to ride-specific group
+                    ride,
                     {
                         "type": "ride_update",
-                        "message": json.dumps(RideSerializer(ride).data)
+                        "message": RideSerializer(ride).data
                     }
                 )
                 return Response(RideSerializer(ride).data)
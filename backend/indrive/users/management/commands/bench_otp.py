@@ -0,0 +1,57 @@
+import time
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.test import Client
+from django.test.utils import setup_databases, teardown_databases
+from users.models import User
+from users.otp import otp_cache_key
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark POST /api/auth/verify-otp/ through the full request stack against a throwaway '
+        'test database: half the phones belong to existing users, half sign up. Also floods '
+        'send-otp from one client to show the throttles.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000, help='verify-otp requests')
+        parser.add_argument('--rounds', type=int, default=5, help='verify-otp rounds; the median is reported')
+        parser.add_argument('--flood', type=int, default=500, help='send-otp requests from one IP')
+
+    def handle(self, *args, **options):
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            self.run(options)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+    def run(self, options):
+        client = Client()
+        count = options['requests']
+        timings = []
+        for round in range(options['rounds']):
+            phones = [f"9{round}{i:08d}" for i in range(count)]
+            User.objects.bulk_create([User(phone_number=phone, role='rider') for phone in phones[::2]])
+            started = time.perf_counter()
+            for i, phone in enumerate(phones):
+                # A different client address per request so the per-IP bucket stays out of the way
+                cache.set(otp_cache_key(phone), '123456', 300)
+                response = client.post('/api/auth/verify-otp/', {'phone_number': phone, 'otp': '123456'},
+                                       content_type='application/json',
+                                       REMOTE_ADDR=f"10.{round}.{i >> 8 & 255}.{i & 255}")
+                assert response.status_code == 200, response.content
+            timings.append(time.perf_counter() - started)
+        elapsed = sorted(timings)[len(timings) // 2]
+        self.stdout.write(f"verify-otp  {count} requests x {len(timings)} rounds, median {count / elapsed:.0f} req/s, "
+                          f"{elapsed / count * 1000:.3f} ms/request")
+
+        statuses = {}
+        started = time.perf_counter()
+        for i in range(options['flood']):
+            response = client.post('/api/auth/send-otp/', {'phone_number': f"97{i % 50:08d}"},
+                                   content_type='application/json', REMOTE_ADDR='192.0.2.1')
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f"send-otp    {options['flood']} requests from one IP, {options['flood'] / elapsed:.0f} req/s, "
+                          f"status codes {dict(sorted(statuses.items()))}")
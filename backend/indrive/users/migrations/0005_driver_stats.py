@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-19 14:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_user_is_online_user_last_seen_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='completed_rides',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='rating',
+            field=models.FloatField(default=5.0),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='response_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -1,5 +1,5 @@
 from django.contrib.auth.models import AbstractUser, BaseUserManager
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.utils.translation import gettext_lazy as _
 
 class CustomUserManager(BaseUserManager):
@@ -22,6 +22,21 @@ class CustomUserManager(BaseUserManager):
             raise ValueError(_('Superuser must have is_superuser=True.'))
         return self.create_user(phone_number, password, **extra_fields)
 
+    def get_or_create_otp_user(self, phone_number, **extra_fields):
+        """User of a verified phone number; new users get an OTP-only account without a password"""
+        try:
+            return self.get(phone_number=phone_number)
+        except self.model.DoesNotExist:
+            pass
+        user = self.model(phone_number=phone_number, **extra_fields)
+        user.set_unusable_password()
+        try:
+            with transaction.atomic(using=self.db):
+                user.save(force_insert=True, using=self.db)
+        except IntegrityError:  # Signed up by a concurrent request
+            return self.get(phone_number=phone_number)
+        return user
+
 class User(AbstractUser):
     username = None # We will use phone_number as the unique identifier
     phone_number = models.CharField(
@@ -46,6 +61,13 @@ class User(AbstractUser):
     current_location = models.CharField(max_length=255, null=True, blank=True) # "lat,lng"
     average_fare = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
     avg_response_time = models.FloatField(default=0.0) # In seconds
+    # Driver statistics for matching, maintained online by rides.stats
+    rating = models.FloatField(default=5.0) # Mean of the ratings riders gave
+    rating_count = models.PositiveIntegerField(default=0)
+    response_count = models.PositiveIntegerField(default=0) # Samples in avg_response_time
+    completed_rides = models.PositiveIntegerField(default=0)
+    is_online = models.BooleanField(default=False, db_index=True) # Maintained by rides.presence
+    last_seen_at = models.DateTimeField(null=True, blank=True) # Last WebSocket heartbeat
 
     USERNAME_FIELD = 'phone_number'
     REQUIRED_FIELDS = ['role'] # Add 'role' to required fields if you want it to be mandatory during creation
@@ -0,0 +1,33 @@
+"""
+One-time login codes.
+
+Codes live in the cache under ``otp:code:<phone>`` (the throttles in
+``users.throttles`` use ``otp:bucket:...``), so they can't collide with
+anything else the project caches.
+"""
+import secrets
+from django.conf import settings
+from django.core.cache import cache
+
+
+def otp_cache_key(phone_number):
+    return f"otp:code:{phone_number}"
+
+
+def issue_otp(phone_number):
+    """Create a six-digit code for the phone, replacing any earlier one"""
+    otp = f"{secrets.randbelow(1000000):06d}"
+    cache.set(otp_cache_key(phone_number), otp, settings.OTP_TTL_SECONDS)
+    return otp
+
+
+def consume_otp(phone_number, otp):
+    """True if ``otp`` is the phone's current code; a code can only be used once"""
+    if not isinstance(otp, str) or len(otp) != 6 or not otp.isascii() or not otp.isdigit():
+        return False
+    key = otp_cache_key(phone_number)
+    expected = cache.get(key)
+    if expected is None or not secrets.compare_digest(expected.encode(), otp.encode()):
+        return False
+    # Of two concurrent verifications with the same code only one deletes it
+    return cache.delete(key)
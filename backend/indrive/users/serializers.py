@@ -4,8 +4,8 @@ from .models import User
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
-        fields = ['phone_number', 'role', 'is_available']
-        read_only_fields = ['phone_number']
+        fields = ['phone_number', 'role', 'is_available', 'is_online']
+        read_only_fields = ['phone_number', 'is_online']
 
 class SendOTPSerializer(serializers.Serializer):
     phone_number = serializers.CharField(max_length=15)
@@ -0,0 +1,76 @@
+from contextlib import redirect_stdout
+from io import StringIO
+from unittest import mock
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+from users.models import User
+from users.otp import consume_otp, issue_otp
+
+
+@override_settings(OTP_THROTTLE_RATES={
+    'send_phone': (2, 60), 'send_ip': (4, 10), 'verify_phone': (3, 60), 'verify_ip': (100, 1),
+})
+class OTPTests(TestCase):
+    phone = '+9779800000001'
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.now = 1000.0
+        patcher = mock.patch('users.throttles.time.time', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def send(self, phone=None, ip='10.0.0.1'):
+        with redirect_stdout(StringIO()):  # The view prints the code in development
+            return self.client.post('/api/auth/send-otp/', {'phone_number': phone or self.phone},
+                                    format='json', REMOTE_ADDR=ip)
+
+    def verify(self, otp, phone=None):
+        return self.client.post('/api/auth/verify-otp/', {'phone_number': phone or self.phone, 'otp': otp},
+                                format='json')
+
+    def test_codes_are_single_use(self):
+        otp = issue_otp(self.phone)
+        self.assertFalse(consume_otp(self.phone, '12345'))
+        self.assertFalse(consume_otp(self.phone, '１２３４５６'))
+        response = self.verify(otp)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('access', response.json())
+        self.assertTrue(User.objects.filter(phone_number=self.phone).exists())
+        self.assertEqual(self.verify(otp).status_code, 400)
+
+    def test_a_new_code_replaces_the_old_one(self):
+        old = issue_otp(self.phone)
+        new = issue_otp(self.phone)
+        if old != new:
+            self.assertFalse(consume_otp(self.phone, old))
+        self.assertTrue(consume_otp(self.phone, new))
+
+    def test_phone_bucket_bursts_then_refills(self):
+        self.assertEqual([self.send().status_code for _ in range(3)], [200, 200, 429])
+        self.assertEqual(self.send().headers['Retry-After'], '60')
+        self.now += 59
+        self.assertEqual(self.send().status_code, 429)
+        self.now += 2
+        self.assertEqual(self.send().status_code, 200)
+
+    def test_spellings_of_a_number_share_a_bucket(self):
+        self.send()
+        self.send(f' {self.phone} ')
+        self.assertEqual(self.send(f'{self.phone}\n').status_code, 429)
+
+    def test_ip_bucket_spans_phone_numbers(self):
+        codes = [self.send(f'+97798000000{i:02d}').status_code for i in range(5)]
+        self.assertEqual(codes, [200, 200, 200, 200, 429])
+        self.assertEqual(self.send('+9779800000099', ip='10.0.0.2').status_code, 200)
+
+    def test_guesses_at_a_code_are_capped(self):
+        otp = issue_otp(self.phone)
+        wrong = '000000' if otp != '000000' else '111111'
+        self.assertEqual([self.verify(wrong).status_code for _ in range(3)], [400, 400, 400])
+        self.assertEqual(self.verify(otp).status_code, 429)
+
+    def test_invalid_phone_numbers_are_left_to_the_view(self):
+        self.assertEqual(self.send('x' * 16).status_code, 400)
@@ -0,0 +1,63 @@
+import time
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.exceptions import ValidationError
+from rest_framework.throttling import BaseThrottle
+from .serializers import SendOTPSerializer
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """Token bucket kept in the cache, one per view ``throttle_scope`` and client.
+
+    ``OTP_THROTTLE_RATES['<scope>_<kind>']`` is ``(capacity, refill_seconds)``:
+    a client may burst ``capacity`` requests, then gets one more every
+    ``refill_seconds``. A bucket expires from the cache once it would be full
+    again, so idle clients cost nothing. Buckets are read and written without
+    a lock: concurrent requests may overshoot the limit by a request or two.
+    """
+    kind = None
+
+    def get_bucket_ident(self, request):
+        raise NotImplementedError('.get_bucket_ident() must be overridden')
+
+    def allow_request(self, request, view):
+        ident = self.get_bucket_ident(request)
+        if not ident:
+            return True  # Left to the view's validation
+        scope = f"{view.throttle_scope}_{self.kind}"
+        capacity, refill_seconds = settings.OTP_THROTTLE_RATES[scope]
+        key = f"otp:bucket:{scope}:{ident}"
+        now = time.time()
+        tokens, updated_at = cache.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) / refill_seconds)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        else:
+            self.wait_seconds = (1 - tokens) * refill_seconds
+        cache.set(key, (tokens, now), timeout=int((capacity - tokens) * refill_seconds) + 1)
+        return allowed
+
+    def wait(self):
+        return getattr(self, 'wait_seconds', None)
+
+
+class PhoneNumberThrottle(TokenBucketThrottle):
+    """Keyed on the phone number as the OTP views clean it, so spellings of one number share a bucket"""
+    kind = 'phone'
+
+    def get_bucket_ident(self, request):
+        data = request.data
+        phone_number = data.get('phone_number') if hasattr(data, 'get') else None
+        try:
+            return SendOTPSerializer().fields['phone_number'].run_validation(phone_number)
+        except ValidationError:
+            return None
+
+
+class ClientIPThrottle(TokenBucketThrottle):
+    """Keyed on the client address as seen past ``NUM_PROXIES`` reverse proxies"""
+    kind = 'ip'
+
+    def get_bucket_ident(self, request):
+        return self.get_ident(request)